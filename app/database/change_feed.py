@@ -0,0 +1,139 @@
+import json
+from typing import Dict, List, Optional, Tuple
+
+import redis
+
+from config.logging import get_logger
+from config.redis_client import get_redis_client
+
+logger = get_logger(__name__)
+
+DEFAULT_STREAM = "grls:changes"
+MAX_SEQUENCE = 18446744073709551615
+
+
+def _session_entry_id(session_id: int, sequence: int) -> str:
+    """ID записи потока: <id сессии>-<номер события>, поэтому поток упорядочен по сессиям"""
+    return f"{session_id}-{sequence}"
+
+
+class ChangeFeed:
+    """
+    Лента изменений реестра в Redis Stream.
+
+    События сессии (added/modified/removed) публикуются пачками после записи сессии в БД,
+    последним идет событие session_completed. ID записей начинаются с id сессии, поэтому
+    читать можно с любой сессии, а длина потока ограничена MAXLEN. Вместе с session_completed
+    обновляется ключ <поток>:last_completed_session - последняя полностью опубликованная сессия.
+    """
+
+    def __init__(self, redis_client: Optional[redis.Redis] = None, stream: str = DEFAULT_STREAM,
+                 maxlen: int = 1_000_000, batch_size: int = 500):
+        self.redis = redis_client or get_redis_client()
+        self.stream = stream
+        self.maxlen = maxlen
+        self.batch_size = batch_size
+        self.completed_key = f"{stream}:last_completed_session"
+
+    def last_published_session(self) -> Optional[int]:
+        last = self.redis.xrevrange(self.stream, count=1)
+        if not last:
+            return None
+        return int(last[0][0].decode().split('-')[0])
+
+    def last_completed_session(self) -> Optional[int]:
+        """Последняя сессия, опубликованная вместе с session_completed; None - поток пустой"""
+        raw = self.redis.get(self.completed_key)
+        if raw is not None:
+            return int(raw)
+
+        # поток, записанный до появления ключа: последняя запись или завершает сессию, или нет
+        last = self.redis.xrevrange(self.stream, count=1)
+        if not last:
+            return None
+        entry_id, fields = last[0]
+        session_id = int(entry_id.decode().split('-')[0])
+        return session_id if fields.get(b'change_type') == b'session_completed' else session_id - 1
+
+    def session_progress(self, session_id: int) -> Tuple[int, bool]:
+        """Сколько записей сессии уже в потоке и опубликовано ли session_completed"""
+        last = self.redis.xrevrange(self.stream, max=_session_entry_id(session_id, MAX_SEQUENCE),
+                                    min=_session_entry_id(session_id, 0), count=1)
+        if not last:
+            return 0, False
+        entry_id, fields = last[0]
+        completed = fields.get(b'change_type') == b'session_completed'
+        return int(entry_id.decode().split('-')[1]) + 1, completed
+
+    def publish_session(self, session_id: int, events: List[Dict]) -> int:
+        """
+        Публикует события сессии. Сессия с session_completed пропускается, прерванная
+        публикация продолжается с первой ненаписанной записи
+        """
+        written, completed = self.session_progress(session_id)
+        if completed:
+            logger.info(f"Изменения сессии {session_id} уже опубликованы")
+            return 0
+
+        last_session = self.last_published_session()
+        if last_session is not None and last_session > session_id:
+            logger.warning(f"Изменения сессии {session_id} не опубликованы: в потоке уже есть "
+                           f"более поздняя сессия {last_session}")
+            return 0
+
+        entries = [
+            {
+                'session_id': session_id,
+                'entity': event['entity'],
+                'change_type': event['change_type'],
+                'payload': json.dumps(event['payload'], ensure_ascii=False, default=str),
+            }
+            for event in events
+        ]
+        entries.append({'session_id': session_id, 'entity': 'session', 'change_type': 'session_completed',
+                        'payload': json.dumps({'events': len(events)})})
+
+        if written:
+            logger.info(f"Продолжаем публикацию сессии {session_id} с записи {written}")
+
+        for start in range(written, len(entries), self.batch_size):
+            pipeline = self.redis.pipeline(transaction=False)
+            for sequence, fields in enumerate(entries[start:start + self.batch_size], start=start):
+                pipeline.xadd(self.stream, fields, id=_session_entry_id(session_id, sequence),
+                              maxlen=self.maxlen, approximate=True)
+            if start + self.batch_size >= len(entries):
+                pipeline.set(self.completed_key, session_id)
+            pipeline.execute()
+
+        logger.info(f"Опубликовано изменений сессии {session_id}: {len(events)}")
+        return max(len(events) - written, 0)
+
+    def ensure_group(self, group: str, from_session: Optional[int] = None):
+        """Создает группу потребителей; from_session - с какой сессии читать, по умолчанию только новые"""
+        start_id = _session_entry_id(from_session - 1, MAX_SEQUENCE) if from_session else '$'
+        try:
+            self.redis.xgroup_create(self.stream, group, id=start_id, mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def read(self, group: str, consumer: str, count: int = 100, block_ms: int = 5000) -> List[Tuple[str, Dict]]:
+        """Читает новые события для потребителя группы"""
+        response = self.redis.xreadgroup(group, consumer, {self.stream: '>'}, count=count, block=block_ms)
+        return [self._decode(entry_id, fields) for _, entries in response for entry_id, fields in entries]
+
+    def ack(self, group: str, *entry_ids: str):
+        if entry_ids:
+            self.redis.xack(self.stream, group, *entry_ids)
+
+    def replay(self, from_session: int, count: int = 1000) -> List[Tuple[str, Dict]]:
+        """Читает события начиная с сессии from_session, без группы потребителей"""
+        entries = self.redis.xrange(self.stream, min=_session_entry_id(from_session, 0), count=count)
+        return [self._decode(entry_id, fields) for entry_id, fields in entries]
+
+    @staticmethod
+    def _decode(entry_id: bytes, fields: Dict[bytes, bytes]) -> Tuple[str, Dict]:
+        event = {key.decode(): value.decode() for key, value in fields.items()}
+        event['session_id'] = int(event['session_id'])
+        event['payload'] = json.loads(event['payload'])
+        return entry_id.decode(), event
@@ -1,25 +1,122 @@
 import os
-from config.logging import get_logger
-from typing import Dict, List, Optional
-from datetime import datetime, timedelta
+import sys
+import gzip
+import zlib
+import hashlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from config.logging import get_logger, StageCounters
+from typing import Dict, List, Optional, Sequence
+from datetime import date, datetime
 import json
 
 import psycopg2
 from psycopg2 import IntegrityError
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
 logger = get_logger(__name__)
 
+CONSUMER_SNAPSHOT_COLUMNS = '''
+    substance_name, substance_id, preparation_trade_name, preparation_inn_name, preparation_manufacturer,
+    preparation_country, registration_number, registration_date, release_forms,
+    version, valid_from_session, valid_to_session
+'''
+
+# Старшие 32 бита ключа pg_advisory_xact_lock для блокировок шардов записи
+SHARD_LOCK_NAMESPACE = 0x47524C53
+
+
+def shard_of(substance_name: str, n_shards: int) -> int:
+    """Шард строки среза. Все строки одной субстанции попадают в один шард"""
+    return zlib.crc32(substance_name.encode('utf-8')) % n_shards
+
+
+def shard_stage(stage: str, shard: int, n_shards: int) -> str:
+    """
+    Этап записи шарда в session_persist_progress. Число шардов входит в название:
+    при другом числе шардов в шард попадают другие строки, и чужой прогресс не подходит
+    """
+    return f'{stage}:shard{shard}of{n_shards}' if n_shards > 1 else stage
+
+
+def shard_lock_key(session_id: int, shard: int, n_shards: int) -> int:
+    """Ключ advisory блокировки шарда: сессия, номер шарда и число шардов"""
+    return (SHARD_LOCK_NAMESPACE << 32) | zlib.crc32(f'{session_id}:{shard}:{n_shards}'.encode('utf-8'))
+
+
+# Какие поля statistics попадают в session_statistics и под какой категорией
+STATISTICS_COUNTERS = ('total_records', 'substances_found', 'preparations_found',
+                       'substance_consumers_found', 'unique_substances')
+STATISTICS_RANKINGS = {
+    'manufacturer': 'top_manufacturers',
+    'substance': 'top_substances',
+    'country': 'countries_distribution',
+}
+
+# Что выгружается в снимок реестра
+EXPORT_QUERIES = {
+    'substance_manufacturers': '''
+        SELECT id, substance_name, substance_id, manufacturers, version, valid_from_session, first_seen_date,
+               (SELECT MAX(timestamp) FROM analysis_sessions WHERE status = 'completed') AS last_seen_date
+        FROM substance_manufacturers
+        WHERE is_current = TRUE
+        ORDER BY id
+    ''',
+    'substance_consumers': '''
+        SELECT id, substance_name, substance_id, preparation_trade_name, preparation_inn_name,
+               preparation_manufacturer, preparation_country, registration_number, registration_date, release_forms,
+               version, valid_from_session, first_seen_date,
+               (SELECT MAX(timestamp) FROM analysis_sessions WHERE status = 'completed') AS last_seen_date
+        FROM substance_consumers
+        WHERE is_current = TRUE
+        ORDER BY id
+    ''',
+}
+
+
+class PooledConnection:
+    """Соединение из пула: close() возвращает его в пул, а не закрывает"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is None:
+            return
+        if not self._conn.closed:
+            # сбрасываем незавершенную транзакцию и настройки сессии (например, после выгрузки)
+            self._conn.rollback()
+            self._conn.set_session(isolation_level='DEFAULT', readonly='DEFAULT')
+        self._pool.putconn(self._conn)
+        self._conn = None
+
 
 class PostgresHandler:
-    def __init__(self, database_url: Optional[str] = None):
+    def __init__(self, database_url: Optional[str] = None, change_feed=None, pool_size: int = 0):
         self.database_url = database_url or os.getenv('DATABASE_URL')
         if not self.database_url:
             raise ValueError("DATABASE_URL не установлен в .env")
+        self.change_feed = change_feed
+        # pool_size > 0 - соединения переиспользуются (долгоживущий процесс воркера)
+        self.pool = ThreadedConnectionPool(1, pool_size, self.database_url) if pool_size else None
 
     def _get_connection(self):
         """Возвращает соединение с PostgreSQL"""
+        if self.pool:
+            return PooledConnection(self.pool, self.pool.getconn())
         return psycopg2.connect(self.database_url)
 
+    def close(self):
+        """Закрывает пул соединений"""
+        if self.pool:
+            self.pool.closeall()
+            self.pool = None
+
     def test_connection(self):
         """Проверяет соединение с базой данных"""
         try:
@@ -31,122 +128,586 @@ class PostgresHandler:
             logger.error(f"Ошибка подключения к PostgreSQL - {e}")
             return False
 
-    def save_analysis_result(self, analysis_result: Dict) -> int:
-        """Сохраняет результат анализа в PostgreSQL с версионированием"""
+    def save_analysis_result(self, analysis_result: Dict, shards: Optional[int] = None) -> int:
+        """
+        Сохраняет результат анализа в PostgreSQL с версионированием.
+
+        Данные пишутся нумерованными пачками, прогресс пачки коммитится в той же транзакции,
+        что и сама пачка. Если запись прервалась, повторный вызов для того же файла
+        (source_sha256) продолжает незавершенную сессию с первой незаписанной пачки.
+        При shards > 1 (по умолчанию PERSIST_SHARDS) срез делится на шарды по субстанции,
+        шарды пишутся параллельно в отдельных соединениях. Сессия помечается завершенной
+        только после записи всех шардов
+        """
+        shards = shards or int(os.getenv('PERSIST_SHARDS', '1'))
+        session_id = self.begin_session(analysis_result)
+
+        if shards == 1:
+            changes = self.persist_shard(session_id, analysis_result)
+        else:
+            workers = min(shards, self.pool.maxconn) if self.pool else shards
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='persist-shard') as executor:
+                futures = [
+                    executor.submit(self.persist_shard, session_id, analysis_result, shard, shards)
+                    for shard in range(shards)
+                ]
+                # исключение любого шарда прерывает запись, сессия остается незавершенной
+                changes = sum(future.result() for future in futures)
+
+        self.finalize_session(session_id, analysis_result, shards)
+        logger.info(f"Результаты анализа сохранены в БД (сессия - {session_id}, изменений - {changes})")
+        return session_id
+
+    def begin_session(self, analysis_result: Dict) -> int:
+        """Создает сессию анализа или возвращает незавершенную сессию того же файла"""
         conn = None
         try:
             conn = self._get_connection()
-            cursor = conn.cursor()
-
-            # Сохраняем сессию анализа и СРАЗУ КОММИТИМ
-            cursor.execute('''
-                INSERT INTO analysis_sessions 
-                (timestamp, source_file, total_records, substances_found, preparations_found, consumers_found)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                RETURNING id
-            ''', (
-                analysis_result['timestamp'],
-                analysis_result['source_file'],
-                analysis_result['statistics']['total_records'],
-                analysis_result['statistics']['substances_found'],
-                analysis_result['statistics']['preparations_found'],
-                analysis_result['statistics']['substance_consumers_found']
-            ))
-
-            session_id = cursor.fetchone()[0]
+            return self._begin_session(conn, analysis_result)
 
-            # КОММИТИМ сессию сразу, чтобы она была доступна в других транзакциях
-            conn.commit()
-            logger.info(f"Сессия анализа создана: {session_id}")
+        except Exception as e:
+            if conn:
+                conn.rollback()
+            logger.error(f"Ошибка создания сессии анализа - {e}")
+            raise
+        finally:
+            if conn:
+                conn.close()
 
-            # Теперь обрабатываем данные в отдельных транзакциях
-            manufacturer_changes = self._process_substance_manufacturers(
-                session_id, analysis_result['substances_manufacturers']
+    def persist_shard(self, session_id: int, analysis_result: Dict, shard: int = 0, n_shards: int = 1) -> int:
+        """
+        Пишет строки среза, попавшие в шард (shard_of(substance_name, n_shards) == shard).
+        Каждая пачка пишется под транзакционной advisory блокировкой шарда (сессия, шард, число шардов),
+        а прогресс пачки перечитывается уже под блокировкой, поэтому два процесса, пишущие
+        один шард (например, повтор задачи), не перемешивают версии и не пишут пачку дважды.
+        Возвращает число изменений в шарде
+        """
+        conn = None
+        try:
+            conn = self._get_connection()
+            progress = self._load_progress(conn, session_id)
+            lock_key = shard_lock_key(session_id, shard, n_shards)
+
+            manufacturer_changes = self._persist_in_batches(
+                conn, session_id, shard_stage('substance_manufacturers', shard, n_shards),
+                self._shard_items(analysis_result['substances_manufacturers'], shard, n_shards,
+                                  key=lambda m: m['substance_name']),
+                self._process_single_manufacturer, progress, lock_key
             )
 
-            consumer_changes = self._process_substance_consumers(
-                session_id, analysis_result['substance_consumers']
+            consumer_changes = self._persist_in_batches(
+                conn, session_id, shard_stage('substance_consumers', shard, n_shards),
+                self._shard_items(analysis_result['substance_consumers'], shard, n_shards, key=self._consumer_key),
+                self._process_single_consumer, progress, lock_key
             )
 
-            logger.info(
-                f"Результаты анализа сохранены в БД (сессия - {session_id}, изменений - {manufacturer_changes + consumer_changes})")
-            return session_id
+            return manufacturer_changes + consumer_changes
 
         except Exception as e:
             if conn:
                 conn.rollback()
-            logger.error(f"Ошибка сохранения в БД - {e}")
+            logger.error(f"Ошибка сохранения шарда {shard}/{n_shards} сессии {session_id} - {e}")
             raise
         finally:
             if conn:
                 conn.close()
 
-    def _process_substance_manufacturers(self, session_id: int, current_manufacturers: List[Dict]) -> int:
-        """Обрабатывает производителей субстанций с версионированием - КАЖДЫЙ в отдельной транзакции"""
-        changes_count = 0
+    def finalize_session(self, session_id: int, analysis_result: Dict, n_shards: int = 1):
+        """
+        Проверяет, что все шарды записаны полностью, закрывает удаленные строки
+        и помечает сессию завершенной, затем публикует изменения
+        """
+        conn = None
+        try:
+            conn = self._get_connection()
+            missing = self._unfinished_stages(conn, session_id, analysis_result, n_shards)
+            if missing:
+                raise RuntimeError(f"Сессия {session_id} записана не полностью, не завершены: {', '.join(missing)}")
 
-        for substance_data in current_manufacturers:
-            conn = None
-            try:
-                conn = self._get_connection()
-                cursor = conn.cursor()
+            self._complete_session(conn, session_id, analysis_result)
 
-                changes_count += self._process_single_manufacturer(cursor, session_id, substance_data)
-                conn.commit()
+        except Exception as e:
+            if conn:
+                conn.rollback()
+            logger.error(f"Ошибка завершения сессии {session_id} - {e}")
+            raise
+        finally:
+            if conn:
+                conn.close()
 
-            except Exception as e:
-                logger.error(
-                    f"Ошибка при обработке производителя {substance_data.get('substance_name', 'unknown')}: {e}")
-                if conn:
-                    conn.rollback()
-                continue
-            finally:
-                if conn:
-                    conn.close()
+        self._publish_changes(session_id)
+        self._publish_latest_session(session_id)
 
-        return changes_count
+    def save_session_snapshot(self, session_id: int, analysis_result: Dict):
+        """
+        Сохраняет срез сессии в БД, откуда его читают шарды на других воркерах.
+        Срез хранится до завершения сессии
+        """
+        conn = None
+        try:
+            conn = self._get_connection()
+            snapshot = gzip.compress(json.dumps(analysis_result, ensure_ascii=False, default=str).encode('utf-8'))
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO session_snapshots (session_id, snapshot)
+                VALUES (%s, %s)
+                ON CONFLICT (session_id) DO UPDATE SET snapshot = EXCLUDED.snapshot, created_at = NOW()
+            ''', (session_id, psycopg2.Binary(snapshot)))
+            conn.commit()
+            logger.info(f"Срез сессии {session_id} сохранен в БД ({len(snapshot) / (1024 * 1024):.2f} MB)")
 
-    def _process_substance_consumers(self, session_id: int, current_consumers: List[Dict]) -> int:
-        """Обрабатывает препараты с версионированием - КАЖДЫЙ препарат в ОТДЕЛЬНОЙ транзакции"""
-        changes_count = 0
+        except Exception as e:
+            if conn:
+                conn.rollback()
+            logger.error(f"Ошибка сохранения среза сессии {session_id} - {e}")
+            raise
+        finally:
+            if conn:
+                conn.close()
 
-        for consumer in current_consumers:
-            conn = None
-            try:
-                conn = self._get_connection()
-                cursor = conn.cursor()
+    def load_session_snapshot(self, session_id: int) -> Dict:
+        """Читает срез сессии, сохраненный save_session_snapshot, с датами регистрации типа date"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            cursor.execute('SELECT snapshot FROM session_snapshots WHERE session_id = %s', (session_id,))
+            row = cursor.fetchone()
+            conn.commit()
+            if row is None:
+                raise LookupError(f"Срез сессии {session_id} не найден")
+
+            analysis_result = json.loads(gzip.decompress(bytes(row[0])).decode('utf-8'))
+            for consumer in analysis_result['substance_consumers']:
+                if consumer.get('registration_date'):
+                    consumer['registration_date'] = date.fromisoformat(consumer['registration_date'])
+            return analysis_result
+
+        finally:
+            if conn:
+                conn.close()
 
-                changes_count += self._process_single_consumer(cursor, session_id, consumer)
+    @staticmethod
+    def _shard_items(items: List[Dict], shard: int, n_shards: int, key) -> List[Dict]:
+        """Строки шарда в детерминированном порядке - номера пачек совпадают между запусками"""
+        return sorted((item for item in items if shard_of(item['substance_name'], n_shards) == shard), key=key)
+
+    def _load_progress(self, conn, session_id: int) -> Dict:
+        """Прогресс записи сессии по этапам: {этап: (последняя пачка, изменений)}"""
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT stage, last_batch, changes
+            FROM session_persist_progress
+            WHERE session_id = %s
+        ''', (session_id,))
+        progress = {stage: (last_batch, changes) for stage, last_batch, changes in cursor.fetchall()}
+        conn.commit()
+        return progress
+
+    def _unfinished_stages(self, conn, session_id: int, analysis_result: Dict, n_shards: int) -> List[str]:
+        """Этапы (с шардами), в которых записаны не все пачки"""
+        batch_size = int(os.getenv('PERSIST_BATCH_SIZE', '500'))
+        progress = self._load_progress(conn, session_id)
+
+        expected = Counter()
+        for stage, items in (('substance_manufacturers', analysis_result['substances_manufacturers']),
+                             ('substance_consumers', analysis_result['substance_consumers'])):
+            for item in items:
+                expected[shard_stage(stage, shard_of(item['substance_name'], n_shards), n_shards)] += 1
+
+        return sorted(
+            stage for stage, count in expected.items()
+            if progress.get(stage, (-1, 0))[0] < (count + batch_size - 1) // batch_size - 1
+        )
+
+    @staticmethod
+    def _consumer_key(consumer: Dict) -> tuple:
+        """Уникальный ключ препарата: каноническая субстанция и регистрация препарата"""
+        return (
+            consumer['substance_id'],
+            consumer['preparation_trade_name'],
+            consumer['preparation_manufacturer'],
+            consumer['registration_number']
+        )
+
+    def _begin_session(self, conn, analysis_result: Dict) -> int:
+        """Возвращает id сессии. Незавершенная сессия того же файла продолжается, иначе создается новая"""
+        cursor = conn.cursor()
+        source_hash = analysis_result.get('source_sha256')
+
+        if source_hash:
+            cursor.execute('''
+                SELECT id FROM analysis_sessions
+                WHERE status = 'in_progress' AND source_hash = %s
+                ORDER BY id DESC
+                LIMIT 1
+            ''', (source_hash,))
+            row = cursor.fetchone()
+
+            if row:
+                session_id = row[0]
                 conn.commit()
+                logger.info(f"Продолжаем незавершенную сессию {session_id}")
+                return session_id
+
+        # незавершенные сессии других файлов уже не будут продолжены - откатываем их записи
+        cursor.execute('''
+            SELECT id FROM analysis_sessions
+            WHERE status = 'in_progress'
+            ORDER BY id
+            FOR UPDATE
+        ''')
+        for (abandoned_id,) in cursor.fetchall():
+            self._abandon_session(cursor, abandoned_id)
+
+        cursor.execute('''
+            INSERT INTO analysis_sessions 
+            (timestamp, source_file, source_hash, status, total_records, substances_found, preparations_found,
+             consumers_found, unique_substances)
+            VALUES (%s, %s, %s, 'in_progress', %s, %s, %s, %s, %s)
+            RETURNING id
+        ''', (
+            analysis_result['timestamp'],
+            analysis_result['source_file'],
+            source_hash,
+            analysis_result['statistics']['total_records'],
+            analysis_result['statistics']['substances_found'],
+            analysis_result['statistics']['preparations_found'],
+            analysis_result['statistics']['substance_consumers_found'],
+            analysis_result['statistics'].get('unique_substances')
+        ))
+
+        session_id = cursor.fetchone()[0]
+        self._save_session_statistics(cursor, session_id, analysis_result['statistics'])
+
+        # КОММИТИМ сессию сразу, чтобы она была доступна в других транзакциях
+        conn.commit()
+        logger.info(f"Сессия анализа создана: {session_id}")
+        return session_id
+
+    def _abandon_session(self, cursor, session_id: int):
+        """
+        Откатывает записи незавершенной сессии: удаляет вставленные ею версии, возвращает
+        актуальность закрытым ею версиям, удаляет ее журнал, прогресс, срез и статистику и помечает сессию брошенной
+        """
+        counts = {}
+        for table in ('substance_manufacturers', 'substance_consumers'):
+            # сначала удаляем новые версии, иначе восстановленная старая нарушит уникальность актуальных
+            cursor.execute(f'DELETE FROM {table} WHERE valid_from_session = %s', (session_id,))
+            counts[f'{table}_deleted'] = cursor.rowcount
+            cursor.execute(f'''
+                UPDATE {table}
+                SET is_current = TRUE, valid_to_session = NULL
+                WHERE valid_to_session = %s
+            ''', (session_id,))
+            counts[f'{table}_reopened'] = cursor.rowcount
+
+        for table in ('substance_manufacturer_changes', 'substance_consumer_changes', 'session_persist_progress',
+                      'session_snapshots', 'session_statistics'):
+            cursor.execute(f'DELETE FROM {table} WHERE session_id = %s', (session_id,))
 
-            except Exception as e:
-                logger.error(f"Ошибка при обработке препарата {consumer.get('preparation_trade_name', 'unknown')}: {e}")
-                if conn:
-                    conn.rollback()
+        cursor.execute('''
+            UPDATE analysis_sessions SET status = 'abandoned'
+            WHERE id = %s
+        ''', (session_id,))
+        logger.warning(f"Незавершенная сессия {session_id} брошена, ее записи откачены: {counts}")
+
+    def _persist_in_batches(self, conn, session_id: int, stage: str, items: List[Dict],
+                            process_row, progress: Dict, lock_key: int) -> int:
+        """
+        Пишет элементы пачками по PERSIST_BATCH_SIZE, пропуская уже записанные пачки.
+        progress - прогресс на момент старта, под блокировкой он перечитывается для каждой пачки.
+        Ошибка в одной строке откатывается до точки сохранения и не влияет на остальные
+        """
+        batch_size = int(os.getenv('PERSIST_BATCH_SIZE', '500'))
+        last_batch, changes_count = progress.get(stage, (-1, 0))
+        counters = StageCounters(logger, stage)
+
+        for batch_number, start in enumerate(range(0, len(items), batch_size)):
+            if batch_number <= last_batch:
+                counters.incr('skipped_batches')
                 continue
-            finally:
-                if conn:
-                    conn.close()
 
+            cursor = conn.cursor()
+            # блокировка шарда держится до коммита пачки
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', (lock_key,))
+            # пока ждали блокировку, пачку мог записать другой процесс
+            cursor.execute('''
+                SELECT last_batch, changes FROM session_persist_progress
+                WHERE session_id = %s AND stage = %s
+            ''', (session_id, stage))
+            row = cursor.fetchone()
+            if row:
+                last_batch, changes_count = row
+                if batch_number <= last_batch:
+                    conn.commit()
+                    counters.incr('skipped_batches')
+                    continue
+
+            for item in items[start:start + batch_size]:
+                cursor.execute('SAVEPOINT persist_row')
+                try:
+                    changes_count += process_row(cursor, session_id, item)
+                    cursor.execute('RELEASE SAVEPOINT persist_row')
+                    counters.incr('processed')
+                except psycopg2.OperationalError:
+                    # соединение потеряно - прерываем, следующий запуск продолжит с этой пачки
+                    raise
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO SAVEPOINT persist_row')
+                    logger.error(
+                        f"Ошибка при обработке {stage} {item.get('preparation_trade_name') or item.get('substance_name', 'unknown')}: {e}")
+                    counters.incr(f'error_{type(e).__name__}')
+
+            cursor.execute('''
+                INSERT INTO session_persist_progress (session_id, stage, last_batch, changes, updated_at)
+                VALUES (%s, %s, %s, %s, NOW())
+                ON CONFLICT (session_id, stage)
+                DO UPDATE SET last_batch = EXCLUDED.last_batch, changes = EXCLUDED.changes, updated_at = NOW()
+                WHERE session_persist_progress.last_batch < EXCLUDED.last_batch
+            ''', (session_id, stage, batch_number, changes_count))
+            conn.commit()
+            counters.incr('batches')
+
+        counters.incr('changed', changes_count)
+        counters.log_summary()
         return changes_count
 
+    def _complete_session(self, conn, session_id: int, analysis_result: Dict):
+        """
+        Помечает сессию завершенной и закрывает строки, которых нет в срезе, - в одной транзакции.
+        Завершается только сессия в статусе in_progress: повторное завершение пропускается,
+        брошенная сессия не завершается
+        """
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE analysis_sessions
+            SET status = 'completed', completed_at = NOW()
+            WHERE id = %s AND status = 'in_progress'
+        ''', (session_id,))
+
+        if cursor.rowcount == 0:
+            cursor.execute('SELECT status FROM analysis_sessions WHERE id = %s', (session_id,))
+            row = cursor.fetchone()
+            conn.rollback()
+            if row and row[0] == 'completed':
+                logger.info(f"Сессия {session_id} уже завершена")
+                return
+            raise RuntimeError(f"Сессия {session_id} не может быть завершена, статус - {row[0] if row else 'нет сессии'}")
+
+        self._close_removed(cursor, session_id, analysis_result)
+        cursor.execute('DELETE FROM session_snapshots WHERE session_id = %s', (session_id,))
+        conn.commit()
+
+    def _close_removed(self, cursor, session_id: int, analysis_result: Dict):
+        """
+        Закрывает актуальные версии, которых нет в срезе сессии (valid_to_session = сессия),
+        и пишет 'removed' в журналы. Неизмененные строки при записи не обновляются,
+        поэтому 'последний раз видели' следует из границ действия версии.
+        Ключи среза загружаются во временные таблицы, закрытие и запись в журнал - один запрос на таблицу
+        """
+        manufacturers = analysis_result['substances_manufacturers']
+        consumers = analysis_result['substance_consumers']
+        if not manufacturers or not consumers:
+            # пустой срез - скорее ошибка разбора, чем удаление всего реестра
+            logger.warning(f"Срез сессии {session_id} пустой, удаленные записи не закрываем")
+            return
+
+        cursor.execute('''
+            CREATE TEMP TABLE snapshot_manufacturer_keys (substance_id BIGINT) ON COMMIT DROP
+        ''')
+        execute_values(cursor, 'INSERT INTO snapshot_manufacturer_keys (substance_id) VALUES %s',
+                       [(m['substance_id'],) for m in manufacturers], page_size=1000)
+        cursor.execute('ANALYZE snapshot_manufacturer_keys')
+        cursor.execute('''
+            WITH closed AS (
+                UPDATE substance_manufacturers m
+                SET is_current = FALSE, valid_to_session = %(session_id)s
+                WHERE m.is_current = TRUE
+                AND NOT EXISTS (SELECT 1 FROM snapshot_manufacturer_keys k WHERE k.substance_id = m.substance_id)
+                RETURNING m.substance_name, m.substance_id, m.manufacturers
+            )
+            INSERT INTO substance_manufacturer_changes
+            (substance_name, substance_id, old_manufacturers, change_type, session_id)
+            SELECT substance_name, substance_id, manufacturers, 'removed', %(session_id)s
+            FROM closed
+        ''', {'session_id': session_id})
+        removed_manufacturers = cursor.rowcount
+
+        cursor.execute('''
+            CREATE TEMP TABLE snapshot_consumer_keys (
+                substance_id BIGINT,
+                preparation_trade_name VARCHAR(500),
+                preparation_manufacturer VARCHAR(500),
+                registration_number VARCHAR(100)
+            ) ON COMMIT DROP
+        ''')
+        execute_values(cursor, '''
+            INSERT INTO snapshot_consumer_keys
+            (substance_id, preparation_trade_name, preparation_manufacturer, registration_number)
+            VALUES %s
+        ''', [self._consumer_key(c) for c in consumers], page_size=1000)
+        cursor.execute('ANALYZE snapshot_consumer_keys')
+        cursor.execute('''
+            WITH closed AS (
+                UPDATE substance_consumers c
+                SET is_current = FALSE, valid_to_session = %(session_id)s
+                WHERE c.is_current = TRUE
+                AND NOT EXISTS (
+                    SELECT 1 FROM snapshot_consumer_keys k
+                    WHERE k.substance_id = c.substance_id
+                    AND k.preparation_trade_name = c.preparation_trade_name
+                    AND k.preparation_manufacturer = c.preparation_manufacturer
+                    AND k.registration_number = c.registration_number
+                )
+                RETURNING c.substance_name, c.substance_id, c.preparation_trade_name, c.preparation_inn_name,
+                          c.preparation_manufacturer, c.preparation_country, c.registration_number,
+                          c.registration_date, c.release_forms
+            )
+            INSERT INTO substance_consumer_changes
+            (substance_name, substance_id, preparation_trade_name, preparation_inn_name, preparation_manufacturer,
+             preparation_country, registration_number, registration_date, release_forms, change_type, session_id)
+            SELECT substance_name, substance_id, preparation_trade_name, preparation_inn_name,
+                   preparation_manufacturer, preparation_country, registration_number,
+                   registration_date, release_forms, 'removed', %(session_id)s
+            FROM closed
+        ''', {'session_id': session_id})
+        removed_consumers = cursor.rowcount
+
+        logger.info(f"Закрыто отсутствующих в срезе записей: производителей - {removed_manufacturers}, "
+                    f"препаратов - {removed_consumers}")
+
+    def _save_session_statistics(self, cursor, session_id: int, statistics: Dict):
+        """Сохраняет счетчики и топы сессии вместе с изменением относительно предыдущей завершенной сессии"""
+        values = {}
+        for name in STATISTICS_COUNTERS:
+            if statistics.get(name) is not None:
+                values[('counter', name)] = statistics[name]
+        for category, field in STATISTICS_RANKINGS.items():
+            for name, value in (statistics.get(field) or {}).items():
+                values[(category, name)] = value
+
+        cursor.execute('''
+            SELECT category, name, value
+            FROM session_statistics
+            WHERE session_id = (
+                SELECT MAX(st.session_id)
+                FROM session_statistics st
+                JOIN analysis_sessions s ON s.id = st.session_id
+                WHERE st.session_id < %s AND s.status = 'completed'
+            )
+        ''', (session_id,))
+        previous = {(category, name): value for category, name, value in cursor.fetchall()}
+
+        execute_values(cursor, '''
+            INSERT INTO session_statistics (session_id, category, name, value, delta)
+            VALUES %s
+            ON CONFLICT DO NOTHING
+        ''', [
+            (session_id, category, name, value,
+             value - previous[(category, name)] if (category, name) in previous else None)
+            for (category, name), value in values.items()
+        ])
+
+    def _load_session_events(self, session_id: int) -> List[Dict]:
+        """
+        Собирает изменения сессии из журналов. Для 'modified' поля препарата - новые значения,
+        для 'removed' - значения закрытой версии
+        """
+        events = [
+            {
+                'entity': 'substance_manufacturer',
+                'change_type': row.pop('change_type'),
+                'payload': row,
+            }
+            for row in self._fetch_all('''
+                SELECT change_type, substance_id, substance_name, old_manufacturers, new_manufacturers
+                FROM substance_manufacturer_changes
+                WHERE session_id = %s
+                ORDER BY id
+            ''', (session_id,))
+        ]
+        events += [
+            {
+                'entity': 'substance_consumer',
+                'change_type': row.pop('change_type'),
+                'payload': row,
+            }
+            for row in self._fetch_all('''
+                SELECT change_type, substance_id, substance_name, preparation_trade_name, preparation_inn_name,
+                       preparation_manufacturer, preparation_country, registration_number,
+                       registration_date, release_forms, changed_fields
+                FROM substance_consumer_changes
+                WHERE session_id = %s
+                ORDER BY id
+            ''', (session_id,))
+        ]
+        return events
+
+    def _publish_changes(self, session_id: int):
+        """
+        Публикует изменения сессии в ленту Redis; ошибка ленты не отменяет запись в БД.
+        Сначала дописываются завершенные сессии, публикация которых раньше не удалась:
+        после публикации более поздней сессии их уже нельзя добавить в поток
+        """
+        if os.getenv('CHANGE_FEED_ENABLED', '1') != '1':
+            return
+        try:
+            if self.change_feed is None:
+                from app.database.change_feed import ChangeFeed
+                self.change_feed = ChangeFeed()
+
+            last_completed = self.change_feed.last_completed_session()
+            pending = []
+            if last_completed is not None:
+                pending = [row['id'] for row in self._fetch_all('''
+                    SELECT id FROM analysis_sessions
+                    WHERE status = 'completed' AND id > %s AND id < %s
+                    ORDER BY id
+                ''', (last_completed, session_id))]
+            if pending:
+                logger.warning(f"Дописываем в ленту изменения неопубликованных сессий: {pending}")
+
+            for pending_id in pending + [session_id]:
+                self.change_feed.publish_session(pending_id, self._load_session_events(pending_id))
+        except Exception as e:
+            logger.error(f"Не удалось опубликовать изменения сессии {session_id}: {e}")
+
+    def _publish_latest_session(self, session_id: int):
+        """Отмечает сессию последней записанной, это сбрасывает кеш запросов к реестру"""
+        if os.getenv('LATEST_SESSION_PUBLISH_ENABLED', '1') != '1':
+            return
+        try:
+            from app.services.query_service import publish_latest_session
+            publish_latest_session(session_id)
+        except ValueError:
+            logger.debug("Redis не настроен, кеш запросов не сбрасывается")
+        except Exception as e:
+            logger.error(f"Не удалось отметить сессию {session_id} последней: {e}")
+
     def _process_single_manufacturer(self, cursor, session_id: int, substance_data: Dict) -> int:
         """Обрабатывает ОДНОГО производителя"""
         current_timestamp = datetime.now()
         substance_name = substance_data['substance_name']
+        substance_id = substance_data['substance_id']
         current_manufacturers_list = substance_data['manufacturers']
 
-        # Ищем существующую запись
+        # Ищем существующую запись по канонической субстанции (или старую запись без id)
         cursor.execute('''
-            SELECT id, manufacturers, version 
+            SELECT id, manufacturers, version, substance_id
             FROM substance_manufacturers 
-            WHERE substance_name = %s AND is_current = TRUE
-        ''', (substance_name,))
+            WHERE is_current = TRUE
+            AND (substance_id = %s OR (substance_id IS NULL AND substance_name = %s))
+            ORDER BY substance_id NULLS LAST
+            LIMIT 1
+        ''', (substance_id, substance_name))
 
         existing_record = cursor.fetchone()
 
         if existing_record:
-            existing_id, existing_manufacturers, existing_version = existing_record
+            existing_id, existing_manufacturers, existing_version, existing_substance_id = existing_record
+            if existing_substance_id is None:
+                self._adopt_legacy_row(cursor, 'substance_manufacturers', existing_id, substance_id)
 
             # Сравниваем производителей
             if set(existing_manufacturers) != set(current_manufacturers_list):
@@ -155,30 +716,34 @@ class PostgresHandler:
                 # Помечаем старую версию как неактуальную
                 cursor.execute('''
                     UPDATE substance_manufacturers 
-                    SET is_current = FALSE 
+                    SET is_current = FALSE, valid_to_session = %s
                     WHERE id = %s
-                ''', (existing_id,))
+                ''', (session_id, existing_id))
 
                 # Создаем новую версию
                 cursor.execute('''
                     INSERT INTO substance_manufacturers 
-                    (substance_name, manufacturers, first_seen_date, last_seen_date, version)
-                    VALUES (%s, %s, %s, %s, %s)
+                    (substance_name, substance_id, manufacturers, first_seen_date, last_seen_date, version,
+                     valid_from_session)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
                 ''', (
                     substance_name,
+                    substance_id,
                     json.dumps(current_manufacturers_list, ensure_ascii=False),
                     current_timestamp,
                     current_timestamp,
-                    existing_version + 1
+                    existing_version + 1,
+                    session_id
                 ))
 
                 # Записываем изменение в журнал
                 cursor.execute('''
                     INSERT INTO substance_manufacturer_changes 
-                    (substance_name, old_manufacturers, new_manufacturers, change_type, session_id)
-                    VALUES (%s, %s, %s, %s, %s)
+                    (substance_name, substance_id, old_manufacturers, new_manufacturers, change_type, session_id)
+                    VALUES (%s, %s, %s, %s, %s, %s)
                 ''', (
                     substance_name,
+                    substance_id,
                     json.dumps(existing_manufacturers, ensure_ascii=False),
                     json.dumps(current_manufacturers_list, ensure_ascii=False),
                     'modified',
@@ -186,65 +751,68 @@ class PostgresHandler:
                 ))
                 return 1
             else:
-                # Производители не изменились - обновляем last_seen_date
-                cursor.execute('''
-                    UPDATE substance_manufacturers 
-                    SET last_seen_date = %s 
-                    WHERE id = %s
-                ''', (current_timestamp, existing_id))
+                # Производители не изменились - строку не трогаем, она видна через valid_to_session IS NULL
                 return 0
         else:
             # Новая субстанция
             cursor.execute('''
                 INSERT INTO substance_manufacturers 
-                (substance_name, manufacturers, first_seen_date, last_seen_date)
-                VALUES (%s, %s, %s, %s)
+                (substance_name, substance_id, manufacturers, first_seen_date, last_seen_date, valid_from_session)
+                VALUES (%s, %s, %s, %s, %s, %s)
             ''', (
                 substance_name,
+                substance_id,
                 json.dumps(current_manufacturers_list, ensure_ascii=False),
                 current_timestamp,
-                current_timestamp
+                current_timestamp,
+                session_id
             ))
 
             # Записываем в журнал
             cursor.execute('''
                 INSERT INTO substance_manufacturer_changes 
-                (substance_name, new_manufacturers, change_type, session_id)
-                VALUES (%s, %s, %s, %s)
+                (substance_name, substance_id, new_manufacturers, change_type, session_id)
+                VALUES (%s, %s, %s, %s, %s)
             ''', (
                 substance_name,
+                substance_id,
                 json.dumps(current_manufacturers_list, ensure_ascii=False),
                 'added',
                 session_id
             ))
             return 1
 
+    @staticmethod
+    def _adopt_legacy_row(cursor, table: str, row_id: int, substance_id: int):
+        """Строки, записанные до словаря субстанций, получают id субстанции при первой встрече"""
+        cursor.execute(f'UPDATE {table} SET substance_id = %s WHERE id = %s', (substance_id, row_id))
+
     def _process_single_consumer(self, cursor, session_id: int, consumer: Dict) -> int:
         """Обрабатывает ОДИН препарат"""
         current_timestamp = datetime.now()
 
         # Формируем уникальный ключ для препарата
-        unique_key = (
-            consumer['substance_name'],
-            consumer['preparation_trade_name'],
-            consumer['preparation_manufacturer'],
-            consumer['registration_number']
-        )
+        unique_key = self._consumer_key(consumer)
 
-        # Ищем существующую запись
+        # Ищем существующую запись по канонической субстанции (или старую запись без id)
         cursor.execute('''
             SELECT id, preparation_inn_name, preparation_country, 
-                   registration_date, release_forms, version, first_seen_date
+                   registration_date, release_forms, version, first_seen_date, substance_id
             FROM substance_consumers 
-            WHERE substance_name = %s AND preparation_trade_name = %s 
-            AND preparation_manufacturer = %s AND registration_number = %s
+            WHERE preparation_trade_name = %s AND preparation_manufacturer = %s AND registration_number = %s
             AND is_current = TRUE
-        ''', unique_key)
+            AND (substance_id = %s OR (substance_id IS NULL AND substance_name = %s))
+            ORDER BY substance_id NULLS LAST
+            LIMIT 1
+        ''', unique_key[1:] + (unique_key[0], consumer['substance_name']))
 
         existing_record = cursor.fetchone()
 
         if existing_record:
-            existing_id, existing_inn, existing_country, existing_date, existing_forms, existing_version, existing_first_seen = existing_record
+            existing_id, existing_inn, existing_country, existing_date, existing_forms, existing_version, \
+                existing_first_seen, existing_substance_id = existing_record
+            if existing_substance_id is None:
+                self._adopt_legacy_row(cursor, 'substance_consumers', existing_id, consumer['substance_id'])
 
             # Проверяем изменения
             changed_fields = []
@@ -263,19 +831,21 @@ class PostgresHandler:
                 # Помечаем старую версию как неактуальную
                 cursor.execute('''
                     UPDATE substance_consumers 
-                    SET is_current = FALSE 
+                    SET is_current = FALSE, valid_to_session = %s
                     WHERE id = %s
-                ''', (existing_id,))
+                ''', (session_id, existing_id))
 
                 # Создаем новую версию
                 cursor.execute('''
                     INSERT INTO substance_consumers 
-                    (substance_name, preparation_trade_name, preparation_inn_name,
+                    (substance_name, substance_id, preparation_trade_name, preparation_inn_name,
                      preparation_manufacturer, preparation_country, registration_number,
-                     registration_date, release_forms, first_seen_date, last_seen_date, version)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                     registration_date, release_forms, first_seen_date, last_seen_date, version,
+                     valid_from_session)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 ''', (
                     consumer['substance_name'],
+                    consumer['substance_id'],
                     consumer['preparation_trade_name'],
                     consumer['preparation_inn_name'],
                     consumer['preparation_manufacturer'],
@@ -285,23 +855,27 @@ class PostgresHandler:
                     consumer['release_forms'],
                     existing_first_seen,
                     current_timestamp,
-                    existing_version + 1
+                    existing_version + 1,
+                    session_id
                 ))
 
                 # Записываем изменение в журнал
                 cursor.execute('''
                     INSERT INTO substance_consumer_changes 
-                    (substance_name, preparation_trade_name, preparation_inn_name,
+                    (substance_name, substance_id, preparation_trade_name, preparation_inn_name,
                      preparation_manufacturer, preparation_country, registration_number,
-                     change_type, changed_fields, session_id)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                     registration_date, release_forms, change_type, changed_fields, session_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 ''', (
                     consumer['substance_name'],
+                    consumer['substance_id'],
                     consumer['preparation_trade_name'],
                     consumer['preparation_inn_name'],
                     consumer['preparation_manufacturer'],
                     consumer['preparation_country'],
                     consumer['registration_number'],
+                    consumer['registration_date'],
+                    consumer['release_forms'],
                     'modified',
                     json.dumps(changed_fields, ensure_ascii=False),
                     session_id
@@ -309,25 +883,22 @@ class PostgresHandler:
 
                 return 1
             else:
-                # Нет изменений - просто обновляем last_seen_date
-                cursor.execute('''
-                    UPDATE substance_consumers 
-                    SET last_seen_date = %s 
-                    WHERE id = %s
-                ''', (current_timestamp, existing_id))
+                # Нет изменений - строку не трогаем, она видна через valid_to_session IS NULL
                 return 0
 
         else:
             # Новый препарат - пробуем вставить
+            cursor.execute('SAVEPOINT consumer_insert')
             try:
                 cursor.execute('''
                     INSERT INTO substance_consumers 
-                    (substance_name, preparation_trade_name, preparation_inn_name,
+                    (substance_name, substance_id, preparation_trade_name, preparation_inn_name,
                      preparation_manufacturer, preparation_country, registration_number,
-                     registration_date, release_forms, first_seen_date, last_seen_date)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                     registration_date, release_forms, first_seen_date, last_seen_date, valid_from_session)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 ''', (
                     consumer['substance_name'],
+                    consumer['substance_id'],
                     consumer['preparation_trade_name'],
                     consumer['preparation_inn_name'],
                     consumer['preparation_manufacturer'],
@@ -336,109 +907,333 @@ class PostgresHandler:
                     consumer['registration_date'],
                     consumer['release_forms'],
                     current_timestamp,
-                    current_timestamp
+                    current_timestamp,
+                    session_id
                 ))
 
                 # Записываем в журнал
                 cursor.execute('''
                     INSERT INTO substance_consumer_changes 
-                    (substance_name, preparation_trade_name, preparation_inn_name,
+                    (substance_name, substance_id, preparation_trade_name, preparation_inn_name,
                      preparation_manufacturer, preparation_country, registration_number,
-                     change_type, session_id)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                     registration_date, release_forms, change_type, session_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 ''', (
                     consumer['substance_name'],
+                    consumer['substance_id'],
                     consumer['preparation_trade_name'],
                     consumer['preparation_inn_name'],
                     consumer['preparation_manufacturer'],
                     consumer['preparation_country'],
                     consumer['registration_number'],
+                    consumer['registration_date'],
+                    consumer['release_forms'],
                     'added',
                     session_id
                 ))
 
+                cursor.execute('RELEASE SAVEPOINT consumer_insert')
                 return 1
 
             except IntegrityError:
                 # Если возникла ошибка уникальности - значит запись уже существует
-                # Обновляем last_seen_date у существующей записи
-                cursor.execute('''
-                    UPDATE substance_consumers 
-                    SET last_seen_date = %s, is_current = TRUE
-                    WHERE substance_name = %s AND preparation_trade_name = %s 
-                    AND preparation_manufacturer = %s AND registration_number = %s
-                    AND is_current = TRUE
-                ''', (
-                    current_timestamp,
-                    consumer['substance_name'],
-                    consumer['preparation_trade_name'],
-                    consumer['preparation_manufacturer'],
-                    consumer['registration_number']
-                ))
-                logger.debug(
-                    f"Обновлена last_seen_date для существующего препарата: {consumer['preparation_trade_name']}")
+                # Откатываем неудачную вставку, актуальная запись уже есть
+                cursor.execute('ROLLBACK TO SAVEPOINT consumer_insert')
+                logger.debug(f"Препарат уже записан: {consumer['preparation_trade_name']}")
                 return 0
 
-    def cleanup_old_files(self, days_to_keep: int = 30):
-        """Очищает только старые файлы, по умолчанию 30"""
+    def _fetch_all(self, query: str, params: tuple) -> List[Dict]:
+        """Выполняет запрос на чтение и возвращает строки как словари"""
+        conn = self._get_connection()
         try:
-            # Очищаем файлы в директории extracted
-            extracted_dir = "./app/parsers/data/extracted"
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute(query, params)
+                return [dict(row) for row in cursor.fetchall()]
+        finally:
+            conn.close()
 
-            if os.path.exists(extracted_dir):
-                cutoff_date = datetime.now() - timedelta(days=days_to_keep)
-                deleted_count = 0
+    def get_latest_session_id(self) -> Optional[int]:
+        """Возвращает id последней завершенной сессии анализа"""
+        rows = self._fetch_all("SELECT MAX(id) AS id FROM analysis_sessions WHERE status = 'completed'", ())
+        return rows[0]['id']
 
-                for filename in os.listdir(extracted_dir):
-                    if filename.lower().endswith(('.xlsx', '.xls')):
-                        filepath = os.path.join(extracted_dir, filename)
-                        file_mtime = datetime.fromtimestamp(os.path.getmtime(filepath))
+    def get_current_consumers(self, substance_name: str) -> List[Dict]:
+        """Возвращает актуальные препараты, содержащие субстанцию"""
+        return self._fetch_all(f'''
+            SELECT {CONSUMER_SNAPSHOT_COLUMNS}
+            FROM substance_consumers
+            WHERE substance_name = %s AND is_current = TRUE
+            ORDER BY preparation_trade_name
+        ''', (substance_name,))
 
-                        if file_mtime < cutoff_date:
-                            os.remove(filepath)
-                            logger.info(f"Удален старый файл: {filename}")
-                            deleted_count += 1
+    def get_current_manufacturers(self, substance_name: str) -> List[str]:
+        """Возвращает актуальных производителей субстанции"""
+        rows = self._fetch_all('''
+            SELECT manufacturers
+            FROM substance_manufacturers
+            WHERE substance_name = %s AND is_current = TRUE
+        ''', (substance_name,))
+        return rows[0]['manufacturers'] if rows else []
+
+    def get_registrations_between(self, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                                  limit: Optional[int] = None) -> List[Dict]:
+        """Возвращает актуальные препараты с датой регистрации в [date_from, date_to], границы необязательны"""
+        return self._fetch_all(f'''
+            SELECT {CONSUMER_SNAPSHOT_COLUMNS}
+            FROM substance_consumers
+            WHERE is_current = TRUE
+            AND registration_date >= COALESCE(%s, '-infinity'::DATE)
+            AND registration_date <= COALESCE(%s, 'infinity'::DATE)
+            ORDER BY registration_date, preparation_trade_name
+            LIMIT %s
+        ''', (date_from, date_to, limit))
+
+    def resolve_session_id(self, as_of: datetime) -> Optional[int]:
+        """Возвращает последнюю завершенную сессию анализа на момент as_of"""
+        rows = self._fetch_all('''
+            SELECT id FROM analysis_sessions
+            WHERE timestamp <= %s AND status = 'completed'
+            ORDER BY timestamp DESC, id DESC
+            LIMIT 1
+        ''', (as_of,))
+        return rows[0]['id'] if rows else None
+
+    def _as_of_session(self, session_id: Optional[int], as_of: Optional[datetime]) -> Optional[int]:
+        if session_id is not None:
+            return session_id
+        if as_of is not None:
+            return self.resolve_session_id(as_of)
+        raise ValueError("Нужно указать session_id или as_of")
+
+    def get_substance_manufacturers_as_of(self, substance_name: str, session_id: Optional[int] = None,
+                                          as_of: Optional[datetime] = None) -> Optional[Dict]:
+        """Возвращает версию производителей субстанции, действовавшую в сессии session_id или на дату as_of"""
+        session_id = self._as_of_session(session_id, as_of)
+        if session_id is None:
+            return None
+
+        rows = self._fetch_all('''
+            SELECT substance_name, manufacturers, version, valid_from_session, valid_to_session
+            FROM substance_manufacturers
+            WHERE substance_name = %s
+            AND valid_from_session <= %s
+            AND (valid_to_session IS NULL OR valid_to_session > %s)
+        ''', (substance_name, session_id, session_id))
+        return rows[0] if rows else None
+
+    def get_substance_consumers_as_of(self, substance_name: str, session_id: Optional[int] = None,
+                                      as_of: Optional[datetime] = None) -> List[Dict]:
+        """Возвращает препараты с субстанцией в том виде, в каком они были в сессии session_id или на дату as_of"""
+        session_id = self._as_of_session(session_id, as_of)
+        if session_id is None:
+            return []
+
+        return self._fetch_all(f'''
+            SELECT {CONSUMER_SNAPSHOT_COLUMNS}
+            FROM substance_consumers
+            WHERE substance_name = %s
+            AND valid_from_session <= %s
+            AND (valid_to_session IS NULL OR valid_to_session > %s)
+            ORDER BY preparation_trade_name
+        ''', (substance_name, session_id, session_id))
+
+    def get_preparation_as_of(self, preparation_trade_name: str, session_id: Optional[int] = None,
+                              as_of: Optional[datetime] = None) -> List[Dict]:
+        """Возвращает записи препарата (по всем субстанциям) в сессии session_id или на дату as_of"""
+        session_id = self._as_of_session(session_id, as_of)
+        if session_id is None:
+            return []
+
+        return self._fetch_all(f'''
+            SELECT {CONSUMER_SNAPSHOT_COLUMNS}
+            FROM substance_consumers
+            WHERE preparation_trade_name = %s
+            AND valid_from_session <= %s
+            AND (valid_to_session IS NULL OR valid_to_session > %s)
+            ORDER BY substance_name
+        ''', (preparation_trade_name, session_id, session_id))
+
+    def get_session_statistics(self, session_id: int) -> Dict[str, Dict[str, Dict]]:
+        """Возвращает статистику сессии по категориям: {category: {name: {'value', 'delta'}}}"""
+        rows = self._fetch_all('''
+            SELECT category, name, value, delta
+            FROM session_statistics
+            WHERE session_id = %s
+            ORDER BY category, value DESC
+        ''', (session_id,))
+
+        result: Dict[str, Dict[str, Dict]] = {}
+        for row in rows:
+            result.setdefault(row['category'], {})[row['name']] = {'value': row['value'], 'delta': row['delta']}
+        return result
+
+    def get_statistics_trend(self, category: str, name: str, last_sessions: int = 100) -> List[Dict]:
+        """Возвращает значения показателя по последним завершенным сессиям, от старых к новым"""
+        rows = self._fetch_all('''
+            SELECT st.session_id, s.timestamp, st.value, st.delta
+            FROM session_statistics st
+            JOIN analysis_sessions s ON s.id = st.session_id
+            WHERE st.category = %s AND st.name = %s AND s.status = 'completed'
+            ORDER BY st.session_id DESC
+            LIMIT %s
+        ''', (category, name, last_sessions))
+        return rows[::-1]
+
+    def export_current_snapshot(self, output_dir: str = "./app/parsers/data/exports",
+                                formats: Sequence[str] = ('csv', 'parquet'),
+                                row_group_size: int = 100_000) -> Dict:
+        """
+        Выгружает актуальный срез реестра через COPY ... TO STDOUT в сжатый CSV и Parquet.
+        Выгрузка делается один раз на сессию анализа: если манифест для последней сессии
+        уже есть, возвращается он
+        """
+        conn = self._get_connection()
+        try:
+            # все таблицы выгружаются из одного снимка данных
+            conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+            cursor = conn.cursor()
 
-                logger.info(f"Очистка завершена: удалено {deleted_count} старых файлов")
+            cursor.execute("SELECT MAX(id) FROM analysis_sessions WHERE status = 'completed'")
+            session_id = cursor.fetchone()[0]
+            if session_id is None:
+                raise ValueError("В БД нет ни одной завершенной сессии анализа")
+
+            export_dir = os.path.join(output_dir, f"session_{session_id}")
+            manifest_path = os.path.join(export_dir, 'manifest.json')
+            if os.path.exists(manifest_path):
+                logger.info(f"Выгрузка для сессии {session_id} уже есть: {manifest_path}")
+                with open(manifest_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+
+            os.makedirs(export_dir, exist_ok=True)
+            manifest = {
+                'session_id': session_id,
+                'created_at': datetime.now().isoformat(),
+                'tables': {},
+            }
+
+            for table, query in EXPORT_QUERIES.items():
+                csv_path = os.path.join(export_dir, f"{table}.csv.gz")
+                with gzip.open(csv_path, 'wb', compresslevel=6) as f:
+                    cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", f)
+
+                files = {'csv': self._describe_export_file(csv_path)}
+                if 'parquet' in formats:
+                    parquet_path = os.path.join(export_dir, f"{table}.parquet")
+                    self._csv_to_parquet(csv_path, parquet_path, row_group_size)
+                    files['parquet'] = self._describe_export_file(parquet_path)
+                if 'csv' not in formats:
+                    os.remove(csv_path)
+                    del files['csv']
+
+                manifest['tables'][table] = {'rows': cursor.rowcount, 'files': files}
+                logger.info(f"Выгружено {table}: {cursor.rowcount} строк")
 
-            # Также очищаем старые ZIP архивы
-            self._cleanup_old_archives(days_to_keep)
+            conn.commit()
 
-        except Exception as e:
-            logger.error(f"Ошибка при очистке старых файлов: {e}")
+            # манифест пишется последним - его наличие означает завершенную выгрузку
+            tmp_path = f"{manifest_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, manifest_path)
+
+            logger.info(f"Срез реестра выгружен (сессия - {session_id}): {export_dir}")
+            return manifest
+
+        finally:
+            conn.close()
 
+    def build_adjacency_index(self, index_dir: Optional[str] = None, fetch_size: int = 10_000) -> Dict:
+        """
+        Строит файл индекса связей "субстанция <-> препарат" из актуальных строк substance_consumers
+        последней завершенной сессии и делает его текущим. Если индекс для сессии уже есть, он не перестраивается
+        """
+        from app.storage import adjacency_index
 
-    def _cleanup_old_archives(self, days_to_keep: int = 30):
-        """Очищает старые ZIP архивы в директории загрузок"""
+        index_dir = index_dir or adjacency_index.DEFAULT_INDEX_DIR
+        conn = self._get_connection()
         try:
-            download_dir = "./app/parsers/data"
+            conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+            cursor = conn.cursor()
+            cursor.execute("SELECT MAX(id) FROM analysis_sessions WHERE status = 'completed'")
+            session_id = cursor.fetchone()[0]
+            if session_id is None:
+                raise ValueError("В БД нет ни одной завершенной сессии анализа")
+
+            path = adjacency_index.index_path(session_id, index_dir)
+            if not os.path.exists(path):
+                writer = adjacency_index.AdjacencyIndexWriter()
+                # именованный курсор - строки читаются с сервера порциями, а не целиком
+                with conn.cursor(name='adjacency_index') as rows:
+                    rows.itersize = fetch_size
+                    rows.execute('''
+                        SELECT substance_name, preparation_trade_name
+                        FROM substance_consumers
+                        WHERE is_current = TRUE AND preparation_trade_name IS NOT NULL
+                    ''')
+                    for substance_name, preparation_trade_name in rows:
+                        writer.add(substance_name, preparation_trade_name)
+                writer.write(path, session_id)
+            conn.commit()
 
-            if not os.path.exists(download_dir):
-                return
+            adjacency_index.set_current(path)
+            return {'session_id': session_id, 'path': path, 'size': os.path.getsize(path)}
 
-            cutoff_date = datetime.now() - timedelta(days=days_to_keep)
+        finally:
+            conn.close()
 
-            for filename in os.listdir(download_dir):
-                if filename.startswith('grls_archive_') and filename.endswith('.zip'):
-                    filepath = os.path.join(download_dir, filename)
-                    file_mtime = datetime.fromtimestamp(os.path.getmtime(filepath))
+    @staticmethod
+    def _csv_to_parquet(csv_path: str, parquet_path: str, row_group_size: int):
+        """Перекладывает сжатый CSV в Parquet группами строк, не загружая файл в память целиком"""
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+        import pyarrow.parquet as pq
 
-                    if file_mtime < cutoff_date:
-                        os.remove(filepath)
-                        logger.info(f"Удален старый архив: {filename}")
+        with gzip.open(csv_path, 'rt', encoding='utf-8') as f:
+            header = f.readline().rstrip('\n').split(',')
+
+        # все колонки читаем строками, иначе тип может разойтись между блоками
+        reader = pa_csv.open_csv(
+            pa.input_stream(csv_path, compression='gzip'),
+            convert_options=pa_csv.ConvertOptions(column_types={name: pa.string() for name in header}),
+        )
+
+        writer = pq.ParquetWriter(parquet_path, reader.schema, compression='zstd')
+        try:
+            pending, pending_rows = [], 0
+            for batch in reader:
+                pending.append(batch)
+                pending_rows += batch.num_rows
+                if pending_rows >= row_group_size:
+                    writer.write_table(pa.Table.from_batches(pending, reader.schema), row_group_size=row_group_size)
+                    pending, pending_rows = [], 0
+            if pending:
+                writer.write_table(pa.Table.from_batches(pending, reader.schema), row_group_size=row_group_size)
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _describe_export_file(path: str) -> Dict:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return {'path': path, 'bytes': os.path.getsize(path), 'sha256': digest.hexdigest()}
 
-        except Exception as e:
-            logger.error(f"Ошибка при очистке архивов: {e}")
 
+def test_postgres(profile=False):
+    """Тест PostgreSQL соединения; profile=True - снять профиль CPU и памяти"""
+    from app.profiling import profile_run
 
-def test_postgres():
-    """Тест PostgreSQL соединения"""
     handler = PostgresHandler()
 
-    if handler.test_connection():
-        print("PostgreSQL connection successful")
-        print("Test passed!")
+    with profile_run(profile, 'postgres_test') as capture:
+        if handler.test_connection():
+            print("PostgreSQL connection successful")
+            print("Test passed!")
+    if capture is not None:
+        print(f"Profile saved to {capture.output_dir}")
 
 
 if __name__ == "__main__":
-    test_postgres()
\ No newline at end of file
+    test_postgres(profile='--profile' in sys.argv)
\ No newline at end of file
@@ -1,3 +1,4 @@
+import sys
 import os
 import requests
 import zipfile
@@ -6,15 +7,19 @@ from config.logging import get_logger
 from urllib.parse import urljoin
 import re
 import shutil
+import tempfile
 from bs4 import BeautifulSoup
 
+from app.storage.artifact_store import ArtifactStore
+
 logger = get_logger(__name__)
 
 
 class ArchiveParser:
-    def __init__(self, base_url="https://grls.minzdrav.gov.ru", download_dir="./app/parsers/data"):
+    def __init__(self, base_url="https://grls.minzdrav.gov.ru", download_dir="./app/parsers/data", store=None):
         self.base_url = base_url
         self.download_dir = download_dir
+        self.store = store or ArtifactStore(os.path.join(download_dir, "store"))
         self.session = requests.Session()
 
         # настройка сессии
@@ -43,27 +48,29 @@ class ArchiveParser:
 
             logger.info(f"Найдена ссылка на архив: {archive_url}")
 
-            # 2. Скачиваем архив
+            # 2. Скачиваем архив и кладем в хранилище, одинаковые архивы хранятся один раз
             zip_path = self._download_file(archive_url)
-            extracted_files = self._extract_archive(zip_path)
-            excel_files = self._find_excel_files(extracted_files)
-            operating_file = self._find_operating_file(excel_files)
+            archive = self.store.put(zip_path, kind='archive')
 
-            # удаляем все ненужные файлы
-            if operating_file:
-                operating_file = self._cleanup_files(operating_file, extracted_files)
+            # 3. Достаем 'Действующий' файл - из хранилища, если этот архив уже разбирали
+            workbook = self._get_operating_workbook(archive)
+            operating_file = workbook['path'] if workbook else None
+
+            self.store.enforce_budget(keep=[archive['sha256']] + ([workbook['sha256']] if workbook else []))
 
             result = {
                 'status': 'success',
                 'timestamp': datetime.now().isoformat(),
                 'archive_url': archive_url,
-                'zip_path': zip_path,
+                'zip_path': archive['path'],
+                'archive_sha256': archive['sha256'],
                 'operating_file': operating_file,
-                'message': 'Архив скачан и очищен'
+                'workbook_sha256': workbook['sha256'] if workbook else None,
+                'message': 'Архив скачан и сохранен в хранилище'
             }
 
             if operating_file:
-                logger.info(f"'Действующий' файл найден: {os.path.basename(operating_file)}")
+                logger.info(f"'Действующий' файл найден: {workbook['original_name']}")
             else:
                 logger.warning("'Действующий' файл НЕ найден")
 
@@ -159,6 +166,30 @@ class ArchiveParser:
             logger.error(f"Загрузка файла не удалась: {e}")
             raise
 
+    def _get_operating_workbook(self, archive):
+        """Возвращает артефакт 'Действующего' файла для архива, распаковывая архив при необходимости"""
+        derived_sha256 = archive.get('derived', {}).get('workbook')
+        if derived_sha256:
+            workbook = self.store.get(derived_sha256)
+            if workbook:
+                logger.info("Архив уже разбирался, берем 'Действующий' файл из хранилища")
+                return workbook
+
+        extract_dir = tempfile.mkdtemp(prefix="extract_", dir=self.download_dir)
+        try:
+            extracted_files = self._extract_archive(archive['path'], extract_dir)
+            excel_files = self._find_excel_files(extracted_files)
+            operating_file = self._find_operating_file(excel_files)
+            if not operating_file:
+                return None
+
+            workbook = self.store.put(operating_file, kind='workbook')
+            self.store.set_derived(archive['sha256'], 'workbook', workbook['sha256'])
+            return workbook
+        finally:
+            # остальные файлы архива не нужны
+            shutil.rmtree(extract_dir, ignore_errors=True)
+
     def _extract_archive(self, zip_path, extract_dir=None):
         """Распаковывает ZIP архив"""
         if extract_dir is None:
@@ -215,65 +246,15 @@ class ArchiveParser:
 
         return None
 
-    def _cleanup_files(self, operating_file, all_files):
-        """Удаляет все файлы кроме действующего файла"""
-        try:
-            operating_filename = os.path.basename(operating_file)
-            operating_dir = os.path.dirname(operating_file)
-
-            logger.info(f"Очищаем файлы, оставляем только: {operating_filename}")
-
-            # удаляем все файлы кроме нужного
-            for file_path in all_files:
-                if os.path.isfile(file_path) and file_path != operating_file:
-                    os.remove(file_path)
-                    logger.info(f"Удаляем файл: {os.path.basename(file_path)}")
-
-            # удаляем пустые директории
-            for root, dirs, files in os.walk(operating_dir, topdown=False):
-                for dir_name in dirs:
-                    dir_path = os.path.join(root, dir_name)
-                    try:
-                        if not os.listdir(dir_path):
-                            os.rmdir(dir_path)
-                            logger.info(f"Удаляем пустую директорию: {dir_path}")
-                    except OSError:
-                        pass
-
-            # перемещаем действующий файл в корень extracted
-            if operating_dir != os.path.join(self.download_dir, "extracted"):
-                new_operating_path = os.path.join(self.download_dir, "extracted", operating_filename)
-                shutil.move(operating_file, new_operating_path)
-                operating_file = new_operating_path
-                logger.info(f"Перемещаем файл в {new_operating_path}")
-
-            logger.info("Очистка завершена - оставлен только файл 'Действующий'")
-            return operating_file
-
-        except Exception as e:
-            logger.error(f"Очистка не удалась - {e}")
-            return operating_file
-
     def get_latest_operating_file(self):
         """Возвращает путь к последнему действующему файлу"""
-        extracted_dir = os.path.join(self.download_dir, "extracted")
-
-        if not os.path.exists(extracted_dir):
-            return None
-
-        excel_files = []
-        for root, dirs, files in os.walk(extracted_dir):
-            for file in files:
-                if file.lower().endswith(('.xlsx', '.xls')):
-                    excel_files.append(os.path.join(root, file))
-
-        excel_files.sort(key=os.path.getmtime, reverse=True)
+        workbooks = self.store.list_artifacts(kind='workbook')
 
-        for excel_file in excel_files:
-            if self._is_operating_file(excel_file):
-                return excel_file
+        for workbook in workbooks:
+            if self._is_operating_file(workbook['original_name']):
+                return workbook['path']
 
-        return excel_files[0] if excel_files else None
+        return workbooks[0]['path'] if workbooks else None
 
     def _is_operating_file(self, file_path):
         """Проверяет, является ли файл действующим файлом"""
@@ -282,29 +263,24 @@ class ArchiveParser:
         return any(pattern in filename for pattern in patterns) or \
             re.search(r'действ', filename, re.IGNORECASE) is not None
 
-    def cleanup_old_files(self, keep_last=3):
-        """Очищает старые файлы, оставляя только последние"""
+    def cleanup_old_files(self, max_bytes=None):
+        """Очищает хранилище артефактов до бюджета по объему, удаляя давно не использованные"""
         try:
-            zip_files = [f for f in os.listdir(self.download_dir)
-                         if f.startswith('grls_archive_') and f.endswith('.zip')]
-
-            zip_files.sort(key=lambda x: os.path.getctime(os.path.join(self.download_dir, x)),
-                           reverse=True)
-
-            for old_file in zip_files[keep_last:]:
-                file_path = os.path.join(self.download_dir, old_file)
-                os.remove(file_path)
-                logger.info(f"Удаляем старый файл - {old_file}")
-
+            self.store.enforce_budget(max_bytes=max_bytes)
         except Exception as e:
             logger.error(f"Удаление не удалось -  {e}")
 
 
-def test():
-    """Простая функция для тестирования"""
+def test(profile=False):
+    """Простая функция для тестирования; profile=True - снять профиль CPU и памяти"""
+    from app.profiling import profile_run
+
     print("Тестируем ArchiveParser с парсингом главной страницы")
     parser = ArchiveParser()
-    result = parser.download_archive()
+    with profile_run(profile, 'archive_parser_test') as capture:
+        result = parser.download_archive()
+    if capture is not None:
+        print(f"Профиль - {capture.output_dir}")
     print(f"Статус - {result['status']}")
     if result['status'] == 'success':
         print(f"Файл 'Действующий' - {result['operating_file']}")
@@ -315,7 +291,7 @@ def test():
 
 
 if __name__ == "__main__":
-    test()
+    test(profile='--profile' in sys.argv)
 
 
 # def test():
@@ -1,19 +1,56 @@
 import pandas as pd
 import json
 import os
-from datetime import datetime
+from datetime import date, datetime
 from collections import Counter
-from config.logging import get_logger
-from typing import Dict, List, Any, Set
+from config.logging import get_logger, StageCounters
+from typing import Dict, List, Any, Optional, Set
+
+from app.parsers.substance_dictionary import SubstanceDictionary, EMPTY_VALUES, normalize_text
+from app.storage.artifact_store import ArtifactStore
 
 logger = get_logger(__name__)
 
+REGISTRATION_DATE_FORMATS = ('%d.%m.%Y', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%d.%m.%y')
+
+
+def parse_registration_date(value: Any) -> Optional[date]:
+    """
+    Приводит дату регистрации из Excel к date.
+    Пустые значения возвращаются как None, для неразборчивых дат и дат вне 1900-2100 - ValueError
+    """
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+
+    if isinstance(value, datetime):
+        parsed = value.date()
+    elif isinstance(value, date):
+        parsed = value
+    else:
+        text = str(value).strip()
+        if text in EMPTY_VALUES:
+            return None
+        parsed = None
+        for date_format in REGISTRATION_DATE_FORMATS:
+            try:
+                parsed = datetime.strptime(text, date_format).date()
+                break
+            except ValueError:
+                continue
+        if parsed is None:
+            raise ValueError(f"Не удалось разобрать дату регистрации: {text!r}")
+
+    if not 1900 <= parsed.year <= 2100:
+        raise ValueError(f"Дата регистрации вне допустимого диапазона: {parsed}")
+    return parsed
+
 
 class MedicalParser:
     """Анализатор Excel файлов ГРЛС для поиска связей между веществами и препаратами."""
 
-    def __init__(self) -> None:
+    def __init__(self, dictionary: Optional[SubstanceDictionary] = None) -> None:
         self.processed_files: List[str] = []
+        self.dictionary = dictionary or SubstanceDictionary.load()
 
     def analyze_substances_and_consumers(self, input_file_path: str) -> Dict[str, Any]:
         """
@@ -26,6 +63,7 @@ class MedicalParser:
             Dict с результатами анализа:
             - timestamp: Время анализа
             - source_file: Путь к исходному файлу
+            - source_sha256: SHA-256 исходного файла
             - statistics: Статистика по данным
             - substances_manufacturers: Список производителей субстанций
             - substance_consumers: Список связей препарат-субстанция
@@ -58,64 +96,70 @@ class MedicalParser:
             logger.info(f"Найдено субстанций: {len(substances_df)}")
             logger.info(f"Найдено препаратов: {len(preparations_df)}")
 
-            # 2. Создаем список уникальных МНН субстанций
-            unique_substances: Set[str] = set()
-            substance_manufacturers: Dict[str, List[str]] = {}
+            # 2. Сводим МНН и торговые названия субстанций к каноническим субстанциям
+            unique_substances: Set[int] = set()
+            substance_manufacturers: Dict[int, Set[str]] = {}
 
-            for idx, row in substances_df.iterrows():
-                inn_name = str(row[INN_NAME_COL]).strip()
-                trade_name = str(row[TRADE_NAME_COL]).strip()
-                manufacturer = str(row[MANUFACTURER_COL]).strip()
-
-                if inn_name and inn_name not in ['', 'nan', '~']:
-                    unique_substances.add(inn_name)
-                    if inn_name not in substance_manufacturers:
-                        substance_manufacturers[inn_name] = []
-                    substance_manufacturers[inn_name].append(manufacturer)
-
-                if trade_name and trade_name not in ['', 'nan', '~']:
-                    unique_substances.add(trade_name)
-                    if trade_name not in substance_manufacturers:
-                        substance_manufacturers[trade_name] = []
-                    substance_manufacturers[trade_name].append(manufacturer)
+            for inn_name, trade_name, manufacturer in zip(substances_df[INN_NAME_COL], substances_df[TRADE_NAME_COL],
+                                                          substances_df[MANUFACTURER_COL]):
+                substance_id = self.dictionary.add(str(inn_name).strip(), str(trade_name).strip())
+                if substance_id is None:
+                    continue
 
+                unique_substances.add(substance_id)
+                manufacturer = str(manufacturer).strip()
+                substance_manufacturers.setdefault(substance_id, set())
+                if manufacturer not in EMPTY_VALUES:
+                    substance_manufacturers[substance_id].add(manufacturer)
+
+            self.dictionary.save()
             logger.info(f"Уникальных субстанций для поиска: {len(unique_substances)}")
 
-            # 3. Ищем препараты, которые используют эти субстанции
-            consumers_data: List[Dict[str, str]] = []
+            # 3. Ищем препараты, которые используют эти субстанции - по всем написаниям субстанции,
+            # но одна связь на каноническую субстанцию
+            matcher = self.dictionary.matcher(unique_substances)
+            consumers_data: List[Dict[str, Any]] = []
+            date_counters = StageCounters(logger, 'registration_dates')
 
-            for substance in unique_substances:
-                if len(substance) < 2:  # Пропускаем слишком короткие названия
-                    continue
+            for row in preparations_df.itertuples(index=False):
+                inn_name = normalize_text(row[INN_NAME_COL])
+                trade_name = normalize_text(row[TRADE_NAME_COL])
 
-                substance_lower = substance.lower()
-
-                for idx, row in preparations_df.iterrows():
-                    inn_name = str(row[INN_NAME_COL]).lower()
-                    trade_name = str(row[TRADE_NAME_COL]).lower()
-
-                    # Ищем субстанцию в МНН или торговом названии препарата
-                    if (substance_lower in inn_name or substance_lower in trade_name):
-                        consumer_info = {
-                            'substance_name': substance,
-                            'preparation_trade_name': str(row[TRADE_NAME_COL]),
-                            'preparation_inn_name': str(row[INN_NAME_COL]),
-                            'preparation_manufacturer': str(row[MANUFACTURER_COL]),
-                            'preparation_country': str(row[COUNTRY_COL]),
-                            'registration_number': str(row[REG_NUMBER_COL]),
-                            'registration_date': str(row[DATE_COL]),
-                            'release_forms': str(row[FORMS_COL])
-                        }
-                        consumers_data.append(consumer_info)
+                # Ищем субстанцию в МНН или торговом названии препарата (целыми словами)
+                matched = matcher.match(inn_name, trade_name)
+
+                if not matched:
+                    continue
 
+                try:
+                    registration_date = parse_registration_date(row[DATE_COL])
+                    date_counters.incr('parsed' if registration_date else 'missing')
+                except ValueError as e:
+                    logger.warning(f"{e} (препарат {row[TRADE_NAME_COL]}, {row[REG_NUMBER_COL]})")
+                    registration_date = None
+                    date_counters.incr('malformed')
+
+                for substance_id in sorted(matched):
+                    consumers_data.append({
+                        'substance_id': substance_id,
+                        'substance_name': self.dictionary.name(substance_id),
+                        'preparation_trade_name': str(row[TRADE_NAME_COL]),
+                        'preparation_inn_name': str(row[INN_NAME_COL]),
+                        'preparation_manufacturer': str(row[MANUFACTURER_COL]),
+                        'preparation_country': str(row[COUNTRY_COL]),
+                        'registration_number': str(row[REG_NUMBER_COL]),
+                        'registration_date': registration_date,
+                        'release_forms': str(row[FORMS_COL])
+                    })
+
+            date_counters.log_summary()
             logger.info(f"Найдено связей препарат-субстанция: {len(consumers_data)}")
 
             # 4. Собираем статистику
             manufacturer_stats = Counter()
             for manufacturers in substance_manufacturers.values():
                 for manufacturer in manufacturers:
-                    if manufacturer and manufacturer not in ['', 'nan', '~']:
-                        manufacturer_stats[manufacturer] += 1
+                    manufacturer_stats[manufacturer] += 1
 
             substance_usage = Counter()
             for consumer in consumers_data:
@@ -131,6 +175,7 @@ class MedicalParser:
             result = {
                 'timestamp': datetime.now().isoformat(),
                 'source_file': input_file_path,
+                'source_sha256': ArtifactStore.file_sha256(input_file_path),
                 'statistics': {
                     'total_records': len(df),
                     'substances_found': len(substances_df),
@@ -143,10 +188,11 @@ class MedicalParser:
                 },
                 'substances_manufacturers': [
                     {
-                        'substance_name': substance,
-                        'manufacturers': manufacturers
+                        'substance_id': substance_id,
+                        'substance_name': self.dictionary.name(substance_id),
+                        'manufacturers': sorted(manufacturers)
                     }
-                    for substance, manufacturers in substance_manufacturers.items()
+                    for substance_id, manufacturers in sorted(substance_manufacturers.items())
                 ],
                 'substance_consumers': consumers_data
             }
@@ -0,0 +1,190 @@
+import os
+import re
+import json
+import fcntl
+import hashlib
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from config.logging import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_DICTIONARY_PATH = "./app/parsers/data/substance_dictionary.json"
+
+# Солевые формы и гидраты, которые не меняют действующее вещество
+SALT_FORMS = {
+    'гидрохлорид', 'дигидрохлорид', 'гидробромид', 'мезилат', 'малеат', 'тартрат', 'битартрат',
+    'сукцинат', 'фумарат', 'ацетат', 'цитрат', 'сульфат', 'гидросульфат', 'фосфат', 'бесилат',
+    'тозилат', 'лактат', 'глюконат', 'моногидрат', 'дигидрат', 'тригидрат', 'гемигидрат',
+    'безводный', 'безводная',
+    'hydrochloride', 'hydrobromide', 'mesylate', 'maleate', 'tartrate', 'succinate', 'fumarate',
+    'acetate', 'citrate', 'sulfate', 'phosphate', 'besylate', 'monohydrate', 'dihydrate', 'anhydrous',
+}
+
+# Катионы неорганических солей в родительном падеже: "магния сульфат" и "магния цитрат" -
+# разные вещества, поэтому солевая форма отбрасывается, только если без нее остается не один катион
+CATION_WORDS = {
+    'натрия', 'калия', 'магния', 'кальция', 'цинка', 'лития', 'железа', 'алюминия', 'аммония',
+    'бария', 'меди', 'серебра', 'висмута', 'стронция', 'марганца', 'кобальта', 'хрома', 'селена',
+    'sodium', 'potassium', 'magnesium', 'calcium', 'zinc', 'lithium', 'iron', 'ferrous', 'ferric',
+    'aluminium', 'aluminum', 'ammonium', 'barium', 'copper', 'silver', 'bismuth', 'strontium',
+}
+
+EMPTY_VALUES = ('', 'nan', '~')
+
+
+def normalize_text(value: str) -> str:
+    """Приводит строку к виду для сравнения: регистр, ё, пунктуация, пробелы"""
+    text = str(value).casefold().replace('ё', 'е')
+    text = re.sub(r'[^\w\s]|_', ' ', text)
+    return ' '.join(text.split())
+
+
+def normalize_substance_name(value: str) -> str:
+    """Ключ субстанции: нормализованное название без солевых форм"""
+    tokens = normalize_text(value).split()
+    core = [token for token in tokens if token not in SALT_FORMS]
+    if not core or all(token in CATION_WORDS for token in core):
+        return ' '.join(tokens)
+    return ' '.join(core)
+
+
+def _is_cation_only(key: str) -> bool:
+    tokens = key.split()
+    return bool(tokens) and all(token in CATION_WORDS for token in tokens)
+
+
+class AliasMatcher:
+    """
+    Поиск субстанций в названии препарата по целым словам: алиас совпадает, только если
+    его слова идут подряд среди слов названия. Алиасы индексируются по первому слову,
+    поэтому на каждое слово названия проверяются только алиасы, начинающиеся с него
+    """
+
+    def __init__(self, aliases: Dict[str, int], min_length: int = 2):
+        self.by_first_token: Dict[str, List[Tuple[Tuple[str, ...], int]]] = {}
+        for alias, substance_id in aliases.items():
+            tokens = tuple(alias.split())
+            if len(alias) < min_length or not tokens:
+                continue
+            self.by_first_token.setdefault(tokens[0], []).append((tokens, substance_id))
+
+    def match(self, *texts: str) -> Set[int]:
+        """id субстанций, алиасы которых встречаются в любом из нормализованных текстов"""
+        matched = set()
+        for text in texts:
+            tokens = text.split()
+            for i, token in enumerate(tokens):
+                for alias_tokens, substance_id in self.by_first_token.get(token, ()):
+                    if tuple(tokens[i:i + len(alias_tokens)]) == alias_tokens:
+                        matched.add(substance_id)
+        return matched
+
+
+def substance_id_for_key(key: str) -> int:
+    """Стабильный id субстанции по ключу, одинаковый во всех процессах и прогонах"""
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:15], 16)
+
+
+class SubstanceDictionary:
+    """
+    Словарь канонических субстанций: МНН и торговые названия строк-субстанций
+    сводятся к одной канонической записи, алиасы (нормализованные написания)
+    указывают на ее id. Словарь хранится в JSON и дополняется между запусками.
+    """
+
+    def __init__(self, path: str = DEFAULT_DICTIONARY_PATH):
+        self.path = path
+        self.substances: Dict[int, Dict] = {}  # id -> {'id', 'name', 'key'}
+        self.aliases: Dict[str, int] = {}  # нормализованное написание -> id
+        self._dirty = False
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_DICTIONARY_PATH) -> 'SubstanceDictionary':
+        dictionary = cls(path)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                dictionary._merge(json.load(f))
+            logger.info(f"Словарь субстанций загружен: {len(dictionary.substances)} субстанций, "
+                        f"{len(dictionary.aliases)} алиасов")
+        return dictionary
+
+    def _merge(self, data: Dict):
+        """
+        Добавляет записи из сохраненного словаря, уже известные записи не перезаписываются.
+        Записи с ключом из одного катиона ("магния") - результат старой нормализации, которая
+        склеивала разные соли одного катиона; они отбрасываются вместе с их алиасами
+        """
+        merged_salts = {s['id'] for s in data.get('substances', []) if _is_cation_only(s['key'])}
+        for substance in data.get('substances', []):
+            if substance['id'] not in merged_salts:
+                self.substances.setdefault(substance['id'], substance)
+        for alias, substance_id in data.get('aliases', {}).items():
+            if substance_id not in merged_salts and not _is_cation_only(alias):
+                self.aliases.setdefault(alias, substance_id)
+
+    def resolve(self, name: str) -> Optional[int]:
+        """Возвращает id канонической субстанции по любому написанию"""
+        if str(name).strip() in EMPTY_VALUES:
+            return None
+        return self.aliases.get(normalize_text(name)) or self.aliases.get(normalize_substance_name(name))
+
+    def add(self, inn_name: str, trade_name: str = '') -> Optional[int]:
+        """Регистрирует строку-субстанцию и возвращает id канонической субстанции"""
+        names = [n.strip() for n in (str(inn_name), str(trade_name)) if n.strip() not in EMPTY_VALUES]
+        if not names:
+            return None
+
+        substance_id = next((self.resolve(n) for n in names if self.resolve(n)), None)
+        if substance_id is None:
+            key = normalize_substance_name(names[0])
+            substance_id = substance_id_for_key(key)
+            if substance_id not in self.substances:
+                self.substances[substance_id] = {'id': substance_id, 'name': names[0], 'key': key}
+                self._dirty = True
+
+        for name in names:
+            for alias in (normalize_text(name), normalize_substance_name(name)):
+                if alias and alias not in self.aliases:
+                    self.aliases[alias] = substance_id
+                    self._dirty = True
+
+        return substance_id
+
+    def name(self, substance_id: int) -> str:
+        return self.substances[substance_id]['name']
+
+    def aliases_for(self, substance_ids: Iterable[int]) -> Dict[str, int]:
+        """Алиасы выбранных субстанций: написание -> id"""
+        substance_ids: Set[int] = set(substance_ids)
+        return {alias: sid for alias, sid in self.aliases.items() if sid in substance_ids}
+
+    def matcher(self, substance_ids: Iterable[int]) -> AliasMatcher:
+        """Поиск выбранных субстанций в названиях препаратов по целым словам"""
+        return AliasMatcher(self.aliases_for(substance_ids))
+
+    def save(self):
+        """Сохраняет словарь, объединяя его с записями, добавленными другими процессами"""
+        if not self._dirty:
+            return
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f"{self.path}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.path):
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        self._merge(json.load(f))
+
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({
+                        'substances': sorted(self.substances.values(), key=lambda s: s['key']),
+                        'aliases': dict(sorted(self.aliases.items())),
+                    }, f, ensure_ascii=False, indent=1)
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        self._dirty = False
+        logger.info(f"Словарь субстанций сохранен: {len(self.substances)} субстанций, {len(self.aliases)} алиасов")
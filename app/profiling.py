@@ -0,0 +1,141 @@
+"""
+Профилирование одного запуска: сэмплирующий профилировщик CPU и трассировка памяти (tracemalloc).
+
+Использовать:
+    with profile_run(enabled=True, label='pipeline') as capture:
+        ...
+    capture.link_session(session_id)
+
+Если enabled=False, ничего не запускается. Результаты:
+- cpu.collapsed - стеки в формате flamegraph.pl / speedscope / inferno ("a;b;c <число сэмплов>")
+- memory_top.txt - топ строк кода по выделенной памяти
+- summary.json - длительность, число сэмплов, пик памяти
+"""
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional
+
+from app.storage.artifact_store import DEFAULT_STORE_DIR, PROFILES_SUBDIR
+from config.logging import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_PROFILE_DIR = os.path.join(DEFAULT_STORE_DIR, PROFILES_SUBDIR)
+
+
+class SamplingProfiler:
+    """Раз в interval секунд снимает стеки всех потоков процесса"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        thread_names = {}
+
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                thread_names[thread.ident] = thread.name
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write_collapsed(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class ProfileCapture:
+    """Результаты профилирования одного запуска"""
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+
+    def link_session(self, session_id: Optional[int]):
+        """Переименовывает директорию профиля по сессии и связывает ее с сессией в хранилище"""
+        if session_id is None:
+            return
+
+        from app.storage.artifact_store import ArtifactStore
+
+        session_dir = os.path.join(os.path.dirname(self.output_dir),
+                                   f"session_{session_id}_{os.path.basename(self.output_dir)}")
+        os.replace(self.output_dir, session_dir)
+        self.output_dir = session_dir
+        ArtifactStore().link_session_path(session_id, session_dir)
+
+
+@contextmanager
+def profile_run(enabled: bool, label: str, output_dir: str = DEFAULT_PROFILE_DIR,
+                interval: float = 0.005, top_n: int = 30):
+    """Профилирует блок кода, если enabled; иначе отдает None и ничего не делает"""
+    if not enabled:
+        yield None
+        return
+
+    run_dir = os.path.join(output_dir, f"{label}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    os.makedirs(run_dir, exist_ok=True)
+    capture = ProfileCapture(run_dir)
+
+    logger.info(f"Профилирование запуска {label} включено: {run_dir}")
+    tracemalloc.start(25)
+    profiler = SamplingProfiler(interval)
+    started = time.monotonic()
+    profiler.start()
+
+    try:
+        yield capture
+    finally:
+        profiler.stop()
+        duration = time.monotonic() - started
+        snapshot = tracemalloc.take_snapshot()
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        profiler.write_collapsed(os.path.join(run_dir, 'cpu.collapsed'))
+
+        with open(os.path.join(run_dir, 'memory_top.txt'), 'w', encoding='utf-8') as f:
+            f.write(f"Пик памяти: {peak_bytes / (1024 * 1024):.1f} MB, "
+                    f"на момент снимка: {current_bytes / (1024 * 1024):.1f} MB\n\n")
+            for stat in snapshot.statistics('lineno')[:top_n]:
+                f.write(f"{stat}\n")
+
+        with open(os.path.join(run_dir, 'summary.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'label': label,
+                'duration_seconds': duration,
+                'cpu_samples': profiler.samples,
+                'sample_interval_seconds': interval,
+                'peak_memory_bytes': peak_bytes,
+            }, f, ensure_ascii=False, indent=2)
+
+        logger.info(f"Профиль запуска {label} сохранен: {run_dir} ({duration:.1f} с, "
+                    f"{profiler.samples} сэмплов, пик памяти {peak_bytes / (1024 * 1024):.1f} MB)")
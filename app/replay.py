@@ -0,0 +1,196 @@
+"""
+Перепроигрывание истории: повторный разбор сохраненных архивов и Excel файлов
+и запись результатов в БД строго в хронологическом порядке.
+
+Использовать:
+    python -m app.replay <sha256 или путь> [...] --database-url postgresql://.../grls_replay --workers 4
+    python -m app.replay --all-archives --live  # запись в боевую БД из DATABASE_URL
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from config.logging import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_STATE_DIR = "./app/parsers/data/replay"
+
+
+def _parse_source(source: Dict) -> Dict:
+    """Разбирает один архив или Excel файл, выполняется в отдельном процессе"""
+    from app.parsers.archive_parser import ArchiveParser
+    from app.parsers.medical_parser import MedicalParser
+
+    started = time.monotonic()
+    workbook_path = source['path']
+    extract_dir = None
+
+    try:
+        if source['path'].lower().endswith('.zip'):
+            archive_parser = ArchiveParser()
+            extract_dir = tempfile.mkdtemp(prefix="replay_", dir=archive_parser.download_dir)
+            extracted_files = archive_parser._extract_archive(source['path'], extract_dir)
+            workbook_path = archive_parser._find_operating_file(archive_parser._find_excel_files(extracted_files))
+            if not workbook_path:
+                raise ValueError(f"В архиве {source['id']} нет 'Действующего' файла")
+
+        analysis_result = MedicalParser().analyze_substances_and_consumers(workbook_path)
+        # сессия получает время исходного файла, а не время перепроигрывания
+        analysis_result['timestamp'] = source['timestamp']
+        analysis_result['source_file'] = source['path']
+        analysis_result['parse_seconds'] = time.monotonic() - started
+        return analysis_result
+
+    finally:
+        if extract_dir:
+            shutil.rmtree(extract_dir, ignore_errors=True)
+
+
+class HistoryReplay:
+    """
+    Параллельно разбирает набор архивов/Excel файлов в пуле процессов и применяет
+    версионирование в БД по одному, в порядке времени файлов. Состояние хранится
+    по целевой БД: последний примененный источник. Повторный запуск, в том числе
+    с добавленными архивами, применяет только источники новее него
+    """
+
+    def __init__(self, sources: List[str], database_url: str, workers: Optional[int] = None,
+                 state_dir: str = DEFAULT_STATE_DIR, db_handler=None, store=None):
+        from app.database.postgres_handler import PostgresHandler
+        from app.storage.artifact_store import ArtifactStore
+
+        if not database_url:
+            raise ValueError("Не указана целевая БД для перепроигрывания")
+
+        self.store = store or ArtifactStore()
+        self.db_handler = db_handler or PostgresHandler(database_url)
+        self.workers = workers or os.cpu_count() or 1
+        self.sources = self._resolve_sources(sources)
+
+        # пароль в имя файла не попадает - только хеш адреса БД
+        replay_id = hashlib.sha1(database_url.encode()).hexdigest()[:16]
+        os.makedirs(state_dir, exist_ok=True)
+        self.state_path = os.path.join(state_dir, f"replay_{replay_id}.json")
+
+    def _resolve_sources(self, sources: List[str]) -> List[Dict]:
+        """Превращает SHA-256 артефактов и пути к файлам в список, упорядоченный по времени"""
+        resolved = []
+        for source in sources:
+            artifact = self.store.get(source)
+            if artifact:
+                resolved.append({'id': source, 'path': artifact['path'], 'timestamp': artifact['created_at']})
+            elif os.path.isfile(source):
+                timestamp = datetime.fromtimestamp(os.path.getmtime(source)).isoformat()
+                resolved.append({'id': os.path.abspath(source), 'path': source, 'timestamp': timestamp})
+            else:
+                raise ValueError(f"Источник не найден ни в хранилище, ни на диске: {source}")
+
+        return sorted(resolved, key=lambda s: (s['timestamp'], s['id']))
+
+    def _load_state(self) -> Dict:
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return {'applied': [], 'last_applied': None}
+
+    def _save_state(self, state: Dict):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def run(self) -> Dict:
+        """Перепроигрывает еще не примененные источники и возвращает отчет о пропускной способности"""
+        state = self._load_state()
+        last_applied = state.get('last_applied')
+        pending = self.sources
+        if last_applied:
+            # версионирование идет строго по времени: источники не новее примененного уже не применить
+            position = (last_applied['timestamp'], last_applied['source'])
+            pending = [s for s in self.sources if (s['timestamp'], s['id']) > position]
+            skipped = len(self.sources) - len(pending)
+            logger.info(f"Продолжаем перепроигрывание после {last_applied['source']} "
+                        f"(сессия {last_applied['session_id']}): пропущено {skipped}, осталось {len(pending)}")
+
+        started = time.monotonic()
+        report = {'sources': len(pending), 'rows': 0, 'parse_seconds': 0.0, 'apply_seconds': 0.0, 'sessions': []}
+
+        # разбор идет с опережением не более чем на окно, чтобы не держать в памяти все результаты
+        window = self.workers * 2
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+            next_to_submit = 0
+
+            for position, source in enumerate(pending):
+                while next_to_submit < len(pending) and next_to_submit < position + window:
+                    futures[next_to_submit] = executor.submit(_parse_source, pending[next_to_submit])
+                    next_to_submit += 1
+
+                analysis_result = futures.pop(position).result()
+
+                apply_started = time.monotonic()
+                session_id = self.db_handler.save_analysis_result(analysis_result)
+                report['apply_seconds'] += time.monotonic() - apply_started
+                report['parse_seconds'] += analysis_result['parse_seconds']
+                report['rows'] += (len(analysis_result['substance_consumers'])
+                                   + len(analysis_result['substances_manufacturers']))
+                report['sessions'].append(session_id)
+
+                state['last_applied'] = {'source': source['id'], 'timestamp': source['timestamp'],
+                                         'session_id': session_id}
+                state['applied'].append({'source': source['id'], 'session_id': session_id})
+                self._save_state(state)
+                logger.info(f"Применен {position + 1}/{len(pending)}: {source['id']} -> сессия {session_id}")
+
+        elapsed = time.monotonic() - started
+        report['elapsed_seconds'] = elapsed
+        report['sources_per_second'] = len(pending) / elapsed if elapsed else 0.0
+        report['rows_per_second'] = report['rows'] / elapsed if elapsed else 0.0
+        report['last_session_id'] = state['applied'][-1]['session_id'] if state['applied'] else None
+
+        logger.info(
+            f"Перепроигрывание завершено: {len(pending)} файлов за {elapsed:.1f} с "
+            f"({report['sources_per_second']:.2f} файлов/с, {report['rows_per_second']:.0f} строк/с)"
+        )
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перепроигрывание истории из сохраненных архивов и Excel файлов")
+    parser.add_argument('sources', nargs='*', help="SHA-256 артефактов или пути к файлам")
+    parser.add_argument('--all-archives', action='store_true', help="Взять все архивы из хранилища")
+    parser.add_argument('--workers', type=int, default=None, help="Число процессов разбора")
+    parser.add_argument('--database-url', help="Целевая БД перепроигрывания")
+    parser.add_argument('--live', action='store_true', help="Писать в боевую БД из DATABASE_URL")
+    args = parser.parse_args()
+
+    if args.database_url and args.live:
+        parser.error("Укажите либо --database-url, либо --live")
+    database_url = args.database_url or (os.getenv('DATABASE_URL') if args.live else None)
+    if not database_url:
+        parser.error("Перепроигрывание пишет в БД: укажите целевую БД (--database-url) "
+                     "или явно разрешите запись в боевую (--live)")
+
+    # перепроигранные сессии не публикуются в ленту изменений и не сбрасывают кеш запросов к реестру
+    os.environ.setdefault('CHANGE_FEED_ENABLED', '0')
+    os.environ.setdefault('LATEST_SESSION_PUBLISH_ENABLED', '0')
+
+    sources = list(args.sources)
+    if args.all_archives:
+        from app.storage.artifact_store import ArtifactStore
+        sources += [a['sha256'] for a in ArtifactStore().list_artifacts(kind='archive')]
+
+    report = HistoryReplay(sources, database_url, workers=args.workers).run()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
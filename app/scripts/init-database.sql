@@ -7,24 +7,61 @@ CREATE TABLE IF NOT EXISTS analysis_sessions (
     substances_found INTEGER,
     preparations_found INTEGER,
     consumers_found INTEGER,
+    unique_substances INTEGER,
+    source_hash VARCHAR(64), -- SHA-256 исходного файла, по нему продолжается незавершенная сессия
+    status VARCHAR(20) NOT NULL DEFAULT 'in_progress', -- 'in_progress', 'completed', 'abandoned'
+    completed_at TIMESTAMP,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Прогресс записи сессии: последняя записанная пачка каждого этапа
+CREATE TABLE IF NOT EXISTS session_persist_progress (
+    session_id INTEGER NOT NULL REFERENCES analysis_sessions(id),
+    stage VARCHAR(100) NOT NULL,
+    last_batch INTEGER NOT NULL,
+    changes INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (session_id, stage)
+);
+
+-- Срез незавершенной сессии для записи шардами на разных воркерах (gzip JSON),
+-- удаляется при завершении сессии
+CREATE TABLE IF NOT EXISTS session_snapshots (
+    session_id INTEGER PRIMARY KEY REFERENCES analysis_sessions(id),
+    snapshot BYTEA NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Статистика сессии (топы и счетчики) с изменением относительно предыдущей сессии
+CREATE TABLE IF NOT EXISTS session_statistics (
+    session_id INTEGER NOT NULL REFERENCES analysis_sessions(id),
+    category VARCHAR(50) NOT NULL, -- 'counter', 'manufacturer', 'substance', 'country'
+    name VARCHAR(500) NOT NULL,
+    value INTEGER NOT NULL,
+    delta INTEGER, -- NULL, если в предыдущей сессии значения не было
+    PRIMARY KEY (session_id, category, name)
+);
+
 -- Производители субстанций с версионированием
 CREATE TABLE IF NOT EXISTS substance_manufacturers (
     id SERIAL PRIMARY KEY,
     substance_name VARCHAR(500) NOT NULL,
+    substance_id BIGINT, -- id канонической субстанции из словаря
     manufacturers JSONB NOT NULL,
     first_seen_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    last_seen_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_seen_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- время записи версии, последний раз видели - last_seen_at в *_seen
     is_current BOOLEAN DEFAULT TRUE,
-    version INTEGER DEFAULT 1
+    version INTEGER DEFAULT 1,
+    -- Версия действует в сессиях [valid_from_session, valid_to_session), NULL - до сих пор
+    valid_from_session INTEGER REFERENCES analysis_sessions(id),
+    valid_to_session INTEGER REFERENCES analysis_sessions(id)
 );
 
 -- Журнал изменений производителей
 CREATE TABLE IF NOT EXISTS substance_manufacturer_changes (
     id SERIAL PRIMARY KEY,
     substance_name VARCHAR(500) NOT NULL,
+    substance_id BIGINT,
     old_manufacturers JSONB,
     new_manufacturers JSONB,
     change_type VARCHAR(50), -- 'added', 'removed', 'modified'
@@ -36,29 +73,35 @@ CREATE TABLE IF NOT EXISTS substance_manufacturer_changes (
 CREATE TABLE IF NOT EXISTS substance_consumers (
     id SERIAL PRIMARY KEY,
     substance_name VARCHAR(500) NOT NULL,
+    substance_id BIGINT, -- id канонической субстанции из словаря
     preparation_trade_name VARCHAR(500),
     preparation_inn_name VARCHAR(500),
     preparation_manufacturer VARCHAR(500),
     preparation_country VARCHAR(100),
     registration_number VARCHAR(100),
-    registration_date VARCHAR(50),
+    registration_date DATE, -- NULL, если в реестре дата пустая или некорректная
     release_forms TEXT,
     first_seen_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    last_seen_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_seen_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- время записи версии, последний раз видели - last_seen_at в *_seen
     is_current BOOLEAN DEFAULT TRUE,
     version INTEGER DEFAULT 1,
-    UNIQUE(substance_name, preparation_trade_name, preparation_manufacturer, registration_number)
+    -- Версия действует в сессиях [valid_from_session, valid_to_session), NULL - до сих пор
+    valid_from_session INTEGER REFERENCES analysis_sessions(id),
+    valid_to_session INTEGER REFERENCES analysis_sessions(id)
 );
 
 -- Журнал изменений препаратов
 CREATE TABLE IF NOT EXISTS substance_consumer_changes (
     id SERIAL PRIMARY KEY,
     substance_name VARCHAR(500) NOT NULL,
+    substance_id BIGINT,
     preparation_trade_name VARCHAR(500),
     preparation_inn_name VARCHAR(500),
     preparation_manufacturer VARCHAR(500),
     preparation_country VARCHAR(100),
     registration_number VARCHAR(100),
+    registration_date DATE, -- для 'modified' - новые значения, для 'removed' - значения закрытой версии
+    release_forms TEXT,
     change_type VARCHAR(50), -- 'added', 'removed', 'modified'
     changed_fields JSONB, -- Какие поля изменились
     changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -67,6 +110,54 @@ CREATE TABLE IF NOT EXISTS substance_consumer_changes (
 
 -- Индексы для производительности
 CREATE INDEX IF NOT EXISTS idx_substance_manufacturers_name ON substance_manufacturers(substance_name);
-CREATE INDEX IF NOT EXISTS idx_substance_manufacturers_current ON substance_manufacturers(is_current);
-CREATE INDEX IF NOT EXISTS idx_substance_consumers_current ON substance_consumers(is_current);
-CREATE INDEX IF NOT EXISTS idx_substance_consumers_composite ON substance_consumers(substance_name, preparation_trade_name, registration_number);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_substance_consumers_composite ON substance_consumers(substance_name, preparation_trade_name, registration_number);
+
+-- Уникальна только актуальная версия препарата, старые версии хранятся рядом
+CREATE UNIQUE INDEX IF NOT EXISTS idx_substance_consumers_current_key ON substance_consumers(substance_id, preparation_trade_name, preparation_manufacturer, registration_number) WHERE is_current = TRUE;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_substance_manufacturers_current_key ON substance_manufacturers(substance_id) WHERE is_current = TRUE;
+
+-- Индексы для запросов на момент сессии
+CREATE INDEX IF NOT EXISTS idx_substance_manufacturers_validity ON substance_manufacturers(substance_name, valid_from_session, valid_to_session);
+CREATE INDEX IF NOT EXISTS idx_substance_consumers_validity ON substance_consumers(substance_name, valid_from_session, valid_to_session);
+CREATE INDEX IF NOT EXISTS idx_substance_consumers_trade_validity ON substance_consumers(preparation_trade_name, valid_from_session, valid_to_session);
+CREATE INDEX IF NOT EXISTS idx_analysis_sessions_timestamp ON analysis_sessions(timestamp);
+
+-- Тренды статистики по сессиям
+CREATE INDEX IF NOT EXISTS idx_session_statistics_trend ON session_statistics(category, name, session_id);
+
+-- Записи, сохраненные до словаря субстанций (substance_id IS NULL), ищутся по названию
+CREATE INDEX IF NOT EXISTS idx_substance_consumers_current_name ON substance_consumers(substance_name) WHERE is_current = TRUE AND substance_id IS NULL;
+
+-- Поиск незавершенной сессии
+CREATE INDEX IF NOT EXISTS idx_analysis_sessions_in_progress ON analysis_sessions(source_hash) WHERE status = 'in_progress';
+
+-- Выборки по дате регистрации
+CREATE INDEX IF NOT EXISTS idx_substance_consumers_registration_date ON substance_consumers(registration_date) WHERE is_current = TRUE;
+
+-- Актуальные версии: частичные индексы вместо индексов по булевой is_current,
+-- которые планировщик не использует, когда актуальных строк много
+CREATE INDEX IF NOT EXISTS idx_substance_manufacturers_current_name ON substance_manufacturers(substance_name) WHERE is_current = TRUE;
+CREATE INDEX IF NOT EXISTS idx_substance_consumers_current_country ON substance_consumers(preparation_country) WHERE is_current = TRUE;
+
+-- Журналы: изменения сессии (лента изменений) и изменения за период
+CREATE INDEX IF NOT EXISTS idx_substance_manufacturer_changes_session ON substance_manufacturer_changes(session_id);
+CREATE INDEX IF NOT EXISTS idx_substance_consumer_changes_session ON substance_consumer_changes(session_id);
+CREATE INDEX IF NOT EXISTS idx_substance_consumer_changes_changed_at ON substance_consumer_changes(changed_at);
+
+-- Когда версию видели последний раз: неизмененные строки при записи не обновляются,
+-- поэтому это последняя завершенная сессия в пределах [valid_from_session, valid_to_session)
+CREATE OR REPLACE VIEW substance_manufacturers_seen AS
+SELECT t.*,
+       (SELECT s.timestamp FROM analysis_sessions s
+        WHERE s.status = 'completed' AND s.id >= t.valid_from_session
+        AND (t.valid_to_session IS NULL OR s.id < t.valid_to_session)
+        ORDER BY s.id DESC LIMIT 1) AS last_seen_at
+FROM substance_manufacturers t;
+
+CREATE OR REPLACE VIEW substance_consumers_seen AS
+SELECT t.*,
+       (SELECT s.timestamp FROM analysis_sessions s
+        WHERE s.status = 'completed' AND s.id >= t.valid_from_session
+        AND (t.valid_to_session IS NULL OR s.id < t.valid_to_session)
+        ORDER BY s.id DESC LIMIT 1) AS last_seen_at
+FROM substance_consumers t;
@@ -0,0 +1,323 @@
+"""
+Нагрузочный тест записи в БД: N синтетических сессий подряд с заданной долей изменений
+против одноразовой локальной PostgreSQL, созданной из init-database.sql.
+
+Для каждой сессии записываются время save_analysis_result, число выполненных
+SQL запросов, размер таблиц и индексов и число мертвых строк.
+
+Использовать:
+    python -m app.scripts.loadtest --sessions 20 --substances 2000 --output report.json
+    python -m app.scripts.loadtest --sessions 20 --compare report.json
+"""
+import os
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+from app.database.postgres_handler import PostgresHandler
+from app.parsers.substance_dictionary import normalize_substance_name, substance_id_for_key
+from config.logging import get_logger
+
+logger = get_logger(__name__)
+
+INIT_SQL_PATH = os.path.join(os.path.dirname(__file__), 'init-database.sql')
+TRACKED_TABLES = ('analysis_sessions', 'substance_manufacturers', 'substance_manufacturer_changes',
+                  'substance_consumers', 'substance_consumer_changes')
+
+
+class ThrowawayPostgres:
+    """
+    Одноразовая БД для тестов: отдельный кластер через initdb/pg_ctl во временной
+    директории или, если задан server_url, временная база на существующем сервере
+    """
+
+    def __init__(self, server_url: Optional[str] = None, init_sql_path: str = INIT_SQL_PATH):
+        self.server_url = server_url
+        self.init_sql_path = init_sql_path
+        self.data_dir = None
+        self.database_name = f"grls_loadtest_{os.getpid()}"
+        self.database_url = None
+
+    def __enter__(self) -> str:
+        if self.server_url:
+            self._admin_execute(self.server_url, f'CREATE DATABASE "{self.database_name}"')
+            self.database_url = self._with_database(self.server_url, self.database_name)
+        else:
+            self.database_url = self._start_cluster()
+
+        conn = psycopg2.connect(self.database_url)
+        try:
+            with conn, conn.cursor() as cursor, open(self.init_sql_path, 'r', encoding='utf-8') as f:
+                cursor.execute(f.read())
+        finally:
+            conn.close()
+
+        logger.info(f"Одноразовая БД готова: {self.database_name}")
+        return self.database_url
+
+    def __exit__(self, *exc_info):
+        if self.server_url:
+            self._admin_execute(self.server_url, f'DROP DATABASE IF EXISTS "{self.database_name}"')
+        elif self.data_dir:
+            subprocess.run(['pg_ctl', '-D', self.data_dir, '-m', 'immediate', 'stop'],
+                           check=False, capture_output=True)
+            shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def _start_cluster(self) -> str:
+        self.data_dir = tempfile.mkdtemp(prefix='grls_pg_')
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+
+        subprocess.run(['initdb', '-D', self.data_dir, '-U', 'postgres', '-A', 'trust', '-E', 'UTF8'],
+                       check=True, capture_output=True)
+        subprocess.run(['pg_ctl', '-D', self.data_dir, '-w', '-l', os.path.join(self.data_dir, 'server.log'),
+                        '-o', f"-p {port} -k {self.data_dir} -c listen_addresses=127.0.0.1", 'start'],
+                       check=True, capture_output=True)
+
+        server_url = f"postgresql://postgres@127.0.0.1:{port}/postgres"
+        self._admin_execute(server_url, f'CREATE DATABASE "{self.database_name}"')
+        return self._with_database(server_url, self.database_name)
+
+    @staticmethod
+    def _admin_execute(server_url: str, query: str):
+        conn = psycopg2.connect(server_url)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _with_database(url: str, database_name: str) -> str:
+        return f"{url.rsplit('/', 1)[0]}/{database_name}"
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Курсор, считающий выполненные запросы"""
+    counter = {'statements': 0}
+
+    def execute(self, query, vars=None):
+        CountingCursor.counter['statements'] += 1
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        CountingCursor.counter['statements'] += 1
+        return super().executemany(query, vars_list)
+
+
+class CountingPostgresHandler(PostgresHandler):
+    """PostgresHandler, все соединения которого считают выполненные запросы"""
+
+    def _get_connection(self):
+        return psycopg2.connect(self.database_url, cursor_factory=CountingCursor)
+
+
+class SyntheticRegistry:
+    """Генерирует последовательные срезы реестра с заданной долей добавлений, изменений и удалений"""
+
+    def __init__(self, substances: int, preparations_per_substance: int = 5, seed: int = 42):
+        self.random = random.Random(seed)
+        self.next_id = 0
+        self.timestamp = datetime(2024, 1, 1, 9, 0)
+        self.substances: Dict[str, List[str]] = {}
+        self.consumers: Dict[tuple, Dict] = {}
+
+        for _ in range(substances):
+            self._add_substance(preparations_per_substance)
+
+    def _new_id(self) -> int:
+        self.next_id += 1
+        return self.next_id
+
+    def _add_substance(self, preparations: int):
+        name = f"Субстанция-{self._new_id()}"
+        self.substances[name] = [f"Производитель-{self.random.randint(1, 500)}" for _ in range(2)]
+        for _ in range(preparations):
+            self._add_consumer(name)
+
+    def _add_consumer(self, substance_name: str):
+        prep_id = self._new_id()
+        consumer = {
+            'substance_id': substance_id_for_key(normalize_substance_name(substance_name)),
+            'substance_name': substance_name,
+            'preparation_trade_name': f"Препарат-{prep_id}",
+            'preparation_inn_name': substance_name,
+            'preparation_manufacturer': f"Производитель-{self.random.randint(1, 500)}",
+            'preparation_country': self.random.choice(['Россия', 'Индия', 'Китай', 'Германия']),
+            'registration_number': f"ЛП-{prep_id:06d}",
+            'registration_date': self.timestamp.date(),
+            'release_forms': 'таблетки',
+        }
+        key = (substance_name, consumer['preparation_trade_name'],
+               consumer['preparation_manufacturer'], consumer['registration_number'])
+        self.consumers[key] = consumer
+
+    def next_session(self, add_rate: float, modify_rate: float, remove_rate: float) -> Dict:
+        """Применяет изменения к реестру и возвращает срез в формате MedicalParser"""
+        keys = list(self.consumers)
+        churn = lambda rate: self.random.sample(keys, min(len(keys), int(len(keys) * rate)))
+
+        for key in churn(remove_rate):
+            self.consumers.pop(key, None)
+        for key in churn(modify_rate):
+            if key in self.consumers:
+                self.consumers[key]['release_forms'] = f"таблетки {self._new_id()}"
+        substance_names = list(self.substances)
+        for _ in range(int(len(keys) * add_rate)):
+            self._add_consumer(self.random.choice(substance_names))
+        for name in self.random.sample(substance_names, int(len(substance_names) * modify_rate)):
+            self.substances[name] = self.substances[name][:1] + [f"Производитель-{self.random.randint(1, 500)}"]
+
+        self.timestamp += timedelta(hours=12)
+        return {
+            'timestamp': self.timestamp.isoformat(),
+            'source_file': 'synthetic',
+            'statistics': {
+                'total_records': len(self.consumers) + len(self.substances),
+                'substances_found': len(self.substances),
+                'preparations_found': len(self.consumers),
+                'substance_consumers_found': len(self.consumers),
+                'unique_substances': len(self.substances),
+                'top_manufacturers': {},
+                'top_substances': {},
+                'countries_distribution': {},
+            },
+            'substances_manufacturers': [
+                {'substance_id': substance_id_for_key(normalize_substance_name(name)),
+                 'substance_name': name, 'manufacturers': list(manufacturers)}
+                for name, manufacturers in self.substances.items()
+            ],
+            'substance_consumers': [dict(c) for c in self.consumers.values()],
+        }
+
+
+def collect_table_stats(database_url: str) -> Dict[str, Dict]:
+    """Размер таблиц и индексов, живые и мертвые строки"""
+    conn = psycopg2.connect(database_url)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT pg_stat_clear_snapshot()')
+            cursor.execute('''
+                SELECT relname, pg_relation_size(relid), pg_indexes_size(relid), n_live_tup, n_dead_tup
+                FROM pg_stat_user_tables
+                WHERE relname = ANY(%s)
+            ''', (list(TRACKED_TABLES),))
+            return {
+                name: {'table_bytes': table_bytes, 'index_bytes': index_bytes,
+                       'live_tuples': live, 'dead_tuples': dead}
+                for name, table_bytes, index_bytes, live, dead in cursor.fetchall()
+            }
+    finally:
+        conn.close()
+
+
+def run_load_test(database_url: str, sessions: int, substances: int, preparations_per_substance: int,
+                  add_rate: float, modify_rate: float, remove_rate: float, stats_delay: float = 1.0) -> Dict:
+    """Записывает sessions синтетических сессий подряд и собирает метрики по каждой"""
+    handler = CountingPostgresHandler(database_url)
+    registry = SyntheticRegistry(substances, preparations_per_substance)
+    results = []
+
+    for number in range(1, sessions + 1):
+        analysis_result = registry.next_session(add_rate, modify_rate, remove_rate) if number > 1 \
+            else registry.next_session(0, 0, 0)
+
+        CountingCursor.counter['statements'] = 0
+        started = time.monotonic()
+        session_id = handler.save_analysis_result(analysis_result)
+        persist_seconds = time.monotonic() - started
+        statements = CountingCursor.counter['statements']
+
+        # статистика таблиц обновляется с задержкой
+        time.sleep(stats_delay)
+        tables = collect_table_stats(database_url)
+
+        results.append({
+            'session': number,
+            'session_id': session_id,
+            'snapshot_rows': len(analysis_result['substance_consumers']),
+            'persist_seconds': round(persist_seconds, 3),
+            'statements': statements,
+            'total_bytes': sum(t['table_bytes'] + t['index_bytes'] for t in tables.values()),
+            'dead_tuples': sum(t['dead_tuples'] for t in tables.values()),
+            'tables': tables,
+        })
+        logger.info(f"Сессия {number}/{sessions}: {persist_seconds:.2f} с, запросов {statements}, "
+                    f"мертвых строк {results[-1]['dead_tuples']}")
+
+    return {
+        'parameters': {
+            'sessions': sessions, 'substances': substances,
+            'preparations_per_substance': preparations_per_substance,
+            'add_rate': add_rate, 'modify_rate': modify_rate, 'remove_rate': remove_rate,
+        },
+        'sessions': results,
+        'summary': {
+            'total_persist_seconds': round(sum(r['persist_seconds'] for r in results), 3),
+            'total_statements': sum(r['statements'] for r in results),
+            'final_total_bytes': results[-1]['total_bytes'] if results else 0,
+            'final_dead_tuples': results[-1]['dead_tuples'] if results else 0,
+        },
+    }
+
+
+def compare_reports(baseline: Dict, current: Dict) -> List[str]:
+    """Сравнивает итоги двух прогонов: текущее значение и отношение к базовому"""
+    lines = []
+    for metric, value in current['summary'].items():
+        base = baseline['summary'].get(metric)
+        ratio = f"x{value / base:.2f}" if base else "n/a"
+        lines.append(f"{metric:<24} {base!s:>14} -> {value!s:>14}  {ratio}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест записи сессий в PostgreSQL")
+    parser.add_argument('--sessions', type=int, default=10)
+    parser.add_argument('--substances', type=int, default=1000)
+    parser.add_argument('--preparations-per-substance', type=int, default=5)
+    parser.add_argument('--add-rate', type=float, default=0.01)
+    parser.add_argument('--modify-rate', type=float, default=0.02)
+    parser.add_argument('--remove-rate', type=float, default=0.005)
+    parser.add_argument('--stats-delay', type=float, default=1.0, help="Пауза перед сбором статистики таблиц, с")
+    parser.add_argument('--server-url', default=os.getenv('LOADTEST_SERVER_URL'),
+                        help="Сервер для временной БД; по умолчанию поднимается свой кластер через initdb")
+    parser.add_argument('--output', help="Куда сохранить отчет в JSON")
+    parser.add_argument('--compare', help="Отчет предыдущего прогона для сравнения")
+    args = parser.parse_args()
+
+    # меряем только запись в БД; синтетические сессии не трогают ленту и кеш запросов боевого Redis
+    os.environ.setdefault('CHANGE_FEED_ENABLED', '0')
+    os.environ.setdefault('LATEST_SESSION_PUBLISH_ENABLED', '0')
+
+    with ThrowawayPostgres(args.server_url) as database_url:
+        report = run_load_test(database_url, args.sessions, args.substances, args.preparations_per_substance,
+                               args.add_rate, args.modify_rate, args.remove_rate, args.stats_delay)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Отчет сохранен: {args.output}")
+
+    print(json.dumps(report['summary'], ensure_ascii=False, indent=2))
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print('\n'.join(compare_reports(baseline, report)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+-- Границы действия версий для уже существующей БД (новая БД создается init-database.sql)
+
+ALTER TABLE substance_manufacturers ADD COLUMN IF NOT EXISTS valid_from_session INTEGER REFERENCES analysis_sessions(id);
+ALTER TABLE substance_manufacturers ADD COLUMN IF NOT EXISTS valid_to_session INTEGER REFERENCES analysis_sessions(id);
+ALTER TABLE substance_consumers ADD COLUMN IF NOT EXISTS valid_from_session INTEGER REFERENCES analysis_sessions(id);
+ALTER TABLE substance_consumers ADD COLUMN IF NOT EXISTS valid_to_session INTEGER REFERENCES analysis_sessions(id);
+
+-- Версия появилась в последней сессии, созданной до first_seen_date
+UPDATE substance_manufacturers t
+SET valid_from_session = (
+    SELECT MAX(s.id) FROM analysis_sessions s WHERE s.created_at <= t.first_seen_date
+)
+WHERE valid_from_session IS NULL;
+
+UPDATE substance_consumers t
+SET valid_from_session = (
+    SELECT MAX(s.id) FROM analysis_sessions s WHERE s.created_at <= t.first_seen_date
+)
+WHERE valid_from_session IS NULL;
+
+-- Неактуальная версия действует до появления следующей
+UPDATE substance_manufacturers t
+SET valid_to_session = n.valid_from_session
+FROM substance_manufacturers n
+WHERE t.is_current = FALSE AND t.valid_to_session IS NULL
+AND n.substance_name = t.substance_name AND n.version = t.version + 1;
+
+-- Уникальность только для актуальной версии, иначе новую версию препарата не вставить
+DO $$
+DECLARE
+    constraint_name TEXT;
+BEGIN
+    SELECT conname INTO constraint_name
+    FROM pg_constraint
+    WHERE conrelid = 'substance_consumers'::regclass AND contype = 'u';
+
+    IF constraint_name IS NOT NULL THEN
+        EXECUTE format('ALTER TABLE substance_consumers DROP CONSTRAINT %I', constraint_name);
+    END IF;
+END $$;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_substance_consumers_current_key ON substance_consumers(substance_name, preparation_trade_name, preparation_manufacturer, registration_number) WHERE is_current = TRUE;
+CREATE INDEX IF NOT EXISTS idx_substance_manufacturers_validity ON substance_manufacturers(substance_name, valid_from_session, valid_to_session);
+CREATE INDEX IF NOT EXISTS idx_substance_consumers_validity ON substance_consumers(substance_name, valid_from_session, valid_to_session);
+CREATE INDEX IF NOT EXISTS idx_substance_consumers_trade_validity ON substance_consumers(preparation_trade_name, valid_from_session, valid_to_session);
+CREATE INDEX IF NOT EXISTS idx_analysis_sessions_timestamp ON analysis_sessions(timestamp);
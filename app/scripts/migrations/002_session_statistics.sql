@@ -0,0 +1,33 @@
+-- Статистика сессий для уже существующей БД (новая БД создается init-database.sql)
+
+ALTER TABLE analysis_sessions ADD COLUMN IF NOT EXISTS unique_substances INTEGER;
+
+CREATE TABLE IF NOT EXISTS session_statistics (
+    session_id INTEGER NOT NULL REFERENCES analysis_sessions(id),
+    category VARCHAR(50) NOT NULL, -- 'counter', 'manufacturer', 'substance', 'country'
+    name VARCHAR(500) NOT NULL,
+    value INTEGER NOT NULL,
+    delta INTEGER, -- NULL, если в предыдущей сессии значения не было
+    PRIMARY KEY (session_id, category, name)
+);
+
+-- Счетчики прошлых сессий уже есть в analysis_sessions
+INSERT INTO session_statistics (session_id, category, name, value)
+SELECT s.id, 'counter', c.name, c.value
+FROM analysis_sessions s
+CROSS JOIN LATERAL (VALUES
+    ('total_records', s.total_records),
+    ('substances_found', s.substances_found),
+    ('preparations_found', s.preparations_found),
+    ('substance_consumers_found', s.consumers_found)
+) AS c(name, value)
+WHERE c.value IS NOT NULL
+ON CONFLICT DO NOTHING;
+
+UPDATE session_statistics t
+SET delta = t.value - p.value
+FROM session_statistics p
+WHERE t.delta IS NULL AND p.category = t.category AND p.name = t.name
+AND p.session_id = (SELECT MAX(id) FROM analysis_sessions WHERE id < t.session_id);
+
+CREATE INDEX IF NOT EXISTS idx_session_statistics_trend ON session_statistics(category, name, session_id);
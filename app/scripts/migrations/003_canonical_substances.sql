@@ -0,0 +1,7 @@
+-- Канонические субстанции для уже существующей БД (новая БД создается init-database.sql)
+
+ALTER TABLE substance_manufacturers ADD COLUMN IF NOT EXISTS substance_id BIGINT;
+ALTER TABLE substance_consumers ADD COLUMN IF NOT EXISTS substance_id BIGINT;
+
+CREATE INDEX IF NOT EXISTS idx_substance_manufacturers_substance_id ON substance_manufacturers(substance_id) WHERE is_current = TRUE;
+CREATE INDEX IF NOT EXISTS idx_substance_consumers_substance_id ON substance_consumers(substance_id) WHERE is_current = TRUE;
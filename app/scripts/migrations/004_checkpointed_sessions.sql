@@ -0,0 +1,21 @@
+-- Возобновляемая запись сессий для уже существующей БД (новая БД создается init-database.sql)
+
+ALTER TABLE analysis_sessions ADD COLUMN IF NOT EXISTS source_hash VARCHAR(64);
+ALTER TABLE analysis_sessions ADD COLUMN IF NOT EXISTS status VARCHAR(20);
+ALTER TABLE analysis_sessions ADD COLUMN IF NOT EXISTS completed_at TIMESTAMP;
+
+-- Прошлые сессии считаем завершенными
+UPDATE analysis_sessions SET status = 'completed', completed_at = created_at WHERE status IS NULL;
+ALTER TABLE analysis_sessions ALTER COLUMN status SET DEFAULT 'in_progress';
+ALTER TABLE analysis_sessions ALTER COLUMN status SET NOT NULL;
+
+CREATE TABLE IF NOT EXISTS session_persist_progress (
+    session_id INTEGER NOT NULL REFERENCES analysis_sessions(id),
+    stage VARCHAR(100) NOT NULL,
+    last_batch INTEGER NOT NULL,
+    changes INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (session_id, stage)
+);
+
+CREATE INDEX IF NOT EXISTS idx_analysis_sessions_in_progress ON analysis_sessions(source_hash) WHERE status = 'in_progress';
@@ -0,0 +1,20 @@
+-- Отслеживание "последний раз видели" без обновления неизмененных строк
+-- для уже существующей БД (новая БД создается init-database.sql)
+
+-- Когда версию видели последний раз: неизмененные строки при записи не обновляются,
+-- поэтому это последняя завершенная сессия в пределах [valid_from_session, valid_to_session)
+CREATE OR REPLACE VIEW substance_manufacturers_seen AS
+SELECT t.*,
+       (SELECT s.timestamp FROM analysis_sessions s
+        WHERE s.status = 'completed' AND s.id >= t.valid_from_session
+        AND (t.valid_to_session IS NULL OR s.id < t.valid_to_session)
+        ORDER BY s.id DESC LIMIT 1) AS last_seen_at
+FROM substance_manufacturers t;
+
+CREATE OR REPLACE VIEW substance_consumers_seen AS
+SELECT t.*,
+       (SELECT s.timestamp FROM analysis_sessions s
+        WHERE s.status = 'completed' AND s.id >= t.valid_from_session
+        AND (t.valid_to_session IS NULL OR s.id < t.valid_to_session)
+        ORDER BY s.id DESC LIMIT 1) AS last_seen_at
+FROM substance_consumers t;
@@ -0,0 +1,35 @@
+-- Дата регистрации как DATE для уже существующей БД (новая БД создается init-database.sql)
+
+-- Раньше хранилось str() значения из pandas: '2019-05-14 00:00:00', 'nan' и т.п.
+CREATE OR REPLACE FUNCTION pg_temp.parse_registration_date(value TEXT) RETURNS DATE AS $$
+BEGIN
+    IF value IS NULL OR btrim(value) IN ('', 'nan', 'NaT', 'None', '~') THEN
+        RETURN NULL;
+    END IF;
+    IF value ~ '^\d{4}-\d{2}-\d{2}' THEN
+        RETURN substr(value, 1, 10)::DATE;
+    END IF;
+    IF value ~ '^\d{2}\.\d{2}\.\d{4}$' THEN
+        RETURN to_date(value, 'DD.MM.YYYY');
+    END IF;
+    RETURN NULL;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- представление зависит от типа колонки
+DROP VIEW IF EXISTS substance_consumers_seen;
+
+ALTER TABLE substance_consumers
+ALTER COLUMN registration_date TYPE DATE USING pg_temp.parse_registration_date(registration_date);
+
+CREATE OR REPLACE VIEW substance_consumers_seen AS
+SELECT t.*,
+       (SELECT s.timestamp FROM analysis_sessions s
+        WHERE s.status = 'completed' AND s.id >= t.valid_from_session
+        AND (t.valid_to_session IS NULL OR s.id < t.valid_to_session)
+        ORDER BY s.id DESC LIMIT 1) AS last_seen_at
+FROM substance_consumers t;
+
+CREATE INDEX IF NOT EXISTS idx_substance_consumers_registration_date ON substance_consumers(registration_date) WHERE is_current = TRUE;
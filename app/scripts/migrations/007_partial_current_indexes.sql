@@ -0,0 +1,14 @@
+-- Частичные индексы по актуальным версиям и индексы журналов
+-- для уже существующей БД (новая БД создается init-database.sql)
+
+-- Индексы по булевой is_current планировщик не использует, когда актуальных строк много
+DROP INDEX IF EXISTS idx_substance_manufacturers_current;
+DROP INDEX IF EXISTS idx_substance_consumers_current;
+
+CREATE INDEX IF NOT EXISTS idx_substance_manufacturers_current_name ON substance_manufacturers(substance_name) WHERE is_current = TRUE;
+CREATE INDEX IF NOT EXISTS idx_substance_consumers_current_country ON substance_consumers(preparation_country) WHERE is_current = TRUE;
+
+-- Журналы: изменения сессии (лента изменений) и изменения за период
+CREATE INDEX IF NOT EXISTS idx_substance_manufacturer_changes_session ON substance_manufacturer_changes(session_id);
+CREATE INDEX IF NOT EXISTS idx_substance_consumer_changes_session ON substance_consumer_changes(session_id);
+CREATE INDEX IF NOT EXISTS idx_substance_consumer_changes_changed_at ON substance_consumer_changes(changed_at);
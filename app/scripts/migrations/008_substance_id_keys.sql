@@ -0,0 +1,14 @@
+-- Версионирование по канонической субстанции (substance_id) для уже существующей БД
+-- (новая БД создается init-database.sql)
+
+-- Записи без substance_id (сохраненные до словаря субстанций) получают id при первой
+-- встрече в новой сессии: запись ищется по названию и переходит на substance_id
+DROP INDEX IF EXISTS idx_substance_consumers_current_key;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_substance_consumers_current_key ON substance_consumers(substance_id, preparation_trade_name, preparation_manufacturer, registration_number) WHERE is_current = TRUE;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_substance_manufacturers_current_key ON substance_manufacturers(substance_id) WHERE is_current = TRUE;
+
+-- Уникальные индексы заменяют обычные индексы по substance_id
+DROP INDEX IF EXISTS idx_substance_manufacturers_substance_id;
+DROP INDEX IF EXISTS idx_substance_consumers_substance_id;
+
+CREATE INDEX IF NOT EXISTS idx_substance_consumers_current_name ON substance_consumers(substance_name) WHERE is_current = TRUE AND substance_id IS NULL;
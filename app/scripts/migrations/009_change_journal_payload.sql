@@ -0,0 +1,7 @@
+-- Журналы изменений хранят все поля события ленты изменений: id субстанции,
+-- дату регистрации и формы выпуска препарата (новая БД создается init-database.sql)
+ALTER TABLE substance_manufacturer_changes ADD COLUMN IF NOT EXISTS substance_id BIGINT;
+
+ALTER TABLE substance_consumer_changes ADD COLUMN IF NOT EXISTS substance_id BIGINT;
+ALTER TABLE substance_consumer_changes ADD COLUMN IF NOT EXISTS registration_date DATE;
+ALTER TABLE substance_consumer_changes ADD COLUMN IF NOT EXISTS release_forms TEXT;
@@ -0,0 +1,8 @@
+-- Срез сессии в БД для записи шардами аккордом Celery, для уже существующей БД
+-- (новая БД создается init-database.sql)
+
+CREATE TABLE IF NOT EXISTS session_snapshots (
+    session_id INTEGER PRIMARY KEY REFERENCES analysis_sessions(id),
+    snapshot BYTEA NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
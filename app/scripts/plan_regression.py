@@ -0,0 +1,324 @@
+"""
+Регрессионный тест планов запросов: загружает в одноразовую PostgreSQL большую синтетическую
+историю реестра и выполняет каждый запрос из queries.txt под EXPLAIN (ANALYZE, BUFFERS).
+
+Тест падает (код выхода 1), если:
+- запрос читает большую таблицу последовательным сканированием, отбрасывая фильтром
+  больше строк, чем возвращает (значит, нужного индекса нет);
+- время выполнения превышает бюджет;
+- с --compare: время выросло больше чем в --tolerance раз относительно прошлого отчета.
+
+Для таких сканирований предлагается индекс (частичный, если фильтр содержит is_current).
+
+Использовать:
+    python -m app.scripts.plan_regression --output plan_report.json
+    python -m app.scripts.plan_regression --compare plan_report.json
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import statistics
+from typing import Dict, List, Optional, Tuple
+
+import psycopg2
+
+from app.scripts.loadtest import ThrowawayPostgres
+from config.logging import get_logger
+
+logger = get_logger(__name__)
+
+QUERIES_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'queries.txt')
+
+# Синтетическая история: у каждого препарата от 1 до versions версий, примерно каждый
+# десятый препарат удален (ни одной актуальной версии). Первые субстанции и препарат
+# названы так же, как в queries.txt, чтобы запросы с литералами находили строки
+HISTORY_SQL = '''
+INSERT INTO analysis_sessions (timestamp, source_file, source_hash, status, total_records, substances_found,
+                               preparations_found, consumers_found, unique_substances, completed_at, created_at)
+SELECT NOW() - make_interval(days => %(sessions)s - g), 'synthetic_' || g || '.xlsx', md5(g::text), 'completed',
+       %(substances)s * %(preparations)s, %(substances)s, %(substances)s * %(preparations)s,
+       %(substances)s * %(preparations)s, %(substances)s,
+       NOW() - make_interval(days => %(sessions)s - g), NOW() - make_interval(days => %(sessions)s - g)
+FROM generate_series(1, %(sessions)s) g;
+
+INSERT INTO substance_manufacturers (substance_name, substance_id, manufacturers, first_seen_date, last_seen_date,
+                                     is_current, version, valid_from_session, valid_to_session)
+SELECT n.substance, s, jsonb_build_array('Производитель ' || s %% 500, 'Производитель ' || (s * 3 + v) %% 500),
+       NOW() - make_interval(days => %(sessions)s), NOW() - make_interval(days => %(sessions)s - b.from_session),
+       v = k.versions, v, b.from_session, b.to_session
+FROM generate_series(1, %(substances)s) s
+CROSS JOIN LATERAL (SELECT 1 + (s * 7) %% %(versions)s AS versions) k
+CROSS JOIN LATERAL generate_series(1, k.versions) v
+CROSS JOIN LATERAL (SELECT CASE s WHEN 1 THEN 'Парацетамол' WHEN 2 THEN 'Ибупрофен'
+                              ELSE 'Субстанция ' || s END AS substance) n
+CROSS JOIN LATERAL (SELECT 1 + (v - 1) * %(sessions)s / k.versions AS from_session,
+                           CASE WHEN v < k.versions THEN 1 + v * %(sessions)s / k.versions END AS to_session) b;
+
+INSERT INTO substance_consumers (substance_name, substance_id, preparation_trade_name, preparation_inn_name,
+                                 preparation_manufacturer, preparation_country, registration_number,
+                                 registration_date, release_forms, first_seen_date, last_seen_date,
+                                 is_current, version, valid_from_session, valid_to_session)
+SELECT n.substance, s, n.trade, n.substance, 'Производитель ' || (s * p) %% 500,
+       (ARRAY['Россия', 'Индия', 'Китай', 'Германия', 'Франция', 'США', 'Венгрия', 'Словения'])[1 + (s + p) %% 8],
+       'ЛП-' || lpad(s::text, 6, '0') || '-' || p, DATE '2000-01-01' + (s * 31 + p * 17) %% 9500,
+       'таблетки ' || v || '0 мг',
+       NOW() - make_interval(days => %(sessions)s), NOW() - make_interval(days => %(sessions)s - b.from_session),
+       v = k.versions AND NOT k.removed, v, b.from_session,
+       CASE WHEN v < k.versions THEN b.to_session WHEN k.removed THEN %(sessions)s END
+FROM generate_series(1, %(substances)s) s
+CROSS JOIN generate_series(1, %(preparations)s) p
+CROSS JOIN LATERAL (SELECT 1 + (s * 7 + p * 13) %% %(versions)s AS versions, (s + p) %% 10 = 0 AS removed) k
+CROSS JOIN LATERAL generate_series(1, k.versions) v
+CROSS JOIN LATERAL (SELECT CASE s WHEN 1 THEN 'Парацетамол' WHEN 2 THEN 'Ибупрофен'
+                              ELSE 'Субстанция ' || s END AS substance,
+                           CASE WHEN s = 1 AND p = 1 THEN 'Панадол'
+                                ELSE 'Препарат ' || s || '-' || p END AS trade) n
+CROSS JOIN LATERAL (SELECT 1 + (v - 1) * %(sessions)s / k.versions AS from_session,
+                           1 + v * %(sessions)s / k.versions AS to_session) b;
+
+INSERT INTO substance_manufacturer_changes (substance_name, old_manufacturers, new_manufacturers,
+                                            change_type, changed_at, session_id)
+SELECT substance_name, NULL, manufacturers, CASE WHEN version = 1 THEN 'added' ELSE 'modified' END,
+       last_seen_date, valid_from_session
+FROM substance_manufacturers;
+
+INSERT INTO substance_consumer_changes (substance_name, preparation_trade_name, preparation_inn_name,
+                                        preparation_manufacturer, preparation_country, registration_number,
+                                        change_type, changed_fields, changed_at, session_id)
+SELECT substance_name, preparation_trade_name, preparation_inn_name, preparation_manufacturer,
+       preparation_country, registration_number,
+       CASE WHEN version = 1 THEN 'added' ELSE 'modified' END,
+       CASE WHEN version > 1 THEN '["release_forms"]'::jsonb END,
+       last_seen_date, valid_from_session
+FROM substance_consumers;
+
+INSERT INTO session_statistics (session_id, category, name, value, delta)
+SELECT g, 'manufacturer', CASE m WHEN 0 THEN 'Pfizer' ELSE 'Производитель ' || m END, 100 + (g * m) %% 50, NULL
+FROM generate_series(1, %(sessions)s) g
+CROSS JOIN generate_series(0, 199) m;
+'''
+
+FILTER_COLUMN = re.compile(r'\(*(\w+)\)?(?:::[\w ]+)?\s*(=|>=|<=|<|>|~~)\s')
+
+
+def load_synthetic_history(database_url: str, substances: int, preparations: int, versions: int, sessions: int):
+    """Заполняет БД синтетической историей целиком на стороне сервера (generate_series)"""
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(HISTORY_SQL, {
+                'substances': substances, 'preparations': preparations,
+                'versions': versions, 'sessions': sessions,
+            })
+            # статистика для планировщика и карта видимости для index only scan
+            cursor.execute('VACUUM ANALYZE')
+            cursor.execute('''
+                SELECT relname, n_live_tup FROM pg_stat_user_tables ORDER BY n_live_tup DESC
+            ''')
+            for table, rows in cursor.fetchall():
+                logger.info(f"Синтетическая история: {table} - {rows} строк")
+    finally:
+        conn.close()
+
+
+def parse_queries(path: str = QUERIES_PATH) -> List[Tuple[str, str]]:
+    """Делит файл запросов на (заголовок, запрос); заголовок - комментарий перед запросом"""
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+
+    queries = []
+    for chunk in text.split(';'):
+        title_lines, sql_lines = [], []
+        for line in chunk.strip().splitlines():
+            if line.startswith('--') and not sql_lines:
+                title_lines.append(line.lstrip('- ').strip())
+            elif line.strip():
+                sql_lines.append(line)
+        if sql_lines:
+            queries.append((' '.join(title_lines) or f"Запрос {len(queries) + 1}", '\n'.join(sql_lines)))
+    return queries
+
+
+def table_sizes(cursor) -> Dict[str, int]:
+    cursor.execute("SELECT relname, reltuples::BIGINT FROM pg_class WHERE relkind = 'r'")
+    return dict(cursor.fetchall())
+
+
+def _walk(plan: Dict, parent: Optional[Dict] = None):
+    yield plan, parent
+    for child in plan.get('Plans', []):
+        yield from _walk(child, plan)
+
+
+def plan_shape(plan: Dict) -> str:
+    """Форма плана без чисел: типы узлов и таблицы/индексы, например Limit(Index Scan[idx_x])"""
+    label = plan['Node Type']
+    target = plan.get('Index Name') or plan.get('Relation Name')
+    if target:
+        label += f"[{target}]"
+    children = [plan_shape(child) for child in plan.get('Plans', [])]
+    return f"{label}({', '.join(children)})" if children else label
+
+
+def suggest_index(node: Dict, parent: Optional[Dict]) -> Optional[str]:
+    """Индекс по колонкам фильтра (или группировки), частичный - если фильтр по is_current"""
+    condition = node.get('Filter', '')
+    columns = []
+    for column, operator in FILTER_COLUMN.findall(condition):
+        if column != 'is_current' and column not in columns:
+            # колонки равенства идут первыми
+            columns.insert(0 if operator == '=' else len(columns), column)
+
+    if not columns and parent:
+        for key in parent.get('Group Key', []):
+            match = re.fullmatch(r'(?:\w+\.)?(\w+)', key)
+            if match and match.group(1) not in columns:
+                columns.append(match.group(1))
+
+    if not columns:
+        return None
+
+    partial = ' WHERE is_current = TRUE' if re.search(r'\bis_current\b', condition) else ''
+    return f"CREATE INDEX ON {node['Relation Name']} ({', '.join(columns)}){partial};"
+
+
+def check_query(cursor, title: str, sql: str, sizes: Dict[str, int], large_table_rows: int,
+                budget_ms: float, runs: int) -> Dict:
+    """Выполняет запрос runs раз под EXPLAIN ANALYZE и проверяет последний план"""
+    timings = []
+    for _ in range(runs):
+        cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}")
+        explain = cursor.fetchone()[0][0]
+        timings.append(explain['Execution Time'])
+
+    plan = explain['Plan']
+    execution_ms = statistics.median(timings)
+    violations, suggestions, seq_scans = [], [], []
+
+    for node, parent in _walk(plan):
+        if node['Node Type'] != 'Seq Scan':
+            continue
+        table = node['Relation Name']
+        loops = node.get('Actual Loops', 1)
+        returned = node.get('Actual Rows', 0) * loops
+        removed = node.get('Rows Removed by Filter', 0) * loops
+        seq_scans.append({'table': table, 'rows': returned, 'removed_by_filter': removed})
+
+        if sizes.get(table, 0) >= large_table_rows and removed > returned:
+            violations.append(f"Seq Scan по {table}: отброшено фильтром {removed} строк, возвращено {returned}")
+            suggestion = suggest_index(node, parent)
+            if suggestion and suggestion not in suggestions:
+                suggestions.append(suggestion)
+
+    if execution_ms > budget_ms:
+        violations.append(f"Время {execution_ms:.1f} мс больше бюджета {budget_ms:.0f} мс")
+
+    return {
+        'title': title,
+        'sql': sql,
+        'execution_ms': round(execution_ms, 3),
+        'planning_ms': round(explain['Planning Time'], 3),
+        'shared_hit_blocks': plan.get('Shared Hit Blocks', 0),
+        'shared_read_blocks': plan.get('Shared Read Blocks', 0),
+        'shape': plan_shape(plan),
+        'seq_scans': seq_scans,
+        'violations': violations,
+        'suggested_indexes': suggestions,
+    }
+
+
+def run_plan_regression(database_url: str, queries: List[Tuple[str, str]], large_table_rows: int,
+                        budget_ms: float, runs: int) -> Dict:
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            sizes = table_sizes(cursor)
+            results = []
+            for title, sql in queries:
+                try:
+                    result = check_query(cursor, title, sql, sizes, large_table_rows, budget_ms, runs)
+                except psycopg2.Error as e:
+                    result = {'title': title, 'sql': sql, 'violations': [f"Ошибка выполнения: {e}".strip()]}
+                results.append(result)
+                status = 'FAIL' if result['violations'] else 'ok'
+                logger.info(f"[{status}] {title}: {result.get('execution_ms', '-')} мс, {result.get('shape', '')}")
+    finally:
+        conn.close()
+
+    return {
+        'parameters': {'large_table_rows': large_table_rows, 'budget_ms': budget_ms, 'runs': runs},
+        'table_rows': {table: sizes[table] for table in sorted(sizes) if sizes[table] > 0},
+        'queries': results,
+    }
+
+
+def compare_reports(baseline: Dict, current: Dict, tolerance: float) -> List[str]:
+    """Добавляет нарушения для запросов, ставших медленнее в tolerance раз; смену плана только печатает"""
+    previous = {q['title']: q for q in baseline['queries']}
+    lines = []
+    for query in current['queries']:
+        base = previous.get(query['title'])
+        if not base or 'execution_ms' not in base or 'execution_ms' not in query:
+            continue
+        if base['shape'] != query['shape']:
+            lines.append(f"План изменился: {query['title']}\n  было:  {base['shape']}\n  стало: {query['shape']}")
+        if base['execution_ms'] and query['execution_ms'] > base['execution_ms'] * tolerance:
+            query['violations'].append(
+                f"Время выросло: {base['execution_ms']:.1f} -> {query['execution_ms']:.1f} мс")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Регрессионный тест планов запросов из queries.txt")
+    parser.add_argument('--queries', default=QUERIES_PATH)
+    parser.add_argument('--substances', type=int, default=20000)
+    parser.add_argument('--preparations-per-substance', type=int, default=5)
+    parser.add_argument('--versions', type=int, default=8, help="Максимум версий одного препарата в истории")
+    parser.add_argument('--sessions', type=int, default=365)
+    parser.add_argument('--large-table-rows', type=int, default=10000,
+                        help="Таблицы от этого размера нельзя читать последовательным сканированием с фильтром")
+    parser.add_argument('--budget-ms', type=float, default=float(os.getenv('PLAN_BUDGET_MS', '200')))
+    parser.add_argument('--runs', type=int, default=3, help="Запусков каждого запроса, берется медиана")
+    parser.add_argument('--server-url', default=os.getenv('LOADTEST_SERVER_URL'),
+                        help="Сервер для временной БД; по умолчанию поднимается свой кластер через initdb")
+    parser.add_argument('--output', help="Куда сохранить отчет в JSON")
+    parser.add_argument('--compare', help="Отчет предыдущего прогона для сравнения")
+    parser.add_argument('--tolerance', type=float, default=2.0)
+    args = parser.parse_args()
+
+    queries = parse_queries(args.queries)
+
+    with ThrowawayPostgres(args.server_url) as database_url:
+        load_synthetic_history(database_url, args.substances, args.preparations_per_substance,
+                               args.versions, args.sessions)
+        report = run_plan_regression(database_url, queries, args.large_table_rows, args.budget_ms, args.runs)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        for line in compare_reports(baseline, report, args.tolerance):
+            print(line)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Отчет сохранен: {args.output}")
+
+    failed = [q for q in report['queries'] if q['violations']]
+    for query in failed:
+        print(f"\n{query['title']}")
+        for violation in query['violations']:
+            print(f"  - {violation}")
+        for suggestion in query.get('suggested_indexes', []):
+            print(f"  предлагаемый индекс: {suggestion}")
+
+    print(f"\nЗапросов: {len(report['queries'])}, с нарушениями: {len(failed)}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
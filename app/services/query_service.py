@@ -0,0 +1,135 @@
+import copy
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Callable, Dict, List, Optional
+
+import redis
+
+from config.logging import get_logger
+from config.redis_client import get_redis_client
+
+logger = get_logger(__name__)
+
+LATEST_SESSION_KEY = "grls:registry:latest_session"
+CACHE_PREFIX = "grls:query"
+
+
+class LRUCache:
+    """Потокобезопасный LRU кеш в памяти процесса"""
+
+    def __init__(self, max_size: int = 2048):
+        self.max_size = max_size
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key: str, value: Any):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+def publish_latest_session(session_id: int, redis_client: Optional[redis.Redis] = None):
+    """Отмечает сессию как последнюю записанную - все закешированные ответы становятся неактуальны"""
+    (redis_client or get_redis_client()).set(LATEST_SESSION_KEY, session_id)
+
+
+class RegistryQueryService:
+    """
+    Частые запросы к реестру с кешем в памяти процесса и в Redis.
+
+    Ключ кеша содержит id последней записанной сессии, поэтому после записи новой
+    сессии все ответы разом становятся неактуальными, без явной очистки кеша.
+    """
+
+    def __init__(self, db_handler=None, redis_client: Optional[redis.Redis] = None,
+                 local_size: int = 2048, redis_ttl: int = 2 * 24 * 3600, session_check_interval: float = 5.0):
+        if db_handler is None:
+            from app.database.postgres_handler import PostgresHandler
+            db_handler = PostgresHandler()
+
+        self.db_handler = db_handler
+        self.redis = redis_client or get_redis_client()
+        self.local = LRUCache(local_size)
+        self.redis_ttl = redis_ttl
+        self.session_check_interval = session_check_interval
+        self._session_id: Optional[int] = None
+        self._session_checked_at = 0.0
+
+    def latest_session_id(self) -> Optional[int]:
+        """Id последней записанной сессии; в Redis проверяется не чаще session_check_interval"""
+        now = time.monotonic()
+        if self._session_id is not None and now - self._session_checked_at < self.session_check_interval:
+            return self._session_id
+
+        session_id = None
+        try:
+            raw = self.redis.get(LATEST_SESSION_KEY)
+            session_id = int(raw) if raw is not None else None
+        except redis.RedisError as e:
+            logger.warning(f"Redis недоступен, берем последнюю сессию из БД: {e}")
+
+        if session_id is None:
+            session_id = self.db_handler.get_latest_session_id()
+
+        self._session_id = session_id
+        self._session_checked_at = now
+        return session_id
+
+    def _cached(self, name: str, args: Dict, loader: Callable[[], Any]) -> Any:
+        session_id = self.latest_session_id()
+        args_hash = hashlib.sha1(json.dumps(args, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+        key = f"{CACHE_PREFIX}:{session_id}:{name}:{args_hash}"
+
+        # наружу отдаются копии, чтобы вызывающий код не мог изменить закешированное значение
+        value = self.local.get(key)
+        if value is not None:
+            return copy.deepcopy(value)
+
+        try:
+            raw = self.redis.get(key)
+            if raw is not None:
+                value = json.loads(raw)
+                self.local.put(key, value)
+                return copy.deepcopy(value)
+        except redis.RedisError as e:
+            logger.warning(f"Не удалось прочитать кеш из Redis: {e}")
+
+        # в оба кеша кладется одно и то же JSON представление (даты - строками)
+        raw = json.dumps(loader(), ensure_ascii=False, default=str)
+        value = json.loads(raw)
+        self.local.put(key, value)
+        try:
+            self.redis.set(key, raw, ex=self.redis_ttl)
+        except redis.RedisError as e:
+            logger.warning(f"Не удалось записать кеш в Redis: {e}")
+        return copy.deepcopy(value)
+
+    def current_preparations_containing(self, substance_name: str) -> List[Dict]:
+        """Актуальные препараты, содержащие субстанцию"""
+        return self._cached('current_preparations', {'substance_name': substance_name},
+                            lambda: self.db_handler.get_current_consumers(substance_name))
+
+    def manufacturers_of_substance(self, substance_name: str) -> List[str]:
+        """Актуальные производители субстанции"""
+        return self._cached('manufacturers', {'substance_name': substance_name},
+                            lambda: self.db_handler.get_current_manufacturers(substance_name))
+
+    def registrations_between(self, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                              limit: Optional[int] = None) -> List[Dict]:
+        """Актуальные препараты, зарегистрированные в заданном диапазоне дат"""
+        return self._cached('registrations_between',
+                            {'date_from': str(date_from), 'date_to': str(date_to), 'limit': limit},
+                            lambda: self.db_handler.get_registrations_between(date_from, date_to, limit))
@@ -0,0 +1,154 @@
+import json
+import time
+import uuid
+import threading
+from typing import Callable, Dict, Optional
+
+import redis
+
+from config.logging import get_logger
+from config.redis_client import get_redis_client
+
+logger = get_logger(__name__)
+
+# Продлевает TTL только если блокировка все еще наша
+_EXTEND_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Снимает блокировку только если она все еще наша
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """
+    Гарантирует, что в каждый момент выполняется только один запуск задачи.
+
+    Первый вызов берет блокировку в Redis (SET NX с TTL) и продлевает ее из фонового
+    потока, пока работа не закончится. Повторный вызов не выполняет работу заново,
+    а ждет результат текущего запуска и возвращает его. Ждет он не дольше max_wait
+    (по умолчанию lock_ttl): если результата еще нет, возвращается {'status': PENDING,
+    'attached_to': <владелец>}, и вызывающий повторяет run(..., attach_to=<владелец>) позже,
+    не занимая воркер все время работы владельца.
+
+    Если func вернула результат с ключом HANDOFF, работа продолжается в других задачах
+    (например, в аккорде Celery): блокировка не снимается, а продлевается на handoff_ttl.
+    Эти задачи продлевают ее через hold(token), а последняя публикует итоговый
+    результат и снимает блокировку через complete(token, result).
+    """
+
+    HANDOFF = 'single_flight_handoff'
+    PENDING = 'pending'
+
+    def __init__(self, name: str, redis_client: Optional[redis.Redis] = None,
+                 lock_ttl: int = 120, heartbeat_interval: int = 30,
+                 result_ttl: int = 3600, max_wait: Optional[int] = None,
+                 poll_interval: float = 5.0, handoff_ttl: int = 3600):
+        self.redis = redis_client or get_redis_client()
+        self.lock_key = f"grls:single_flight:{name}:lock"
+        self.result_prefix = f"grls:single_flight:{name}:result:"
+        self.lock_ttl = lock_ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.result_ttl = result_ttl
+        self.max_wait = max_wait if max_wait is not None else lock_ttl
+        self.poll_interval = poll_interval
+        self.handoff_ttl = handoff_ttl
+        self._extend = self.redis.register_script(_EXTEND_SCRIPT)
+        self._release = self.redis.register_script(_RELEASE_SCRIPT)
+
+    def run(self, func: Callable[[], Dict], run_id: Optional[str] = None, attach_to: Optional[str] = None) -> Dict:
+        """
+        Выполняет func под блокировкой или возвращает результат уже идущего запуска.
+        attach_to - владелец, которого вызывающий уже ждал (из результата PENDING)
+        """
+        token = run_id or uuid.uuid4().hex
+
+        if attach_to and attach_to != token:
+            return self._wait_for_result(func, attach_to, token)
+
+        if self.redis.set(self.lock_key, token, nx=True, px=self.lock_ttl * 1000):
+            return self._run_as_leader(func, token)
+
+        holder = self.redis.get(self.lock_key)
+        if holder is None:
+            # блокировку только что сняли - пробуем еще раз
+            return self.run(func, run_id=token)
+
+        holder = holder.decode()
+        logger.info(f"Запуск {holder} уже выполняется, ждем его результат")
+        return self._wait_for_result(func, holder, token)
+
+    def _run_as_leader(self, func: Callable[[], Dict], token: str) -> Dict:
+        stop_event = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(token, stop_event), daemon=True)
+        heartbeat.start()
+
+        result = None
+        try:
+            result = func()
+            return result
+        finally:
+            stop_event.set()
+            heartbeat.join()
+            if result is not None and result.get(self.HANDOFF):
+                # работу продолжают другие задачи, блокировку снимет complete()
+                self.hold(token)
+            else:
+                self.complete(token, result)
+
+    def hold(self, token: str) -> bool:
+        """Продлевает переданную другим задачам блокировку на handoff_ttl; False - блокировка уже не наша"""
+        held = bool(self._extend(keys=[self.lock_key], args=[token, self.handoff_ttl * 1000]))
+        # результат уже есть - продолжение успело завершиться и снять блокировку
+        if not held and not self.redis.exists(self.result_prefix + token):
+            logger.error(f"Блокировка {self.lock_key} потеряна запуском {token}")
+        return held
+
+    def complete(self, token: str, result: Optional[Dict]):
+        """Публикует результат запуска и снимает его блокировку"""
+        # результат публикуется до снятия блокировки, чтобы ожидающие его не пропустили
+        payload = result if result is not None else {'status': 'error', 'error': 'Запуск завершился с исключением'}
+        self.redis.set(self.result_prefix + token, json.dumps(payload, ensure_ascii=False, default=str),
+                       ex=self.result_ttl)
+        self._release(keys=[self.lock_key], args=[token])
+
+    def _heartbeat(self, token: str, stop_event: threading.Event):
+        """Продлевает блокировку, пока работа не завершится"""
+        while not stop_event.wait(self.heartbeat_interval):
+            try:
+                if not self._extend(keys=[self.lock_key], args=[token, self.lock_ttl * 1000]):
+                    logger.error(f"Блокировка {self.lock_key} потеряна запуском {token}")
+                    return
+            except redis.RedisError as e:
+                logger.warning(f"Не удалось продлить блокировку {self.lock_key}: {e}")
+
+    def _wait_for_result(self, func: Callable[[], Dict], holder: str, token: str) -> Dict:
+        deadline = time.monotonic() + self.max_wait
+
+        while True:
+            raw = self.redis.get(self.result_prefix + holder)
+            if raw is not None:
+                result = json.loads(raw)
+                result['attached_to'] = holder
+                return result
+
+            current = self.redis.get(self.lock_key)
+            if current is None or current.decode() != holder:
+                # владелец упал и блокировка истекла, не оставив результата
+                raw = self.redis.get(self.result_prefix + holder)
+                if raw is not None:
+                    continue
+                logger.warning(f"Запуск {holder} завершился без результата, выполняем сами")
+                return self.run(func, run_id=token)
+
+            if time.monotonic() >= deadline:
+                return {'status': self.PENDING, 'attached_to': holder}
+            time.sleep(self.poll_interval)
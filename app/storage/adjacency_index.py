@@ -0,0 +1,232 @@
+"""
+Индекс связей "субстанция <-> препарат" в одном файле, который читается через mmap без копирования.
+
+Формат (все числа little-endian):
+    заголовок   - magic "GRLSADJ1", session_id (uint64), число субстанций, препаратов и связей (uint32),
+                  затем смещение и длина (uint64) каждой из секций ниже
+    substances  - отсортированная таблица строк: смещения (uint32, n+1) и utf-8 строки подряд
+    preparations- то же для торговых названий препаратов
+    s2p         - CSR: indptr (uint32, n_substances+1) и indices (uint32) - номера препаратов субстанции
+    p2s         - CSR в обратную сторону
+
+Строки отсортированы по utf-8 байтам, поиск - двоичный. Файл неизменяемый: новый индекс
+пишется во временный файл и переименовывается, текущий указывается в файле CURRENT.
+"""
+import os
+import sys
+import mmap
+import glob
+import struct
+from array import array
+from typing import Iterable, List, Optional, Tuple
+
+from config.logging import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_INDEX_DIR = "./app/parsers/data/index"
+CURRENT_POINTER = 'CURRENT'
+MAGIC = b'GRLSADJ1'
+SECTIONS = ('substance_offsets', 'substance_blob', 'preparation_offsets', 'preparation_blob',
+            's2p_indptr', 's2p_indices', 'p2s_indptr', 'p2s_indices')
+HEADER = struct.Struct('<8sQIII' + 'QQ' * len(SECTIONS))
+
+
+def _uint32_array(values: Iterable[int] = ()) -> array:
+    result = array('I', values)
+    if result.itemsize != 4:
+        raise RuntimeError("array('I') на этой платформе не 32-битный")
+    return result
+
+
+def _to_little_endian(data: array) -> bytes:
+    if sys.byteorder != 'little':
+        data = array(data.typecode, data)
+        data.byteswap()
+    return data.tobytes()
+
+
+def _string_table(names: List[bytes]) -> Tuple[array, bytes]:
+    offsets = _uint32_array([0])
+    for name in names:
+        offsets.append(offsets[-1] + len(name))
+    return offsets, b''.join(names)
+
+
+def _csr(n_rows: int, edges: List[Tuple[int, int]]) -> Tuple[array, array]:
+    """edges должны быть отсортированы по (строка, столбец)"""
+    indptr = _uint32_array([0] * (n_rows + 1))
+    for row, _ in edges:
+        indptr[row + 1] += 1
+    for i in range(n_rows):
+        indptr[i + 1] += indptr[i]
+    return indptr, _uint32_array(column for _, column in edges)
+
+
+class AdjacencyIndexWriter:
+    """Собирает пары (субстанция, препарат) и пишет из них файл индекса"""
+
+    def __init__(self):
+        self.pairs = set()
+
+    def add(self, substance_name: str, preparation_trade_name: str):
+        if substance_name and preparation_trade_name:
+            self.pairs.add((substance_name.encode('utf-8'), preparation_trade_name.encode('utf-8')))
+
+    def write(self, path: str, session_id: int) -> int:
+        """Пишет индекс атомарно (через временный файл), возвращает размер файла"""
+        substances = sorted({s for s, _ in self.pairs})
+        preparations = sorted({p for _, p in self.pairs})
+        substance_ids = {name: i for i, name in enumerate(substances)}
+        preparation_ids = {name: i for i, name in enumerate(preparations)}
+
+        edges = sorted((substance_ids[s], preparation_ids[p]) for s, p in self.pairs)
+        s2p_indptr, s2p_indices = _csr(len(substances), edges)
+        p2s_indptr, p2s_indices = _csr(len(preparations), sorted((p, s) for s, p in edges))
+
+        substance_offsets, substance_blob = _string_table(substances)
+        preparation_offsets, preparation_blob = _string_table(preparations)
+
+        sections = [
+            _to_little_endian(substance_offsets), substance_blob,
+            _to_little_endian(preparation_offsets), preparation_blob,
+            _to_little_endian(s2p_indptr), _to_little_endian(s2p_indices),
+            _to_little_endian(p2s_indptr), _to_little_endian(p2s_indices),
+        ]
+
+        # секции выравниваются по 8 байт
+        layout = []
+        offset = HEADER.size
+        for data in sections:
+            offset += -offset % 8
+            layout.extend((offset, len(data)))
+            offset += len(data)
+
+        header = HEADER.pack(MAGIC, session_id, len(substances), len(preparations), len(edges), *layout)
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            for data, section_offset in zip(sections, layout[::2]):
+                f.write(b'\0' * (section_offset - f.tell()))
+                f.write(data)
+            size = f.tell()
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        logger.info(f"Индекс связей записан: {path} ({len(substances)} субстанций, "
+                    f"{len(preparations)} препаратов, {len(edges)} связей, {size} байт)")
+        return size
+
+
+class AdjacencyIndex:
+    """
+    Только для чтения. Файл отображается в память, данные читаются прямо из страниц кеша ОС,
+    поэтому один файл, открытый в нескольких процессах, занимает память один раз
+    """
+
+    def __init__(self, path: str):
+        if sys.byteorder != 'little':
+            raise RuntimeError("Индекс связей читается только на little-endian платформах")
+
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffer = memoryview(self._mmap)
+
+        fields = HEADER.unpack_from(self._buffer)
+        if fields[0] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} не является индексом связей")
+
+        self.session_id, self.substance_count, self.preparation_count, self.edge_count = fields[1:5]
+        layout = fields[5:]
+        views = {}
+        for i, name in enumerate(SECTIONS):
+            offset, length = layout[2 * i], layout[2 * i + 1]
+            view = self._buffer[offset:offset + length]
+            views[name] = view if name.endswith('_blob') else view.cast('I')
+        self._views = views
+
+    @classmethod
+    def open_current(cls, index_dir: str = DEFAULT_INDEX_DIR) -> Optional['AdjacencyIndex']:
+        """Открывает индекс, на который указывает CURRENT, или возвращает None"""
+        pointer = os.path.join(index_dir, CURRENT_POINTER)
+        if not os.path.exists(pointer):
+            return None
+        with open(pointer, 'r', encoding='utf-8') as f:
+            return cls(os.path.join(index_dir, f.read().strip()))
+
+    def close(self):
+        for view in getattr(self, '_views', {}).values():
+            view.release()
+        self._views = {}
+        self._buffer.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _name(self, table: str, i: int) -> str:
+        offsets = self._views[f'{table}_offsets']
+        return bytes(self._views[f'{table}_blob'][offsets[i]:offsets[i + 1]]).decode('utf-8')
+
+    def _find(self, table: str, count: int, name: str) -> Optional[int]:
+        """Двоичный поиск строки в отсортированной таблице"""
+        offsets = self._views[f'{table}_offsets']
+        blob = self._views[f'{table}_blob']
+        key = name.encode('utf-8')
+
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if blob[offsets[middle]:offsets[middle + 1]].tobytes() < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < count and blob[offsets[low]:offsets[low + 1]].tobytes() == key:
+            return low
+        return None
+
+    def _neighbours(self, direction: str, row: Optional[int], table: str) -> List[str]:
+        if row is None:
+            return []
+        indptr = self._views[f'{direction}_indptr']
+        indices = self._views[f'{direction}_indices']
+        return [self._name(table, column) for column in indices[indptr[row]:indptr[row + 1]]]
+
+    def preparations_for(self, substance_name: str) -> List[str]:
+        """Торговые названия актуальных препаратов, содержащих субстанцию"""
+        row = self._find('substance', self.substance_count, substance_name)
+        return self._neighbours('s2p', row, 'preparation')
+
+    def substances_for(self, preparation_trade_name: str) -> List[str]:
+        """Субстанции, входящие в актуальный препарат"""
+        row = self._find('preparation', self.preparation_count, preparation_trade_name)
+        return self._neighbours('p2s', row, 'substance')
+
+
+def index_path(session_id: int, index_dir: str = DEFAULT_INDEX_DIR) -> str:
+    return os.path.join(index_dir, f"adjacency_{session_id}.idx")
+
+
+def set_current(path: str, keep: int = 2):
+    """Делает индекс текущим и удаляет старые, оставляя keep последних"""
+    index_dir = os.path.dirname(path)
+    pointer = os.path.join(index_dir, CURRENT_POINTER)
+    tmp_pointer = f"{pointer}.tmp"
+    with open(tmp_pointer, 'w', encoding='utf-8') as f:
+        f.write(os.path.basename(path))
+    os.replace(tmp_pointer, pointer)
+
+    # уже открытые читатели продолжают работать со старым файлом и после удаления
+    files = sorted(glob.glob(os.path.join(index_dir, 'adjacency_*.idx')),
+                   key=lambda p: int(os.path.basename(p)[len('adjacency_'):-len('.idx')]))
+    for old_path in files[:-keep]:
+        if old_path != path:
+            os.remove(old_path)
@@ -0,0 +1,243 @@
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from config.logging import get_logger, StageCounters
+
+logger = get_logger(__name__)
+
+DEFAULT_STORE_DIR = "./app/parsers/data/store"
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+# Профили запусков (app/profiling.py) хранятся рядом с объектами и входят в бюджет хранилища
+PROFILES_SUBDIR = 'profiles'
+
+
+def _disk_size(path: str) -> int:
+    """Размер файла или всех файлов директории"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(dirpath, name))
+               for dirpath, _, names in os.walk(path) for name in names)
+
+
+class ArtifactStore:
+    """
+    Хранилище скачанных архивов и рабочих Excel файлов, адресуемое по SHA-256 содержимого.
+
+    Одинаковые файлы хранятся один раз. Индекс (index.json) хранит метаданные артефактов
+    и их связь с сессиями анализа, объем на диске ограничивается вытеснением
+    давно не использованных артефактов (LRU).
+    """
+
+    def __init__(self, root: str = DEFAULT_STORE_DIR, max_bytes: Optional[int] = None):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.index_path = os.path.join(root, 'index.json')
+        self.lock_path = os.path.join(root, 'index.lock')
+        self.max_bytes = max_bytes or int(os.getenv('ARTIFACT_STORE_MAX_BYTES', DEFAULT_MAX_BYTES))
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    @contextmanager
+    def _index(self, write: bool = True):
+        """Открывает индекс под файловой блокировкой и сохраняет его после изменений"""
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            try:
+                index = {'artifacts': {}, 'sessions': {}}
+                if os.path.exists(self.index_path):
+                    with open(self.index_path, 'r', encoding='utf-8') as f:
+                        index = json.load(f)
+
+                yield index
+
+                if write:
+                    tmp_path = f"{self.index_path}.tmp"
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        json.dump(index, f, ensure_ascii=False, indent=2)
+                    os.replace(tmp_path, self.index_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+        """Считает SHA-256 файла потоково"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _object_path(self, sha256: str, extension: str) -> str:
+        return os.path.join(self.objects_dir, sha256[:2], f"{sha256}{extension}")
+
+    def put(self, path: str, kind: str, move: bool = True, original_name: Optional[str] = None) -> Dict:
+        """
+        Кладет файл в хранилище и возвращает запись артефакта.
+        Если такое содержимое уже есть, новый файл не сохраняется
+        """
+        sha256 = self.file_sha256(path)
+        original_name = original_name or os.path.basename(path)
+        object_path = self._object_path(sha256, os.path.splitext(original_name)[1].lower())
+        now = datetime.now().isoformat()
+
+        with self._index() as index:
+            artifact = index['artifacts'].get(sha256)
+
+            if artifact and os.path.exists(artifact['path']):
+                if move:
+                    os.remove(path)
+                artifact['last_access'] = now
+                logger.info(f"Артефакт уже есть в хранилище: {original_name} ({sha256[:12]})")
+                return dict(artifact)
+
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            if move:
+                shutil.move(path, object_path)
+            else:
+                shutil.copy2(path, object_path)
+
+            artifact = {
+                'sha256': sha256,
+                'kind': kind,
+                'path': object_path,
+                'original_name': original_name,
+                'size': os.path.getsize(object_path),
+                'created_at': now,
+                'last_access': now,
+                'derived': {},
+            }
+            index['artifacts'][sha256] = artifact
+
+        logger.info(f"Артефакт сохранен: {original_name} ({sha256[:12]}, {artifact['size'] / (1024 * 1024):.2f} MB)")
+        return dict(artifact)
+
+    def get(self, sha256: str) -> Optional[Dict]:
+        """Возвращает запись артефакта и отмечает обращение к нему"""
+        with self._index() as index:
+            artifact = index['artifacts'].get(sha256)
+            if not artifact or not os.path.exists(artifact['path']):
+                return None
+            artifact['last_access'] = datetime.now().isoformat()
+            return dict(artifact)
+
+    def set_derived(self, sha256: str, name: str, derived_sha256: str):
+        """Запоминает артефакт, полученный из другого (например, Excel файл из архива)"""
+        with self._index() as index:
+            if sha256 in index['artifacts']:
+                index['artifacts'][sha256].setdefault('derived', {})[name] = derived_sha256
+
+    def link_session(self, session_id: int, *sha256s: str):
+        """Связывает артефакты с сессией анализа"""
+        with self._index() as index:
+            linked = index['sessions'].setdefault(str(session_id), [])
+            for sha256 in sha256s:
+                if sha256 and sha256 not in linked:
+                    linked.append(sha256)
+
+    def link_session_path(self, session_id: int, path: str):
+        """Связывает с сессией файл или директорию вне хранилища объектов (например, профиль запуска)"""
+        with self._index() as index:
+            linked = index.setdefault('session_paths', {}).setdefault(str(session_id), [])
+            if path not in linked:
+                linked.append(path)
+
+    def paths_for_session(self, session_id: int) -> List[str]:
+        """Возвращает файлы и директории, связанные с сессией через link_session_path"""
+        with self._index(write=False) as index:
+            return list(index.get('session_paths', {}).get(str(session_id), []))
+
+    def artifacts_for_session(self, session_id: int) -> List[Dict]:
+        """Возвращает артефакты, использованные в сессии анализа"""
+        with self._index(write=False) as index:
+            return [
+                dict(index['artifacts'][sha256])
+                for sha256 in index['sessions'].get(str(session_id), [])
+                if sha256 in index['artifacts']
+            ]
+
+    def list_artifacts(self, kind: Optional[str] = None) -> List[Dict]:
+        """Возвращает артефакты, от новых к старым"""
+        with self._index(write=False) as index:
+            artifacts = [dict(a) for a in index['artifacts'].values() if kind is None or a['kind'] == kind]
+        return sorted(artifacts, key=lambda a: a['created_at'], reverse=True)
+
+    def _linked_paths(self, index: Dict) -> Dict[str, Dict]:
+        """
+        Файлы и директории вне хранилища объектов, которые тоже входят в бюджет: связанные
+        с сессиями (session_paths) и профили запусков, в том числе не связанные с сессией.
+        Время последнего обращения - время изменения на диске
+        """
+        paths = [path for linked in index.get('session_paths', {}).values() for path in linked]
+        profiles_dir = os.path.join(self.root, PROFILES_SUBDIR)
+        if os.path.isdir(profiles_dir):
+            paths += [os.path.join(profiles_dir, name) for name in os.listdir(profiles_dir)]
+
+        entries = {}
+        for path in paths:
+            key = os.path.abspath(path)
+            if key in entries or not os.path.exists(path):
+                continue
+            entries[key] = {
+                'path': path,
+                'size': _disk_size(path),
+                'last_access': datetime.fromtimestamp(os.path.getmtime(path)).isoformat(),
+            }
+        return entries
+
+    def enforce_budget(self, max_bytes: Optional[int] = None, keep: Iterable[str] = ()) -> List[str]:
+        """
+        Вытесняет давно не использованные артефакты, профили и файлы сессий, пока объем
+        хранилища больше бюджета. Артефакты (SHA-256) и пути из keep не удаляются.
+        Возвращает SHA-256 удаленных артефактов и пути удаленных файлов
+        """
+        max_bytes = max_bytes or self.max_bytes
+        keep = set(keep)
+        removed = []
+        counters = StageCounters(logger, 'artifact_store_eviction')
+
+        with self._index() as index:
+            artifacts = index['artifacts']
+
+            # записи без файлов на диске
+            for sha256 in [s for s, a in artifacts.items() if not os.path.exists(a['path'])]:
+                del artifacts[sha256]
+                counters.incr('missing')
+
+            candidates = [(sha256, artifact) for sha256, artifact in artifacts.items()]
+            candidates += list(self._linked_paths(index).items())
+
+            total = sum(entry['size'] for _, entry in candidates)
+            for key, entry in sorted(candidates, key=lambda c: c[1]['last_access']):
+                if total <= max_bytes:
+                    break
+                if key in keep or entry['path'] in keep:
+                    continue
+
+                if os.path.isdir(entry['path']):
+                    shutil.rmtree(entry['path'])
+                else:
+                    os.remove(entry['path'])
+                total -= entry['size']
+                removed.append(key if key in artifacts else entry['path'])
+                counters.incr('evicted')
+                counters.incr('freed_bytes', entry['size'])
+
+            for sha256 in [s for s in removed if s in artifacts]:
+                del artifacts[sha256]
+            for session_id, linked in list(index['sessions'].items()):
+                index['sessions'][session_id] = [s for s in linked if s in artifacts]
+            session_paths = index.get('session_paths', {})
+            for session_id, linked in list(session_paths.items()):
+                session_paths[session_id] = [path for path in linked if os.path.exists(path)]
+                if not session_paths[session_id]:
+                    del session_paths[session_id]
+
+        counters.incr('total_bytes', total)
+        counters.log_summary()
+        return removed
@@ -1,38 +1,104 @@
+import os
+
+from celery import chord
+
 from config.celery import celery_app
 from config.logging import get_logger
 
 
 logger = get_logger(__name__)
 
+PIPELINE_FLIGHT = 'full_medical_pipeline'
+# Повторный вызов ждет результат текущего запуска повторами задачи, а не занятым воркером
+PIPELINE_FOLLOWER_RETRY_DELAY = 60
+PIPELINE_FOLLOWER_MAX_RETRIES = 4 * 60
 
-@celery_app.task
-def full_medical_pipeline_task():
-    """Полный пайплайн, включает в себя скачивание архива, анализ файлов, сохранение результатов в БД"""
+
+@celery_app.task(bind=True, max_retries=PIPELINE_FOLLOWER_MAX_RETRIES)
+def full_medical_pipeline_task(self, profile=False, attach_to=None):
+    """
+    Полный пайплайн, включает в себя скачивание архива, анализ файлов, сохранение результатов в БД.
+    Одновременно выполняется только один запуск, повторный вызов получает результат текущего:
+    пока его нет, задача повторяется через PIPELINE_FOLLOWER_RETRY_DELAY секунд (attach_to - кого ждем).
+    profile=True - снять профиль CPU и памяти этого запуска (full_medical_pipeline_task.delay(profile=True))
+    """
+    from app.services.single_flight import SingleFlight
+
+    result = SingleFlight(PIPELINE_FLIGHT).run(
+        lambda: _run_profiled_pipeline(profile, lock_token=self.request.id),
+        run_id=self.request.id, attach_to=attach_to
+    )
+
+    if result.get('status') == SingleFlight.PENDING:
+        holder = result['attached_to']
+        if self.request.retries >= self.max_retries:
+            return {'status': 'error', 'error': f'Не дождались результата запуска {holder}', 'attached_to': holder}
+        logger.info(f"Запуск {holder} еще идет, ждем его результат повтором через {PIPELINE_FOLLOWER_RETRY_DELAY} с")
+        raise self.retry(kwargs={'profile': profile, 'attach_to': holder}, countdown=PIPELINE_FOLLOWER_RETRY_DELAY)
+
+    return result
+
+
+def _run_profiled_pipeline(profile=False, lock_token=None):
+    """Запускает пайплайн под профилировщиком и связывает профиль с записанной сессией"""
+    from app.profiling import profile_run
+
+    with profile_run(profile, 'full_medical_pipeline') as capture:
+        result = _run_medical_pipeline(lock_token)
+
+    if capture is not None:
+        try:
+            capture.link_session(result.get('session_id'))
+        except Exception as e:
+            # исключение здесь сняло бы блокировку, переданную аккорду (HANDOFF)
+            logger.error(f"Не удалось связать профиль с сессией: {e}")
+        result['profile_dir'] = capture.output_dir
+    return result
+
+
+def _run_medical_pipeline(lock_token=None):
+    """
+    Скачивание архива, анализ файла и сохранение в БД.
+    lock_token - блокировка SingleFlight запуска: при записи аккордом ее снимает finalize_session_task
+    """
     logger.info("Начинаем основной пайплайн")
     try:
-        from app.parsers.archive_parser import ArchiveParser
-        from app.parsers.medical_parser import MedicalParser
-        from app.database.postgres_handler import PostgresHandler
+        from app import worker_state
 
         # 1. Скачиваем архив
-        archive_parser = ArchiveParser()
+        archive_parser = worker_state.get_archive_parser()
         download_result = archive_parser.download_archive()
         logger.info('Скачиваем архив')
 
         # 2. Анализируем файл
         if download_result['status'] == 'success' and download_result['operating_file']:
             logger.info('Архив скачан')
-            medical_parser = MedicalParser()
+            medical_parser = worker_state.get_medical_parser()
             analysis_result = medical_parser.analyze_substances_and_consumers(
                 download_result['operating_file']
             )
             logger.info('Анализируем файл')
 
             # 3. Сохраняем в БД
-            db_handler = PostgresHandler()
+            db_handler = worker_state.get_db_handler()
+            shard_tasks = int(os.getenv('PERSIST_SHARD_TASKS', '0'))
+            if shard_tasks > 1:
+                # шарды пишут разные воркеры, сессию завершает callback аккорда;
+                # срез лежит в БД, поэтому воркерам не нужна общая файловая система
+                session_id = db_handler.begin_session(analysis_result)
+                db_handler.save_session_snapshot(session_id, analysis_result)
+                _link_session_files(archive_parser, download_result, session_id)
+                return _dispatch_shard_chord(session_id, shard_tasks, lock_token)
+
             session_id = db_handler.save_analysis_result(analysis_result)
             logger.info('Сохраняем в БД')
 
+            # 4. Связываем входные файлы с сессией
+            _link_session_files(archive_parser, download_result, session_id)
+
+            # 5. Выгружаем срез реестра для потребителей и строим индекс связей
+            _after_session_saved()
+
             return {'status': 'success', 'session_id': session_id}
 
         logger.warning('Файл не найден')
@@ -44,6 +110,136 @@ def full_medical_pipeline_task():
         return {'status': 'error', 'error': str(e)}
 
 
+def _link_session_files(archive_parser, download_result, session_id):
+    """Связывает скачанный архив и Excel файл с сессией в хранилище артефактов"""
+    archive_parser.store.link_session(
+        session_id, download_result['archive_sha256'], download_result['workbook_sha256']
+    )
+
+
+def _dispatch_shard_chord(session_id, shard_tasks, lock_token):
+    """
+    Запускает аккорд записи шардами. После отправки аккорда пайплайн больше ничего не делает:
+    блокировку запуска снимет finalize_session_task, поэтому результат сразу помечается HANDOFF
+    """
+    from app.services.single_flight import SingleFlight
+
+    chord(
+        persist_shard_task.s(session_id, shard, shard_tasks, lock_token)
+        for shard in range(shard_tasks)
+    )(finalize_session_task.s(session_id, shard_tasks, lock_token))
+    logger.info(f"Запущена запись сессии {session_id} шардами ({shard_tasks})")
+
+    # блокировка пайплайна держится до конца аккорда
+    return {'status': 'success', 'session_id': session_id, 'shards': shard_tasks,
+            SingleFlight.HANDOFF: lock_token is not None}
+
+
+def _after_session_saved():
+    """Задачи, которые запускаются после записи очередной сессии"""
+    export_current_snapshot_task.delay()
+    build_adjacency_index_task.delay()
+
+
+@celery_app.task(bind=True, max_retries=3, default_retry_delay=30)
+def persist_shard_task(self, session_id, shard, n_shards, lock_token=None):
+    """Пишет в БД один шард среза сессии. Повтор продолжает шард с первой незаписанной пачки"""
+    logger.info(f"Записываем шард {shard}/{n_shards} сессии {session_id}")
+    try:
+        from app import worker_state
+
+        if lock_token:
+            from app.services.single_flight import SingleFlight
+            SingleFlight(PIPELINE_FLIGHT).hold(lock_token)
+
+        db_handler = worker_state.get_db_handler()
+        analysis_result = db_handler.load_session_snapshot(session_id)
+        changes = db_handler.persist_shard(session_id, analysis_result, shard, n_shards)
+        return {'status': 'success', 'shard': shard, 'changes': changes}
+
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e)
+        logger.error(f"Ошибка при записи шарда {shard}/{n_shards} сессии {session_id}: {e}")
+        return {'status': 'error', 'shard': shard, 'error': str(e)}
+
+
+@celery_app.task
+def finalize_session_task(shard_results, session_id, n_shards, lock_token=None):
+    """
+    Callback аккорда: завершает сессию, только если все шарды записаны успешно.
+    Затем публикует результат запуска пайплайна и снимает его блокировку
+    """
+    result = _finalize_sharded_session(shard_results, session_id, n_shards)
+    if lock_token:
+        try:
+            from app.services.single_flight import SingleFlight
+            SingleFlight(PIPELINE_FLIGHT).complete(lock_token, result)
+        except Exception as e:
+            logger.error(f"Не удалось снять блокировку пайплайна {lock_token}: {e}")
+    return result
+
+
+def _finalize_sharded_session(shard_results, session_id, n_shards):
+    failed = [r['shard'] for r in shard_results if r.get('status') != 'success']
+    if failed:
+        logger.error(f"Сессия {session_id} не завершена, не записаны шарды: {failed}")
+        return {'status': 'error', 'session_id': session_id, 'failed_shards': failed}
+
+    try:
+        from app import worker_state
+
+        db_handler = worker_state.get_db_handler()
+        analysis_result = db_handler.load_session_snapshot(session_id)
+        db_handler.finalize_session(session_id, analysis_result, n_shards)
+        _after_session_saved()
+
+        changes = sum(r['changes'] for r in shard_results)
+        logger.info(f"Сессия {session_id} записана шардами ({n_shards}), изменений - {changes}")
+        return {'status': 'success', 'session_id': session_id, 'changes': changes}
+
+    except Exception as e:
+        logger.error(f"Ошибка при завершении сессии {session_id}: {e}")
+        return {'status': 'error', 'session_id': session_id, 'error': str(e)}
+
+
+@celery_app.task
+def export_current_snapshot_task(formats=('csv', 'parquet')):
+    """Выгружает актуальный срез реестра в сжатый CSV и Parquet с манифестом сессии"""
+    logger.info("Начинаем выгрузку среза реестра")
+    try:
+        from app import worker_state
+
+        manifest = worker_state.get_db_handler().export_current_snapshot(formats=formats)
+        return {'status': 'success', 'session_id': manifest['session_id'], 'tables': manifest['tables']}
+
+    except Exception as e:
+        logger.error(f"Ошибка при выгрузке среза реестра: {e}")
+        return {'status': 'error', 'error': str(e)}
+
+
+@celery_app.task
+def build_adjacency_index_task():
+    """Строит файл индекса связей субстанций и препаратов для последней сессии"""
+    logger.info("Начинаем построение индекса связей")
+    try:
+        from app import worker_state
+
+        index = worker_state.get_db_handler().build_adjacency_index()
+        return {'status': 'success', **index}
+
+    except Exception as e:
+        logger.error(f"Ошибка при построении индекса связей: {e}")
+        return {'status': 'error', 'error': str(e)}
+
+
+@celery_app.task
+def worker_latency_stats_task():
+    """Время холодных и теплых запусков задач в процессе, выполнившем эту задачу"""
+    from app import worker_state
+    return worker_state.latency_stats()
+
+
 @celery_app.task
 def simple_test_task():
     """Простая задача"""
@@ -52,17 +248,16 @@ def simple_test_task():
 
 @celery_app.task
 def cleanup_old_files_task():
-    """Очищает старые файлы и записи в БД"""
+    """Очищает хранилище скачанных архивов и Excel файлов до бюджета по объему"""
     logger.info("Начинаем очистку старых файлов")
     try:
-        from app.database.postgres_handler import PostgresHandler
+        from app.storage.artifact_store import ArtifactStore
 
-        handler = PostgresHandler()
-        handler.cleanup_old_files(days_to_keep=30)
+        removed = ArtifactStore().enforce_budget()
 
         logger.info("Очистка старых файлов завершена")
-        return {'status': 'success', 'message': 'Old files cleaned up'}
+        return {'status': 'success', 'message': 'Old files cleaned up', 'removed': len(removed)}
 
     except Exception as e:
         logger.error(f"Ошибка при очистке файлов: {e}")
-        return {'status': 'error', 'error': str(e)}
\ No newline at end of file
+        return {'status': 'error', 'error': str(e)}
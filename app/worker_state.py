@@ -0,0 +1,118 @@
+"""
+Состояние процесса воркера Celery: тяжелые модули импортируются в родительском процессе
+до fork, а парсеры, HTTP сессия и пул соединений с БД создаются один раз на дочерний
+процесс и переиспользуются всеми задачами этого процесса.
+"""
+import os
+import time
+import importlib
+import threading
+from typing import Dict
+
+from config.logging import get_logger
+
+logger = get_logger(__name__)
+
+PRELOAD_MODULES = (
+    'pandas',
+    'openpyxl',
+    'bs4',
+    'psycopg2',
+    'app.parsers.archive_parser',
+    'app.parsers.medical_parser',
+    'app.database.postgres_handler',
+)
+
+_state: Dict = {}
+_lock = threading.Lock()
+_latency = {'cold': [0, 0.0], 'warm': [0, 0.0]}  # вид запуска -> [число задач, суммарное время]
+_task_started: Dict[str, float] = {}
+
+
+def preload_modules():
+    """Импортирует тяжелые модули, вызывается в родительском процессе до fork"""
+    started = time.monotonic()
+    for module in PRELOAD_MODULES:
+        importlib.import_module(module)
+    logger.info(f"Модули загружены заранее за {time.monotonic() - started:.2f} с")
+
+
+def _get(name: str, factory):
+    with _lock:
+        if name not in _state:
+            _state[name] = factory()
+        return _state[name]
+
+
+def get_archive_parser():
+    """ArchiveParser процесса, с общей HTTP сессией"""
+    from app.parsers.archive_parser import ArchiveParser
+    return _get('archive_parser', ArchiveParser)
+
+
+def get_medical_parser():
+    """MedicalParser процесса, словарь субстанций загружается один раз"""
+    from app.parsers.medical_parser import MedicalParser
+    return _get('medical_parser', MedicalParser)
+
+
+def get_db_handler():
+    """PostgresHandler процесса с пулом соединений"""
+    from app.database.postgres_handler import PostgresHandler
+    pool_size = int(os.getenv('DB_POOL_SIZE', '4'))
+    return _get('db_handler', lambda: PostgresHandler(pool_size=pool_size))
+
+
+def init_process_state():
+    """Создает переиспользуемые объекты в новом дочернем процессе"""
+    started = time.monotonic()
+    _state.clear()
+    get_archive_parser()
+    get_medical_parser()
+    try:
+        get_db_handler()
+    except Exception as e:
+        # БД может быть еще недоступна - пул создастся при первой задаче
+        logger.warning(f"Пул соединений не создан при старте процесса: {e}")
+    logger.info(f"Состояние процесса {os.getpid()} готово за {time.monotonic() - started:.2f} с")
+
+
+def close_process_state():
+    """Освобождает ресурсы процесса при его остановке"""
+    db_handler = _state.pop('db_handler', None)
+    if db_handler:
+        db_handler.close()
+    archive_parser = _state.pop('archive_parser', None)
+    if archive_parser:
+        archive_parser.session.close()
+    _state.clear()
+
+
+def task_started(task_id: str):
+    _task_started[task_id] = time.monotonic()
+
+
+def task_finished(task_id: str, task_name: str):
+    """Учитывает время задачи как холодное (первая задача процесса) или теплое"""
+    started = _task_started.pop(task_id, None)
+    if started is None:
+        return
+
+    duration = time.monotonic() - started
+    kind = 'cold' if _latency['cold'][0] == 0 else 'warm'
+    _latency[kind][0] += 1
+    _latency[kind][1] += duration
+
+    cold_count, cold_total = _latency['cold']
+    warm_count, warm_total = _latency['warm']
+    warm_avg = f"{warm_total / warm_count:.2f} с" if warm_count else "n/a"
+    logger.info(f"Задача {task_name} ({kind}): {duration:.2f} с; "
+                f"холодный старт {cold_total / max(cold_count, 1):.2f} с, теплый в среднем {warm_avg}")
+
+
+def latency_stats() -> Dict:
+    """Время холодных и теплых запусков задач процесса"""
+    return {
+        kind: {'tasks': count, 'avg_seconds': total / count if count else None}
+        for kind, (count, total) in _latency.items()
+    }
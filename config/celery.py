@@ -1,7 +1,9 @@
 import os
-from celery import Celery
+from celery import Celery, signals
 from celery.schedules import crontab
 
+from config.logging import setup_logging
+
 celery_app = Celery('medical_parser')
 celery_app.conf.update(
     broker_url=os.getenv('CELERY_BROKER_URL'),
@@ -14,4 +16,41 @@ celery_app.conf.update(
             'schedule': crontab(hour=9, minute=40),  # каждый день в 9:00
         },
     },
-)
\ No newline at end of file
+)
+
+
+@signals.setup_logging.connect
+def configure_logging(**kwargs):
+    """Не даем Celery заменить наше логирование через очередь своим синхронным хендлером"""
+    setup_logging()
+
+
+@signals.worker_init.connect
+def preload_worker_modules(**kwargs):
+    """Импортируем тяжелые модули в родительском процессе, дочерние получат их через fork"""
+    from app import worker_state
+    worker_state.preload_modules()
+
+
+@signals.worker_process_init.connect
+def init_worker_process(**kwargs):
+    from app import worker_state
+    worker_state.init_process_state()
+
+
+@signals.worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    from app import worker_state
+    worker_state.close_process_state()
+
+
+@signals.task_prerun.connect
+def track_task_start(task_id=None, **kwargs):
+    from app import worker_state
+    worker_state.task_started(task_id)
+
+
+@signals.task_postrun.connect
+def track_task_finish(task_id=None, task=None, **kwargs):
+    from app import worker_state
+    worker_state.task_finished(task_id, task.name if task else 'unknown')
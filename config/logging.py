@@ -1,28 +1,173 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import os
+import queue
 import sys
+import threading
+import time
+from collections import Counter
 
 
-def setup_logging():
-    """Базовая настройка логирования"""
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # text | json
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_RATE_LIMIT_PERIOD = float(os.getenv('LOG_RATE_LIMIT_PERIOD', '60'))
+LOG_RATE_LIMIT_BURST = int(os.getenv('LOG_RATE_LIMIT_BURST', '10'))
+
+_listener = None
+_rate_limit_filter = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись лога в одну JSON строку"""
+
+    def format(self, record):
+        payload = {
+            'ts': self.formatTime(record, self.datefmt),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for field in ('stage', 'counters', 'suppressed'):
+            if hasattr(record, field):
+                payload[field] = getattr(record, field)
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Ограничивает повторяющиеся сообщения с одного места вызова:
+    не более burst записей за period секунд, остальные только считаются.
+    Итоги этапов (StageCounters) не ограничиваются: все они пишутся из одной строки
+    log_summary, а каждый итог - уже сводка вместо множества сообщений
+    """
+
+    def __init__(self, period: float = 60.0, burst: int = 10):
+        super().__init__()
+        self.period = period
+        self.burst = burst
+        self._state = {}  # (logger, файл, строка) -> [начало окна, пропущено, подавлено]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.CRITICAL or hasattr(record, 'counters'):
+            return True
+
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+
+        with self._lock:
+            state = self._state.get(key)
+            if state is None or now - state[0] >= self.period:
+                suppressed = state[2] if state else 0
+                self._state[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f"{record.getMessage()} (подавлено похожих сообщений: {suppressed})"
+                    record.args = None
+                    record.suppressed = suppressed
+                return True
+
+            if state[1] < self.burst:
+                state[1] += 1
+                return True
+
+            state[2] += 1
+            return False
+
+    def pop_suppressed(self):
+        """Возвращает и обнуляет счетчики подавленных сообщений"""
+        with self._lock:
+            result = {key: state[2] for key, state in self._state.items() if state[2]}
+            self._state.clear()
+        return result
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполнении очереди отбрасывает запись вместо ожидания"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StageCounters:
+    """
+    Счетчики событий этапа пайплайна вместо записи в лог по каждому элементу
+    Использовать:
+        counters = StageCounters(logger, 'cleanup')
+        counters.incr('deleted_files')
+        counters.log_summary()
+    """
+
+    def __init__(self, logger: logging.Logger, stage: str):
+        self.logger = logger
+        self.stage = stage
+        self.counts = Counter()
+
+    def incr(self, event: str, amount: int = 1):
+        self.counts[event] += amount
 
-    # форматтер
-    formatter = logging.Formatter(
+    def log_summary(self, level: int = logging.INFO):
+        if not self.counts:
+            return
+        summary = ', '.join(f"{event}={count}" for event, count in sorted(self.counts.items()))
+        self.logger.log(level, f"Итоги этапа {self.stage}: {summary}",
+                        extra={'stage': self.stage, 'counters': dict(self.counts)})
+
+
+def _build_formatter():
+    if LOG_FORMAT == 'json':
+        return JsonFormatter(datefmt='%Y-%m-%dT%H:%M:%S')
+    return logging.Formatter(
         '%(asctime)s | %(name)-25s | %(levelname)-8s | %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'
     )
 
-    # хендлер в консоль
+
+def setup_logging():
+    """
+    Базовая настройка логирования: записи кладутся в очередь,
+    в stdout их пишет фоновый поток QueueListener
+    """
+    stop_logging()
+    _start_logging()
+
+
+def _start_logging():
+    """Создает новые очередь, фильтр и слушателя и подключает их к корневому логгеру"""
+    global _listener, _rate_limit_filter
+
+    # хендлер в консоль, работает в фоновом потоке
     console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setFormatter(formatter)
+    console_handler.setFormatter(_build_formatter())
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(log_queue, console_handler, respect_handler_level=True)
+    _listener.start()
+
+    # хендлер в очередь, работает в вызывающем потоке и никогда не ждет
+    _rate_limit_filter = RateLimitFilter(LOG_RATE_LIMIT_PERIOD, LOG_RATE_LIMIT_BURST)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(_rate_limit_filter)
 
     # корневой логгер
     root_logger = logging.getLogger()
-    root_logger.setLevel(logging.INFO)
+    root_logger.setLevel(LOG_LEVEL)
 
     for handler in root_logger.handlers[:]:
         root_logger.removeHandler(handler)
 
-    root_logger.addHandler(console_handler)
+    root_logger.addHandler(queue_handler)
 
     # убираем лишнее
     logging.getLogger('celery').setLevel(logging.WARNING)
@@ -30,6 +175,38 @@ def setup_logging():
     logging.getLogger('requests').setLevel(logging.WARNING)
 
 
+def stop_logging():
+    """Дописывает накопленные записи и останавливает фоновый поток"""
+    global _listener
+
+    if _rate_limit_filter is not None:
+        suppressed = _rate_limit_filter.pop_suppressed()
+        if suppressed:
+            total = sum(suppressed.values())
+            logging.getLogger(__name__).warning(
+                f"Подавлено повторяющихся сообщений: {total} (мест вызова: {len(suppressed)})"
+            )
+
+    if _listener is not None:
+        # после fork поток слушателя остается в родительском процессе
+        if _listener._thread is not None and _listener._thread.is_alive():
+            _listener.stop()
+        _listener = None
+
+
+def _reinit_logging_after_fork():
+    """
+    В дочернем процессе объекты родителя не трогаем: их блокировки мог держать другой
+    поток родителя в момент fork, а подавленные сообщения родителя уже не наши.
+    Просто забываем их и поднимаем логирование заново
+    """
+    global _listener, _rate_limit_filter
+
+    _listener = None
+    _rate_limit_filter = None
+    _start_logging()
+
+
 def get_logger(name):
     """
     Получить логгер с указанным именем
@@ -39,4 +216,7 @@ def get_logger(name):
 
 
 # инициализация
-setup_logging()
\ No newline at end of file
+setup_logging()
+atexit.register(stop_logging)
+# в дочерних процессах (prefork Celery, пулы процессов) поток слушателя нужно поднять заново
+os.register_at_fork(after_in_child=_reinit_logging_after_fork)
@@ -0,0 +1,12 @@
+import os
+from typing import Optional
+
+import redis
+
+
+def get_redis_client(redis_url: Optional[str] = None) -> redis.Redis:
+    """Возвращает клиент Redis, по умолчанию - брокер Celery"""
+    url = redis_url or os.getenv('REDIS_URL') or os.getenv('CELERY_BROKER_URL')
+    if not url:
+        raise ValueError("REDIS_URL / CELERY_BROKER_URL не установлен в .env")
+    return redis.Redis.from_url(url)
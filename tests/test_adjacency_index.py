@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+from app.storage.adjacency_index import AdjacencyIndex, AdjacencyIndexWriter, index_path, set_current
+
+
+def _write(index_dir, session_id, pairs):
+    writer = AdjacencyIndexWriter()
+    for substance_name, preparation_trade_name in pairs:
+        writer.add(substance_name, preparation_trade_name)
+    path = index_path(session_id, str(index_dir))
+    writer.write(path, session_id)
+    return path
+
+
+def test_lookups_in_both_directions(tmp_path):
+    path = _write(tmp_path, 1, [
+        ('Парацетамол', 'Панадол'),
+        ('Парацетамол', 'Колдрекс'),
+        ('Кофеин', 'Колдрекс'),
+        ('Ибупрофен', 'Нурофен'),
+        ('Парацетамол', 'Панадол'),
+        # пустые значения не попадают в индекс
+        ('Ибупрофен', ''),
+        (None, 'Нурофен'),
+    ])
+
+    with AdjacencyIndex(path) as index:
+        assert (index.session_id, index.substance_count, index.preparation_count, index.edge_count) == (1, 3, 3, 4)
+        assert index.preparations_for('Парацетамол') == ['Колдрекс', 'Панадол']
+        assert index.preparations_for('Ибупрофен') == ['Нурофен']
+        assert index.substances_for('Колдрекс') == ['Кофеин', 'Парацетамол']
+        # поиск точный: регистр и неизвестные названия не совпадают
+        assert index.preparations_for('парацетамол') == []
+        assert index.substances_for('Аспирин') == []
+
+
+def test_empty_index(tmp_path):
+    path = _write(tmp_path, 1, [])
+
+    with AdjacencyIndex(path) as index:
+        assert index.edge_count == 0
+        assert index.preparations_for('Парацетамол') == []
+
+
+def test_rejects_foreign_file(tmp_path):
+    path = tmp_path / 'adjacency_1.idx'
+    path.write_bytes(b'\0' * 1024)
+
+    with pytest.raises(ValueError):
+        AdjacencyIndex(str(path))
+
+
+def test_open_current_follows_pointer_and_keeps_last_indexes(tmp_path):
+    assert AdjacencyIndex.open_current(str(tmp_path)) is None
+
+    paths = []
+    for session_id in (1, 2, 10):
+        paths.append(_write(tmp_path, session_id, [('Парацетамол', f'Препарат {session_id}')]))
+        set_current(paths[-1])
+
+    with AdjacencyIndex.open_current(str(tmp_path)) as index:
+        assert index.session_id == 10
+        assert index.preparations_for('Парацетамол') == ['Препарат 10']
+    # номера сессий сравниваются как числа, а не как строки
+    assert not os.path.exists(paths[0])
+    assert os.path.exists(paths[1]) and os.path.exists(paths[2])
+
+
+def test_open_reader_survives_index_switch(tmp_path):
+    first = _write(tmp_path, 1, [('Парацетамол', 'Панадол')])
+    set_current(first)
+    reader = AdjacencyIndex.open_current(str(tmp_path))
+
+    for session_id in (2, 3):
+        set_current(_write(tmp_path, session_id, [('Парацетамол', 'Колдрекс')]))
+
+    # файл первой сессии удален, но уже открытый читатель его видит
+    assert not os.path.exists(first)
+    assert reader.preparations_for('Парацетамол') == ['Панадол']
+    reader.close()
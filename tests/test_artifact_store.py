@@ -0,0 +1,83 @@
+import os
+
+from app.storage.artifact_store import ArtifactStore, PROFILES_SUBDIR
+
+
+def _file(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(name.encode('utf-8') + b'\0' * (size - len(name)))
+    return str(path)
+
+
+def test_put_stores_same_content_once(tmp_path):
+    store = ArtifactStore(str(tmp_path / 'store'), max_bytes=10 ** 6)
+    first = store.put(_file(tmp_path, 'a.zip', 100), 'archive')
+    copy = tmp_path / 'copy.zip'
+    copy.write_bytes(open(first['path'], 'rb').read())
+    second = store.put(str(copy), 'archive')
+
+    assert second['sha256'] == first['sha256']
+    assert second['path'] == first['path']
+    # при move=True дубликат удаляется, а не копируется в хранилище
+    assert not copy.exists()
+    assert len(store.list_artifacts()) == 1
+
+
+def test_enforce_budget_evicts_least_recently_used_first(tmp_path):
+    store = ArtifactStore(str(tmp_path / 'store'), max_bytes=10 ** 6)
+    old = store.put(_file(tmp_path, 'old.zip', 100), 'archive')
+    middle = store.put(_file(tmp_path, 'middle.zip', 100), 'archive')
+    new = store.put(_file(tmp_path, 'new.xlsx', 100), 'workbook')
+    # обращение делает самый старый артефакт самым свежим
+    store.get(old['sha256'])
+    store.link_session(1, old['sha256'], middle['sha256'], new['sha256'])
+
+    removed = store.enforce_budget(max_bytes=150)
+
+    assert removed == [middle['sha256'], new['sha256']]
+    assert os.path.exists(old['path'])
+    assert not os.path.exists(middle['path']) and not os.path.exists(new['path'])
+    assert [a['sha256'] for a in store.artifacts_for_session(1)] == [old['sha256']]
+
+
+def test_enforce_budget_keeps_protected_artifacts(tmp_path):
+    store = ArtifactStore(str(tmp_path / 'store'), max_bytes=10 ** 6)
+    old = store.put(_file(tmp_path, 'old.zip', 100), 'archive')
+    new = store.put(_file(tmp_path, 'new.zip', 100), 'archive')
+
+    removed = store.enforce_budget(max_bytes=1, keep=[old['sha256']])
+
+    assert removed == [new['sha256']]
+    assert store.get(old['sha256']) is not None
+    assert store.get(new['sha256']) is None
+
+
+def test_enforce_budget_evicts_profiles_and_session_paths(tmp_path):
+    store = ArtifactStore(str(tmp_path / 'store'), max_bytes=10 ** 6)
+    profile_dir = os.path.join(store.root, PROFILES_SUBDIR, 'run1')
+    os.makedirs(profile_dir)
+    with open(os.path.join(profile_dir, 'cpu.prof'), 'wb') as f:
+        f.write(b'\0' * 300)
+    report = _file(tmp_path, 'report.html', 200)
+    store.link_session_path(7, report)
+    # профиль старше отчета, отчет старше артефакта
+    os.utime(profile_dir, (1_000_000, 1_000_000))
+    os.utime(report, (2_000_000, 2_000_000))
+    artifact = store.put(_file(tmp_path, 'a.zip', 100), 'archive')
+
+    removed = store.enforce_budget(max_bytes=250)
+
+    assert removed == [profile_dir, report]
+    assert not os.path.exists(profile_dir) and not os.path.exists(report)
+    assert os.path.exists(artifact['path'])
+    # путь удаленного файла больше не связан с сессией
+    assert store.paths_for_session(7) == []
+
+
+def test_enforce_budget_drops_records_without_files(tmp_path):
+    store = ArtifactStore(str(tmp_path / 'store'), max_bytes=10 ** 6)
+    artifact = store.put(_file(tmp_path, 'a.zip', 100), 'archive')
+    os.remove(artifact['path'])
+
+    assert store.enforce_budget() == []
+    assert store.list_artifacts() == []
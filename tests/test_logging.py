@@ -0,0 +1,54 @@
+import logging
+
+from config.logging import RateLimitFilter, StageCounters
+
+
+class _Collect(logging.Handler):
+    def __init__(self, log_filter):
+        super().__init__()
+        self.addFilter(log_filter)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def _logger(name, log_filter):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.handlers = []
+    handler = _Collect(log_filter)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    return logger, handler
+
+
+def test_rate_limit_filter_suppresses_repeats_of_one_call_site():
+    log_filter = RateLimitFilter(period=60, burst=3)
+    logger, handler = _logger('tests.rate_limit', log_filter)
+
+    for i in range(10):
+        logger.warning(f"Повтор {i}")
+
+    assert [r.getMessage() for r in handler.records] == ['Повтор 0', 'Повтор 1', 'Повтор 2']
+    assert sum(log_filter.pop_suppressed().values()) == 7
+
+
+def test_rate_limit_filter_keeps_every_stage_summary():
+    log_filter = RateLimitFilter(period=60, burst=3)
+    logger, handler = _logger('tests.stage_summary', log_filter)
+
+    for shard in range(16):
+        counters = StageCounters(logger, f'substance_consumers:shard{shard}')
+        counters.incr('processed', shard + 1)
+        counters.log_summary()
+
+    assert [r.stage for r in handler.records] == [f'substance_consumers:shard{shard}' for shard in range(16)]
+    assert handler.records[15].counters == {'processed': 16}
+    assert log_filter.pop_suppressed() == {}
+
+
+def test_stage_counters_without_events_log_nothing():
+    logger, handler = _logger('tests.empty_stage', RateLimitFilter())
+    StageCounters(logger, 'empty').log_summary()
+    assert handler.records == []
@@ -0,0 +1,34 @@
+from datetime import date, datetime
+
+import pytest
+
+pytest.importorskip('pandas')
+
+from app.parsers.medical_parser import parse_registration_date  # noqa: E402
+
+
+@pytest.mark.parametrize('value', ['05.03.2021', '2021-03-05', '2021-03-05 00:00:00', '05.03.21', ' 05.03.2021 '])
+def test_parses_known_formats(value):
+    assert parse_registration_date(value) == date(2021, 3, 5)
+
+
+def test_excel_dates_are_converted_to_date():
+    assert parse_registration_date(datetime(2021, 3, 5, 12, 30)) == date(2021, 3, 5)
+    assert parse_registration_date(date(2021, 3, 5)) == date(2021, 3, 5)
+
+
+@pytest.mark.parametrize('value', [None, float('nan'), '', 'nan', '~', '   '])
+def test_empty_values_are_none(value):
+    assert parse_registration_date(value) is None
+
+
+@pytest.mark.parametrize('value', ['31.02.2021', 'бессрочно', '2021/03/05'])
+def test_malformed_dates_raise(value):
+    with pytest.raises(ValueError):
+        parse_registration_date(value)
+
+
+@pytest.mark.parametrize('value', ['01.01.1899', '01.01.2101', datetime(1800, 1, 1)])
+def test_dates_out_of_range_raise(value):
+    with pytest.raises(ValueError):
+        parse_registration_date(value)
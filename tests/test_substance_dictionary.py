@@ -0,0 +1,42 @@
+from app.parsers.substance_dictionary import SubstanceDictionary, normalize_substance_name, normalize_text
+
+
+def test_salts_of_one_cation_stay_distinct(tmp_path):
+    assert normalize_substance_name('Магния сульфат') == 'магния сульфат'
+    assert normalize_substance_name('Натрия ацетат') == 'натрия ацетат'
+    assert normalize_substance_name('Метформина гидрохлорид') == 'метформина'
+
+    dictionary = SubstanceDictionary(str(tmp_path / 'dictionary.json'))
+    sulfate = dictionary.add('Магния сульфат')
+    citrate = dictionary.add('Магния цитрат')
+    acetate = dictionary.add('Натрия ацетат')
+    phosphate = dictionary.add('Натрия фосфат')
+
+    assert len({sulfate, citrate, acetate, phosphate}) == 4
+    assert 'магния' not in dictionary.aliases
+    assert 'натрия' not in dictionary.aliases
+
+
+def test_aliases_match_whole_words_only(tmp_path):
+    dictionary = SubstanceDictionary(str(tmp_path / 'dictionary.json'))
+    sodium_chloride = dictionary.add('Натрия хлорид')
+    paracetamol = dictionary.add('Парацетамол')
+    matcher = dictionary.matcher([sodium_chloride, paracetamol])
+
+    assert matcher.match(normalize_text('Натрия хлорид раствор 0,9%')) == {sodium_chloride}
+    assert matcher.match(normalize_text('Натрия гидрокарбонат')) == set()
+    assert matcher.match(normalize_text('Ибупрофен'), normalize_text('Парацетамол+Кофеин')) == {paracetamol}
+    # подстрока внутри другого слова - не совпадение
+    assert matcher.match(normalize_text('Парацетамолум')) == set()
+
+
+def test_cation_only_records_from_old_dictionary_are_dropped(tmp_path):
+    dictionary = SubstanceDictionary(str(tmp_path / 'dictionary.json'))
+    dictionary._merge({
+        'substances': [{'id': 1, 'name': 'Магния сульфат', 'key': 'магния'},
+                       {'id': 2, 'name': 'Парацетамол', 'key': 'парацетамол'}],
+        'aliases': {'магния': 1, 'магния сульфат': 1, 'парацетамол': 2},
+    })
+
+    assert set(dictionary.substances) == {2}
+    assert dictionary.aliases == {'парацетамол': 2}